@@ -0,0 +1,178 @@
+"""Generate a synthetic /proc tree for benchmarks and tests.
+
+Point process.PROC_DIR at FakeProc.path to run the watcher code against it.
+Files are regular files, so unlike the real /proc, reading a file kept open
+after its process was removed still succeeds.
+"""
+
+import os
+import os.path as P
+import random
+import shutil
+import tempfile
+
+STATUS_TEMPLATE = """Name:\t{comm}
+Umask:\t0022
+State:\tS (sleeping)
+Tgid:\t{pid}
+Ngid:\t0
+Pid:\t{pid}
+PPid:\t{ppid}
+TracerPid:\t0
+Uid:\t{uid}\t{uid}\t{uid}\t{uid}
+Gid:\t{uid}\t{uid}\t{uid}\t{uid}
+FDSize:\t64
+Groups:\t
+NStgid:\t{pid}
+NSpid:\t{pid}
+NSpgid:\t{pid}
+NSsid:\t{ppid}
+Kthread:\t0
+VmPeak:\t{vm_peak:8} kB
+VmSize:\t{vm_size:8} kB
+VmLck:\t       0 kB
+VmPin:\t       0 kB
+VmHWM:\t{vm_hwm:8} kB
+VmRSS:\t{vm_rss:8} kB
+RssAnon:\t{vm_rss:8} kB
+RssFile:\t       0 kB
+RssShmem:\t       0 kB
+VmData:\t     360 kB
+VmStk:\t     132 kB
+VmExe:\t      20 kB
+VmLib:\t    1528 kB
+VmPTE:\t      52 kB
+VmSwap:\t       0 kB
+HugetlbPages:\t       0 kB
+CoreDumping:\t0
+THP_enabled:\t1
+Threads:\t1
+SigQ:\t0/24002
+SigPnd:\t0000000000000000
+ShdPnd:\t0000000000000000
+SigBlk:\t0000000000000000
+SigIgn:\t0000000000000000
+SigCgt:\t0000000000000000
+CapInh:\t0000000000000000
+CapPrm:\t0000000000000000
+CapEff:\t0000000000000000
+CapBnd:\t000001fffeffffff
+CapAmb:\t0000000000000000
+NoNewPrivs:\t0
+Seccomp:\t0
+Seccomp_filters:\t0
+Speculation_Store_Bypass:\tthread vulnerable
+Cpus_allowed:\tff
+Cpus_allowed_list:\t0-7
+Mems_allowed:\t00000000,00000001
+Mems_allowed_list:\t0
+voluntary_ctxt_switches:\t{voluntary}
+nonvoluntary_ctxt_switches:\t{nonvoluntary}
+"""
+
+STAT_TEMPLATE = "{pid} ({comm}) S {ppid} {pid} {ppid} 0 -1 4194560 1900 0 0 0 {utime} {stime} 0 0 20 0 1 0 " \
+                "{start_time} {vsize} {rss_pages} 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0 " \
+                "0 0 0 0 0 0 0\n"
+
+IO_TEMPLATE = """rchar: {read_bytes}
+wchar: {write_bytes}
+syscr: 9
+syscw: 0
+read_bytes: {read_bytes}
+write_bytes: {write_bytes}
+cancelled_write_bytes: 0
+"""
+
+# Command names to pick from, roughly what a build host runs
+COMMANDS = ('bash', 'python3', 'cc1plus', 'ld', 'make', 'sshd', 'systemd', 'kworker/0:1', 'worker', 'java',
+            'node', 'postgres', 'nginx', 'sleep', 'gcc')
+
+# Files in /proc that aren't processes
+OTHER_ENTRIES = ('self', 'thread-self', 'meminfo', 'cpuinfo', 'stat', 'uptime', 'sys', 'net')
+
+
+class FakeProc:
+    """A directory laid out like /proc with PID directories containing
+    status, stat, comm, cmdline, cgroup and io files.
+
+    :param path: directory to create it in, a temporary directory if None
+    :param seed: random seed so trees are reproducible
+    """
+
+    def __init__(self, path=None, seed=0):
+        self.path = path if path is not None else tempfile.mkdtemp(prefix='fakeproc-')
+        self._random = random.Random(seed)
+        self.pids = set()
+        self._next_pid = 1
+        self._start_time = 1000
+        for name in OTHER_ENTRIES:
+            os.makedirs(P.join(self.path, name), exist_ok=True)
+
+    def add(self, comm=None, cmdline=None, ppid=1, pid=None, uid=1000, cgroup='/user.slice'):
+        """Add a process
+        :return its PID
+        """
+        rand = self._random
+        if pid is None:
+            pid = self._next_pid
+            self._next_pid += 1
+        if comm is None:
+            comm = rand.choice(COMMANDS)
+        if cmdline is None:
+            cmdline = ['/usr/bin/' + comm] + ['--arg{}'.format(i) for i in range(rand.randint(0, 4))]
+        self._start_time += 1
+
+        vm_rss = rand.randint(100, 500000)
+        vm_size = vm_rss + rand.randint(1000, 1000000)
+        values = {'pid': pid, 'ppid': ppid, 'comm': comm[:15], 'uid': uid,
+                  'vm_rss': vm_rss, 'vm_hwm': vm_rss + rand.randint(0, 1000),
+                  'vm_size': vm_size, 'vm_peak': vm_size + rand.randint(0, 1000),
+                  'voluntary': rand.randint(0, 10000), 'nonvoluntary': rand.randint(0, 1000),
+                  'utime': rand.randint(0, 100000), 'stime': rand.randint(0, 10000),
+                  'start_time': self._start_time, 'vsize': vm_size * 1024, 'rss_pages': vm_rss // 4,
+                  'read_bytes': rand.randint(0, 10 ** 9), 'write_bytes': rand.randint(0, 10 ** 9)}
+
+        directory = P.join(self.path, str(pid))
+        os.makedirs(directory, exist_ok=True)
+        self._write(directory, 'status', STATUS_TEMPLATE.format(**values))
+        self._write(directory, 'stat', STAT_TEMPLATE.format(**values))
+        self._write(directory, 'io', IO_TEMPLATE.format(**values))
+        self._write(directory, 'comm', values['comm'] + '\n')
+        self._write(directory, 'cmdline', '\x00'.join(cmdline) + '\x00')
+        self._write(directory, 'cgroup', '0::{}\n'.format(cgroup))
+        self.pids.add(pid)
+        return pid
+
+    @staticmethod
+    def _write(directory, name, text):
+        with open(P.join(directory, name), 'w') as f:
+            f.write(text)
+
+    def populate(self, count):
+        """Add count random processes"""
+        for _ in range(count):
+            self.add()
+
+    def remove(self, pid):
+        """Remove a process, as if it exited"""
+        shutil.rmtree(P.join(self.path, str(pid)))
+        self.pids.discard(pid)
+
+    def churn(self, count):
+        """Replace count random processes with new ones.
+        :return (removed PIDs, added PIDs)
+        """
+        removed = self._random.sample(sorted(self.pids), min(count, len(self.pids)))
+        for pid in removed:
+            self.remove(pid)
+        added = [self.add() for _ in range(count)]
+        return removed, added
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
@@ -0,0 +1,81 @@
+"""Measure the memory each watched process costs the watcher.
+
+Watches processes of a synthetic /proc tree, checks them twice so rates and
+history are filled in, and reports the bytes allocated per process with
+tracemalloc. Run from the repository root, results are printed as JSON:
+    python -m benchmarks.memory_bench --watched 50000 --history 1,120
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import process
+from process import ProcessByPID
+from benchmarks.fakeproc import FakeProc
+
+
+def measure(fake, history):
+    """:return dict with bytes per watched process for processes with history samples"""
+    ProcessByPID.history_size = history
+    pids = sorted(fake.pids)
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    processes = {pid: ProcessByPID(pid) for pid in pids}
+    for now in (1.0, 2.0):
+        for p in processes.values():
+            p.check(now)
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    # Of which the history ring buffers, fixed size per process
+    history_bytes = sum(sys.getsizeof(array) for p in processes.values()
+                        for array in (p.history.times, p.history.rss, p.history.vsz, p.history.cpu))
+    history_bytes += sum(sys.getsizeof(p.history) for p in processes.values())
+    count = len(processes)
+    for p in processes.values():
+        p.close()
+    return {'history': history, 'watched': count, 'bytes': total, 'bytes_per_process': total / count,
+            'history_bytes_per_process': history_bytes / count,
+            'record_bytes_per_process': (total - history_bytes) / count}
+
+
+def run(watched, histories=(1, 120)):
+    """:return dict of results for each history size"""
+    history_size = ProcessByPID.history_size
+    with FakeProc() as fake:
+        fake.populate(watched)
+        process.PROC_DIR = fake.path
+        try:
+            return {'watched': watched, 'results': [measure(fake, history) for history in histories]}
+        finally:
+            process.PROC_DIR = '/proc'
+            ProcessByPID.history_size = history_size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--watched', type=int, default=10000, help='processes watched. (default: %(default)s)')
+    parser.add_argument('--history', default='1,120',
+                        help='comma separated --history sizes to measure with. (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time(),
+              'run': run(args.watched, [int(size) for size in args.history.split(',')])}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
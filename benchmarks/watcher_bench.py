@@ -0,0 +1,174 @@
+"""Time the watcher's per-tick work against synthetic /proc trees.
+
+Run from the repository root, results are printed as JSON:
+    python -m benchmarks.watcher_bench --sizes 10,1000,100000
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import process
+from process import ProcessByPID, ProcessIDs, ProcessMatcher, check_all
+from process.alerts import AlertRules
+from process.parallel import ShardPool
+from process.pidfd import raise_open_file_limit
+from benchmarks.fakeproc import FakeProc
+
+# Mix of conditions a typical -c/-crx command line might have
+WILDCARDS = ('cc1*', 'ld', 'make', 'java', 'node*')
+REGEXES = (r'postgres(:.*)?', r'nginx|httpd', r'kworker/\d+:\d+')
+# Alert rules, repeated with other thresholds up to --alerts
+ALERTS = ('rss > {}GB', 'vsz > {}GB', 'rss growth > {}% in 5m', 'cpu < 1% for {}m', 'cpu > {}%',
+          'write_rate > {}MB')
+
+
+def make_matcher(patterns):
+    matcher = ProcessMatcher()
+    conditions = [(matcher.add_command_wildcard, pattern) for pattern in WILDCARDS]
+    conditions += [(matcher.add_command_regex, pattern) for pattern in REGEXES]
+    for i in range(patterns):
+        add, pattern = conditions[i % len(conditions)]
+        if i >= len(conditions):
+            # Distinct pattern that can't match, like extra rules for other hosts
+            pattern += 'x{}'.format(i)
+        add(pattern)
+    return matcher
+
+
+def make_alert_rules(count):
+    rules = AlertRules()
+    for i in range(count):
+        rules.add(ALERTS[i % len(ALERTS)].format(i // len(ALERTS) + 1))
+    return rules
+
+
+def timed(function, repeat):
+    """Run function repeat times
+    :return (best, mean) seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def result(times, items):
+    best, mean = times
+    return {'seconds': best, 'mean_seconds': mean, 'items': items,
+            'per_item_us': best / items * 1e6 if items else 0.0}
+
+
+def run(size, watched=1000, patterns=8, churn=0.01, repeat=5, pool=None, alerts=24):
+    """Benchmark one tree size
+    :param pool: optional process.parallel.ShardPool used for matching and checks
+    :return dict of results
+    """
+    with FakeProc() as fake:
+        start = time.perf_counter()
+        fake.populate(size)
+        setup_seconds = time.perf_counter() - start
+
+        process.PROC_DIR = fake.path
+        results = {}
+
+        results['process_ids_scan'] = result(timed(lambda: list(ProcessIDs(pool=pool)), repeat), size)
+
+        ids = ProcessIDs(pool=pool)
+        list(ids)
+        results['process_ids_rescan'] = result(timed(lambda: list(ids), repeat), size)
+
+        pids = sorted(fake.pids)
+        results['matcher_matching'] = result(
+            timed(lambda: list(make_matcher(patterns).matching(pids, pool)), repeat), size)
+
+        processes = {pid: ProcessByPID(pid) for pid in pids[:watched]}
+        results['process_check'] = result(timed(lambda: check_all(processes.values(), pool), repeat), len(processes))
+
+        rules = make_alert_rules(alerts)
+        checked = list(processes.values())
+        results['alert_evaluate'] = result(timed(lambda: rules.evaluate(checked, time.time()), repeat),
+                                           len(checked) * alerts)
+
+        # Full main loop tick: list /proc once to end the processes gone and
+        # watch new matching ones, then check the rest, after churn replaced some processes
+        matcher = make_matcher(patterns)
+        ids = ProcessIDs(on_remove=matcher.forget, pool=pool)
+        for pid in matcher.matching(list(ids), pool, ids.seen, ids.comms):
+            if pid not in processes:
+                processes[pid] = ProcessByPID(pid)
+        churn_count = max(1, int(size * churn))
+
+        def tick():
+            new_pids = list(ids)
+            for pid in ids.disappeared:
+                p = processes.pop(pid, None)
+                if p is not None:
+                    p.close()
+            ids.disappeared.clear()
+            ended, errors = check_all(list(processes.values()), pool)
+            for p in ended:
+                del processes[p.pid]
+            for pid in matcher.matching(new_pids, pool, ids.seen, ids.comms):
+                if pid not in processes:
+                    try:
+                        processes[pid] = ProcessByPID(pid)
+                    except process.NoProcessFound:
+                        pass
+
+        tick_times = []
+        for _ in range(repeat):
+            fake.churn(churn_count)
+            tick_times.append(timed(tick, 1)[0])
+        results['main_loop_tick'] = result((min(tick_times), sum(tick_times) / len(tick_times)),
+                                           len(processes))
+
+        for p in processes.values():
+            p.close()
+        process.PROC_DIR = '/proc'
+
+    return {'pids': size, 'watched': min(watched, size), 'patterns': patterns, 'alerts': alerts,
+            'churn_per_tick': churn_count,
+            'setup_seconds': setup_seconds, 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,1000,10000', help='comma separated numbers of PIDs. (default: %(default)s)')
+    parser.add_argument('--watched', type=int, default=1000, help='processes watched. (default: %(default)s)')
+    parser.add_argument('--patterns', type=int, default=8, help='command conditions. (default: %(default)s)')
+    parser.add_argument('--alerts', type=int, default=24, help='alert rules. (default: %(default)s)')
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help='fraction of processes replaced before each tick. (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, best is reported. (default: %(default)s)')
+    parser.add_argument('--keep-open', action='store_true', help='use ProcessByPID.keep_open sampling')
+    parser.add_argument('--workers', type=int, default=1, help='threads reading /proc. (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.keep_open:
+        raise_open_file_limit()
+        ProcessByPID.keep_open = True
+    pool = ShardPool(args.workers) if args.workers > 1 else None
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(),
+              'keep_open': args.keep_open, 'workers': args.workers, 'time': time.time(),
+              'runs': [run(int(size), args.watched, args.patterns, args.churn, args.repeat, pool, args.alerts)
+                       for size in args.sizes.split(',')]}
+    if pool is not None:
+        pool.close()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Coalesce notifications about processes that end around the same time.
+
+A pool that recycles hundreds of short-lived workers would otherwise send a
+notification per exit. Exits are grouped by executable and tag, and each
+group is held for a window from its first exit; then one notification is sent
+for the group: the process itself if it was alone, otherwise a Digest with
+counts and distributions of durations, memory and exit codes.
+
+The Coalescer is driven by the caller's main loop, which schedules a check of
+each new group at the deadline add() returns.
+"""
+
+from collections import Counter
+from datetime import timedelta
+
+DIGEST_FORMAT = """{count} {executable} processes ended{tag_text}
+ First ended: {first_ended:%a, %b %d %H:%M:%S}  Last ended: {last_ended:%a, %b %d %H:%M:%S}
+ Duration min/median/p95/max: {durations}
+ Resident memory peak min/median/p95/max: {memory} kB
+ Exit codes: {exit_codes}
+ PIDs: {pids_text}"""
+
+# PIDs listed in a digest
+MAX_PIDS = 20
+
+
+def distribution(values):
+    """:return (min, median, 95th percentile, max) of a non-empty list"""
+    values = sorted(values)
+    n = len(values)
+    return values[0], values[n // 2], values[min(n - 1, int(0.95 * n))], values[-1]
+
+
+def _duration_text(seconds):
+    return str(timedelta(seconds=round(seconds)))
+
+
+class Digest:
+    """Summary of several processes of a group that ended within the window.
+
+    Has the attributes and info() the communicate modules use for a process:
+    executable of the group, pid is the text of the first PIDs.
+    """
+
+    def __init__(self, key, processes):
+        self.executable, self.tag = key
+        self.processes = processes
+        self.count = len(processes)
+        self.pids = [process.pid for process in processes]
+        self.pid = '{} and {} more'.format(self.pids[0], self.count - 1)
+        self.command = processes[0].command
+        self.headline = '{} processes have stopped.'.format(self.count)
+
+    def info(self):
+        processes = self.processes
+        ended = [process.ended_datetime for process in processes]
+        durations = distribution([(process.ended_datetime - process.created_datetime).total_seconds()
+                                  for process in processes])
+        memory = distribution([process.status['VmHWM'] for process in processes])
+        exit_codes = Counter(process.exit_code for process in processes)
+        exit_text = ', '.join('{}: {}'.format('unknown' if code is None else code, count)
+                              for code, count in exit_codes.most_common())
+        pids_text = ', '.join(map(str, self.pids[:MAX_PIDS]))
+        if self.count > MAX_PIDS:
+            pids_text += ' and {} more'.format(self.count - MAX_PIDS)
+        return DIGEST_FORMAT.format(count=self.count, executable=self.executable,
+                                    tag_text=' ({})'.format(self.tag) if self.tag else '',
+                                    first_ended=min(ended), last_ended=max(ended),
+                                    durations=' / '.join(map(_duration_text, durations)),
+                                    memory=' / '.join('{:,}'.format(value) for value in memory),
+                                    exit_codes=exit_text, pids_text=pids_text)
+
+
+class Coalescer:
+    """Groups ended processes by (executable, tag) over a window
+
+    :param window: seconds a group collects exits after its first one
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # (executable, tag) -> list of ended processes
+        self.groups = {}
+
+    def __len__(self):
+        """Processes waiting"""
+        return sum(map(len, self.groups.values()))
+
+    @staticmethod
+    def key(process):
+        return process.executable, getattr(process, 'tag', None)
+
+    def add(self, process, now):
+        """Hold an ended process
+        :return (key, deadline) if it started a new group, whose pop() is due at the deadline, otherwise None
+        """
+        key = self.key(process)
+        group = self.groups.get(key)
+        if group is not None:
+            group.append(process)
+            return None
+        self.groups[key] = [process]
+        return key, now + self.window
+
+    def pop(self, key):
+        """:return what to notify about for the group: the process if it was alone, a Digest, or None if no group"""
+        processes = self.groups.pop(key, None)
+        if not processes:
+            return None
+        if len(processes) == 1:
+            return processes[0]
+        return Digest(key, processes)
+
+    def pop_all(self):
+        """:return what to notify about for every group, e.g. before exiting"""
+        return [self.pop(key) for key in list(self.groups)]
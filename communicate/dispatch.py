@@ -0,0 +1,414 @@
+"""Deliver notifications in background threads so watching never waits on network I/O.
+
+Each channel (a communicate module and its send() keyword args) has a bounded
+queue and its own worker threads, which limits how many sends run at once
+per channel. Failed sends are retried with exponential backoff.
+
+Modules with a send_batch(items, **send_args) function, where items are
+(process, subject_format) pairs and the result is a list of exceptions (None
+for success), are given all jobs queued at once (up to batch_size).
+
+A channel can be rate limited with a token bucket: each notification takes a
+token and workers wait for one when there are none left, while jobs keep
+queueing (and are dropped once the queue is full).
+"""
+
+import logging
+import queue
+import threading
+import time
+
+
+# Seconds per unit of parse_rate()
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(text):
+    """Parse a rate limit like 10/m (10 per minute) or 100/h
+    :return (tokens per second, burst), burst being the count
+    :raises ValueError
+    """
+    count, _, period = text.partition('/')
+    try:
+        count = int(count)
+        seconds = RATE_PERIODS[period.strip().lower() or 's']
+    except (ValueError, KeyError):
+        raise ValueError('Invalid rate {!r}, expected COUNT/PERIOD with period s, m, h or d, e.g. 10/m'.format(text))
+    if count < 1:
+        raise ValueError('Invalid rate {!r}, count must be at least 1'.format(text))
+    return count / seconds, count
+
+
+class TokenBucket:
+    """Allows rate events per second on average, bursts of up to burst at once.
+
+    :param rate: tokens added per second
+    :param burst: most tokens held, the bucket starts full
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self):
+        """:return 0 if a token was taken, otherwise seconds until one is available"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def take(self, stop=None):
+        """Wait for a token and take it
+        :param stop: threading.Event that ends waiting early
+        :return True if taken, False if stopped
+        """
+        while True:
+            wait = self.try_take()
+            if not wait:
+                return True
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+
+class Job:
+    """A notification waiting to be delivered"""
+
+    __slots__ = ('process', 'subject_format', 'created', 'attempts')
+
+    def __init__(self, process, subject_format):
+        self.process = process
+        self.subject_format = subject_format
+        self.created = time.time()
+        self.attempts = 0
+
+
+class Channel:
+    """Delivers jobs through one communicate module.
+
+    :param module: communicate module with a send(process=, subject_format=, ...) function
+    :param send_args: keyword args for send()
+    :param workers: max concurrent sends
+    :param timeout: passed to send() as timeout=, if not None
+    :param retries: how many times to retry a failed send
+    :param backoff: delay before the first retry (seconds), doubled each retry
+    :param max_backoff: longest delay between retries (seconds)
+    :param queue_size: max jobs waiting; new jobs are dropped when full
+    :param batch_size: max jobs per send_batch() call, if the module has it
+    :param batch_delay: seconds to wait for more jobs to batch after the first one
+    :param on_result: called from the worker thread as on_result(channel name, job, error) once a job
+                      was delivered (error is None) or given up on
+    :param rate_limit: (tokens per second, burst) from parse_rate(), None for no limit.
+                       Retries take tokens too. Waiting for tokens stops once the channel is closing.
+    """
+
+    def __init__(self, module, send_args=None, workers=1, timeout=None, retries=3, backoff=1.0,
+                 max_backoff=300.0, queue_size=1000, batch_size=100, batch_delay=0.0, on_result=None,
+                 rate_limit=None):
+        self.module = module
+        self.on_result = on_result
+        self._bucket = TokenBucket(*rate_limit) if rate_limit is not None else None
+        self._closing = threading.Event()
+        self._send_batch = getattr(module, 'send_batch', None) if batch_size > 1 else None
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.name = module.__name__.rsplit('.', 1)[-1]
+        self.send_args = dict(send_args or {})
+        if timeout is not None:
+            self.send_args['timeout'] = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Condition()
+        # Retries waiting for their backoff delay
+        self._timers = set()
+        # Jobs accepted but not yet delivered or given up on
+        self._pending = 0
+
+        # Statistics
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self._threads = [threading.Thread(target=self._work, name='{}-sender-{}'.format(self.name, i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """Jobs queued or waiting to be retried"""
+        return self._queue.qsize() + len(self._timers)
+
+    @property
+    def pending(self):
+        """Jobs accepted but not yet delivered or given up on, e.g. left when close() ran out of time"""
+        return self._pending
+
+    @property
+    def latency_mean(self):
+        """Mean seconds from submit to successful delivery"""
+        return self.latency_total / self.sent if self.sent else 0.0
+
+    def submit(self, job):
+        """Queue a job without blocking.
+        :return False if dropped because the queue is full
+        """
+        with self._lock:
+            if job.attempts == 0:
+                self._pending += 1
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self._finished()
+            logging.warning('{} notification queue full, dropped notification about process {}'
+                            .format(self.name, job.process.pid))
+            return False
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                # Sentinel from close()
+                return
+
+            if self._send_batch is None:
+                self._deliver(job)
+                continue
+
+            # Take everything else waiting, or arriving within batch_delay
+            jobs = [job]
+            stop = False
+            deadline = time.time() + self.batch_delay
+            while len(jobs) < self.batch_size:
+                try:
+                    job = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+
+            self._deliver_batch(jobs)
+            if stop:
+                return
+
+    def _wait_for_tokens(self, count):
+        """Take a token per job to be sent, waiting for them if the channel is rate limited"""
+        bucket = self._bucket
+        if bucket is None:
+            return
+        for _ in range(count):
+            if bucket.try_take():
+                with self._lock:
+                    self.rate_limited += 1
+                if not bucket.take(self._closing):
+                    # Closing, send the rest without waiting
+                    return
+
+    def _deliver(self, job):
+        self._wait_for_tokens(1)
+        job.attempts += 1
+        try:
+            self.module.send(process=job.process, subject_format=job.subject_format, **self.send_args)
+        except Exception as err:
+            self._failed(job, err)
+            return
+        self._delivered(job)
+
+    def _deliver_batch(self, jobs):
+        self._wait_for_tokens(len(jobs))
+        for job in jobs:
+            job.attempts += 1
+        try:
+            errors = self._send_batch([(job.process, job.subject_format) for job in jobs], **self.send_args)
+        except Exception as err:
+            errors = [err] * len(jobs)
+
+        for job, error in zip(jobs, errors):
+            if error is None:
+                self._delivered(job)
+            else:
+                self._failed(job, error)
+
+    def _delivered(self, job):
+        latency = time.time() - job.created
+        with self._lock:
+            self.sent += 1
+            self.latency_total += latency
+            if latency > self.latency_max:
+                self.latency_max = latency
+            self._finished()
+        self._report(job, None)
+
+    def _report(self, job, error):
+        if self.on_result is not None:
+            try:
+                self.on_result(self.name, job, error)
+            except Exception:
+                logging.exception('Exception encountered while reporting {} notification result'.format(self.name))
+
+    def _finished(self):
+        """Call with _lock held when a job is done with, successfully or not"""
+        self._pending -= 1
+        if not self._pending:
+            self._lock.notify_all()
+
+    def _failed(self, job, err):
+        if job.attempts > self.retries:
+            with self._lock:
+                self.failed += 1
+                self._finished()
+            logging.error('Giving up sending {} notification about process {} after {} attempts: {}'
+                          .format(self.name, job.process.pid, job.attempts, err))
+            self._report(job, err)
+            return
+
+        # Honor a delay requested by the server (e.g. HTTP 429 Retry-After)
+        delay = getattr(err, 'retry_after', None)
+        if delay is None:
+            delay = min(self.backoff * 2 ** (job.attempts - 1), self.max_backoff)
+        logging.warning('Failed sending {} notification about process {} ({}), retrying in {:.1f} seconds'
+                        .format(self.name, job.process.pid, err, delay))
+
+        timer = threading.Timer(delay, self._retry, (job,))
+        timer.daemon = True
+        with self._lock:
+            self.retried += 1
+            self._timers.add(timer)
+        timer.start()
+
+    def _retry(self, job):
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+        self.submit(job)
+
+    def close(self, timeout=None):
+        """Wait for queued jobs and pending retries to be delivered and stop workers.
+
+        :param timeout: max seconds to wait, None waits forever
+        :return: True if all jobs were done with and workers stopped in time, see pending for those left
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        self._closing.set()
+        with self._lock:
+            self._lock.wait_for(lambda: not self._pending, timeout)
+
+            # Out of time, abandon remaining retries
+            for timer in self._timers:
+                timer.cancel()
+            self._timers.clear()
+
+        try:
+            for _ in self._threads:
+                # Sentinels go after queued jobs; may block if full while workers drain it
+                self._queue.put(None, timeout=None if deadline is None else max(0.0, deadline - time.time()))
+        except queue.Full:
+            pass
+
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.time()))
+        return not self._pending and not any(thread.is_alive() for thread in self._threads)
+
+    def stats(self):
+        with self._lock:
+            return {'channel': self.name, 'queue_depth': self.depth, 'sent': self.sent, 'failed': self.failed,
+                    'dropped': self.dropped, 'retried': self.retried, 'rate_limited': self.rate_limited,
+                    'latency_mean': self.latency_mean,
+                    'latency_total': self.latency_total, 'latency_max': self.latency_max}
+
+
+class Dispatcher:
+    """Fans notifications out to the default channels, or the ones given
+
+    :param on_result: see Channel, can also be set later
+    """
+
+    def __init__(self, on_result=None):
+        # All channels, including ones only used when given to submit()
+        self.channels = []
+        self.default_channels = []
+        # (module name, send_args text) -> Channel
+        self._by_args = {}
+        self.on_result = on_result
+
+    def __bool__(self):
+        return bool(self.channels)
+
+    @staticmethod
+    def _key(module, send_args):
+        return module.__name__, repr(sorted((send_args or {}).items()))
+
+    def add_channel(self, module, send_args=None, default=True, **options):
+        """Add a channel, see Channel for options
+        :param default: whether submit() uses it when not given channels
+        :return Channel
+        """
+        channel = Channel(module, send_args, on_result=self._result, **options)
+        self.channels.append(channel)
+        if default:
+            self.default_channels.append(channel)
+        self._by_args.setdefault(self._key(module, send_args), channel)
+        return channel
+
+    def get_channel(self, module, send_args=None, **options):
+        """:return the channel of module with send_args, adding one that isn't a default channel if there's none.
+        Options are only used for a new channel."""
+        channel = self._by_args.get(self._key(module, send_args))
+        if channel is None:
+            channel = self.add_channel(module, send_args, default=False, **options)
+        return channel
+
+    def submit(self, process, subject_format='{executable} process {pid} ended', channels=None):
+        """Queue a notification about the process on each channel. Doesn't block.
+        :param channels: Channels to send it on, None for the default ones
+        """
+        for channel in self.default_channels if channels is None else channels:
+            channel.submit(Job(process, subject_format))
+
+    def _result(self, channel, job, error):
+        if self.on_result is not None:
+            self.on_result(channel, job, error)
+
+    @property
+    def depth(self):
+        return sum(channel.depth for channel in self.channels)
+
+    @property
+    def pending(self):
+        """Notifications not yet delivered or given up on, see Channel.pending"""
+        return sum(channel.pending for channel in self.channels)
+
+    def stats(self):
+        """:return list of per channel statistics dicts"""
+        return [channel.stats() for channel in self.channels]
+
+    def close(self, timeout=None):
+        """Deliver queued notifications and stop all channels.
+        :return True if everything was delivered in time
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        done = True
+        for channel in self.channels:
+            done &= channel.close(None if deadline is None else max(0.0, deadline - time.time()))
+        return done
@@ -1,20 +1,142 @@
-
+import atexit
 import logging
 import smtplib
+import threading
+import time
 from email.mime.text import MIMEText
 
 
-def send(to=None, process=None, machine='VTAG0', subject_format='{executable} process {pid} ended'):
-    """Send email about the ended process.
+class SMTPPool:
+    """Keeps SMTP connections open between sends so each message doesn't
+    need its own connection and session.
 
-    :param to: email addresses to send to
-    :param process: information about process. (.info() inserted into body)
-    :param subject_format: subject format string. (uses process.__dict__)
+    Connections idle for longer than idle_timeout are closed instead of reused,
+    since servers drop idle clients (usually after a few minutes).
+    A connection that breaks while sending is reopened once.
     """
-    if to is None:
-        raise ValueError('to keyword arg required')
 
-    body = "Process has stopped."
+    def __init__(self, host='localhost', port=0, timeout=None, idle_timeout=30.0, size=4):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        # Max idle connections kept, one is used per concurrent send
+        self.size = size
+        # (smtplib.SMTP, last used time)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.timeout is None:
+            return smtplib.SMTP(self.host, self.port)
+        return smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self):
+        now = time.time()
+        stale = []
+        smtp = None
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout:
+                    smtp = conn
+                    break
+                stale.append(conn)
+
+        for conn in stale:
+            _quit(conn)
+        return smtp if smtp is not None else self._connect()
+
+    def _release(self, smtp):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((smtp, time.time()))
+                return
+        _quit(smtp)
+
+    def send_messages(self, messages):
+        """Send messages in one SMTP session.
+
+        :param messages: email.message.Message objects
+        :return: list with None for each message sent, otherwise the exception
+        """
+        errors = []
+        smtp = None
+        try:
+            smtp = self._acquire()
+            for msg in messages:
+                try:
+                    smtp = self._send(smtp, msg)
+                    errors.append(None)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as err:
+                    # Server rejected this message, the session is still usable
+                    errors.append(err)
+
+        except Exception as err:
+            # Connection failed, this and the remaining messages weren't sent
+            if smtp is not None:
+                _quit(smtp)
+                smtp = None
+            errors += [err] * (len(messages) - len(errors))
+
+        finally:
+            if smtp is not None:
+                self._release(smtp)
+
+        return errors
+
+    def _send(self, smtp, msg):
+        """:return connection to keep using"""
+        try:
+            smtp.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # Server dropped the connection, reconnect and try once more
+            _quit(smtp)
+            smtp = self._connect()
+            smtp.send_message(msg)
+        return smtp
+
+    def close(self):
+        """Close idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for smtp, _ in idle:
+            _quit(smtp)
+
+
+def _quit(smtp):
+    try:
+        smtp.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp.close()
+
+
+# (host, port, timeout) -> SMTPPool
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host='localhost', port=0, timeout=None):
+    """Get the shared connection pool for a server"""
+    key = (host, port, timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SMTPPool(host, port, timeout)
+        return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+def make_message(to, process, machine='VTAG0', subject_format='{executable} process {pid} ended'):
+    """Build the email about the ended process (or other event, see process.headline)"""
+    body = getattr(process, 'headline', "Process has stopped.")
     body += '\n\n'
     body += process.info()
     body += '\n\n(automatically sent by process-watcher program)'
@@ -24,11 +146,36 @@ def send(to=None, process=None, machine='VTAG0', subject_format='{executable} pr
     # From is required
     msg['From'] = 'process.watcher@localhost'
     msg['To'] = ', '.join(to)
+    return msg
+
+
+def send(to=None, process=None, machine='VTAG0', subject_format='{executable} process {pid} ended',
+         timeout=None, host='localhost', port=0):
+    """Send email about the ended process.
+
+    :param to: email addresses to send to
+    :param process: information about process. (.info() inserted into body)
+    :param subject_format: subject format string. (uses process.__dict__)
+    :param timeout: seconds to wait for the SMTP server (None uses the socket default)
+    :param host: SMTP server, connections are reused between calls
+    :param port: SMTP server port (0 for default)
+    """
+    error, = send_batch([(process, subject_format)], to=to, machine=machine, timeout=timeout, host=host, port=port)
+    if error is not None:
+        raise error
+
+
+def send_batch(items, to=None, machine='VTAG0', timeout=None, host='localhost', port=0):
+    """Send emails about several ended processes in one SMTP session.
+
+    :param items: (process, subject_format) pairs
+    :return: list with None for each email sent, otherwise the exception
+    """
+    if to is None:
+        raise ValueError('to keyword arg required')
+
+    messages = [make_message(to, process, machine, subject_format) for process, subject_format in items]
 
     # Send the message via our own SMTP server.
-    s = smtplib.SMTP('localhost')
-    try:
-        logging.info('Sending email to: {}'.format(msg['To']))
-        s.send_message(msg)
-    finally:
-        s.quit()
+    logging.info('Sending {} email(s) to: {}'.format(len(messages), ', '.join(to)))
+    return get_pool(host, port, timeout).send_messages(messages)
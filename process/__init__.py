@@ -1,13 +1,21 @@
 """Process management and information gathering using /proc filesystem.
 """
 
+from array import array
 from datetime import datetime
 import time
 import os
 import os.path as P
+import sys
 from collections import deque
-from fnmatch import fnmatch
+from collections.abc import MutableMapping
+import fnmatch
 import re
+import threading
+
+from .netlink import PROC_EVENT_FORK, PROC_EVENT_EXEC, PROC_EVENT_EXIT
+from .history import SampleHistory, CLOCK_TICKS
+from .predicates import MatchExpression, ProcessFacts
 
 PROC_DIR = '/proc'
 time_now = time.time
@@ -19,14 +27,30 @@ INFO_RUNNING_FORMAT="""PID {pid}: {command}
 
 INFO_ENDED_FORMAT=INFO_RUNNING_FORMAT + "  Ended: {ended_datetime:%a, " \
                                         "%b %d %H:%M:%S}  (duration {" \
-                                        "duration_text})"
+                                        "duration_text}){exit_text}"
 
 MEM_TEXT = "\n Memory (current/peak) - " \
            "Resident: {status[VmRSS]:,} / {status[VmHWM]:,} kB   " \
            "Virtual: {status[VmSize]:,} / {status[VmPeak]:,} kB"
 
-INFO_RUNNING_FORMAT += MEM_TEXT
-INFO_ENDED_FORMAT += MEM_TEXT
+# I/O parts are left out for processes whose io isn't read, see ProcessByPID.read_io
+IO_RATES_TEXT = "I/O (read/write): {read_rate:,.0f} / {write_rate:,.0f} B/s   "
+RATES_TEXT = "\n CPU: {cpu_percent:.1f}%   " + IO_RATES_TEXT + \
+             "Context switches: {ctxt_switch_rate:,.1f}/s"
+
+IO_TOTALS_TEXT = "I/O - Read: {io[read_bytes]:,}  Written: {io[write_bytes]:,} bytes   "
+TOTALS_TEXT = "\n CPU time - User: {user_seconds:,.2f} s  System: {system_seconds:,.2f} s   " + IO_TOTALS_TEXT + \
+              "Context switches - Voluntary: {status[voluntary_ctxt_switches]:,}  " \
+              "Involuntary: {status[nonvoluntary_ctxt_switches]:,}"
+
+HISTORY_TEXT = "\n History ({history.samples} samples) - " \
+               "Resident mean/p95: {history.rss_mean:,.0f} / {history.rss_p95:,} kB   " \
+               "Growth: {history.rss_growth:+,.0f} kB/min   CPU: {history.cpu_percent:.1f}%"
+
+INFO_RUNNING_NO_IO_FORMAT = INFO_RUNNING_FORMAT + MEM_TEXT + RATES_TEXT.replace(IO_RATES_TEXT, '') + HISTORY_TEXT
+INFO_ENDED_NO_IO_FORMAT = INFO_ENDED_FORMAT + MEM_TEXT + TOTALS_TEXT.replace(IO_TOTALS_TEXT, '') + HISTORY_TEXT
+INFO_RUNNING_FORMAT += MEM_TEXT + RATES_TEXT + HISTORY_TEXT
+INFO_ENDED_FORMAT += MEM_TEXT + TOTALS_TEXT + HISTORY_TEXT
 
 
 class NoProcessFound(Exception):
@@ -37,64 +61,376 @@ class NoProcessFound(Exception):
         self.pid = pid
 
 
+# Totals of work done since start, to monitor the watcher itself (see process.metrics).
+# Updated with add_count() since ShardPool threads update them too.
+counters = {'files_opened': 0, 'matcher_checks': 0, 'matcher_cache_hits': 0, 'matcher_hits': 0}
+_counters_lock = threading.Lock()
+
+
+def add_count(name, n=1):
+    with _counters_lock:
+        counters[name] += n
+
+
+# Per thread buffer reused for reading /proc files as bytes without
+# allocating per read
+_buffers = threading.local()
+
+
+def _read_into_buffer(fd):
+    """Read a whole /proc file from offset 0 into this thread's buffer.
+    :return (buffer, number of bytes read)
+    """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _buffers.buffer = bytearray(4096)
+    while True:
+        n = os.preadv(fd, [buffer], 0)
+        if n < len(buffer):
+            return buffer, n
+        # File didn't fit, grow buffer and try again
+        buffer = _buffers.buffer = bytearray(len(buffer) * 2)
+
+
+def _parse_fields(data, n, keys, values):
+    """Parse "Name:\t  1234 kB" lines of status-like files straight from bytes.
+
+    :param data: buffer holding the file contents
+    :param n: length of the contents in data
+    :param keys: b'\nName:' for each field to parse, in the order found in the file
+    :param values: array to store the int value of each field in, by position
+    """
+    position = 0
+    for i, key in enumerate(keys):
+        start = data.find(key, position, n)
+        if start < 0:
+            # Not present, e.g. kernel threads have no Vm* fields
+            continue
+        start += len(key)
+        position = data.find(b'\n', start, n)
+        if position < 0:
+            position = n
+        # int() ignores the surrounding whitespace but not the units
+        end = data.find(b' kB', start, position)
+        values[i] = int(data[start:end if end >= 0 else position])
+
+
+def _field_keys(fields):
+    return tuple('\n{}:'.format(field).encode() for field in fields)
+
+
+class Fields(MutableMapping):
+    """Fixed set of int fields, used like a dict (status['VmRSS']) but stored in an array.
+
+    :param index: dict of field name -> position, shared by all instances with the same fields
+    """
+
+    __slots__ = ('_index', 'values')
+
+    def __init__(self, index):
+        self._index = index
+        self.values = array('q', bytes(8 * len(index)))
+
+    @staticmethod
+    def index(fields):
+        """:return the index of Fields with these field names"""
+        return {field: i for i, field in enumerate(fields)}
+
+    def __getitem__(self, name):
+        return self.values[self._index[name]]
+
+    def __setitem__(self, name, value):
+        self.values[self._index[name]] = value
+
+    def __delitem__(self, name):
+        raise TypeError('Fields are fixed')
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _read_proc_file(fd, pid, name):
+    """Read /proc/PID/name into this thread's buffer from fd if kept open, otherwise open it.
+    :return (buffer, number of bytes read)
+    """
+    if fd is not None:
+        return _read_into_buffer(fd)
+
+    fd = os.open('{}/{}/{}'.format(PROC_DIR, pid, name), os.O_RDONLY)
+    add_count('files_opened')
+    try:
+        return _read_into_buffer(fd)
+    finally:
+        os.close(fd)
+
+
+# Index of fields after comm in /proc/PID/stat (field number in man proc - 3)
+STAT_PPID = 1
+STAT_UTIME = 11
+STAT_STIME = 12
+STAT_STARTTIME = 19
+
+
 class ProcessByPID:
-    """Information about a process using the /proc filesystem"""
+    """Information about a process using the /proc filesystem
+
+    Records use __slots__, since the watcher may keep tens of thousands: memory
+    and I/O fields are arrays (see Fields), times are seconds since epoch
+    (created, ended) with datetime properties for formatting, and command and
+    executable strings are interned so processes of the same program share
+    them. __dict__ is a view of the attributes by name, for the
+    subject_format.format(**process.__dict__) calls of the communicate modules.
+    """
+
+    __slots__ = ('pid', 'running', 'start_time', 'command', 'executable', 'created', 'ended', 'exit_code',
+                 'exit_text', 'utime', 'stime', 'cpu_ticks', 'history', 'status', 'io',
+                 'cpu_percent', 'read_rate', 'write_rate', 'ctxt_switch_rate',
+                 # Latest sample: time, CPU ticks, bytes read and written, context switches
+                 '_last_time', '_last_cpu', '_last_read', '_last_write', '_last_ctxt',
+                 '_status_fd', '_stat_fd', '_io_fd', '_read_io',
+                 # Set by the watcher: label for notifications and digests, and config spec watched for
+                 'tag', 'spec')
 
     # /proc/<PID>/status fields to record
     # WARNING: Must list fields in order found in file for update_status()
     # algorithm to work. (done for efficiency)
     # Also, fields are assumed to be int
-    status_fields = ('VmPeak', 'VmSize', 'VmHWM', 'VmRSS')
+    status_fields = ('VmPeak', 'VmSize', 'VmHWM', 'VmRSS', 'voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches')
+    _status_keys = _field_keys(status_fields)
+    _status_index = Fields.index(status_fields)
 
-    # Values will be stored in object as _status_X
+    # /proc/<PID>/io fields to record, same rules as status_fields.
+    # Reading io requires the same permissions as ptrace, so it is skipped for
+    # processes that can't be read.
+    io_fields = ('read_bytes', 'write_bytes')
+    _io_keys = _field_keys(io_fields)
+    _io_index = Fields.index(io_fields)
 
-    def __init__(self, pid):
+    # Keep /proc/<PID>/status, stat and io open and re-read them with pread on
+    # each check, instead of opening them every time. Costs three file
+    # descriptors per process. Reading a stale fd raises ProcessLookupError,
+    # which signals the process ended.
+    keep_open = False
 
-        self.pid = pid
-        self.running = True
-        self.ended_datetime = None
+    # Read io on each check. Unless kept open that's a third file opened per
+    # check, so the watcher turns it off when nothing uses I/O statistics;
+    # read_rate, write_rate and io then stay zero and info() leaves them out.
+    read_io = True
+
+    # Number of samples kept in history
+    history_size = 120
 
-        # Mapping of each status_fields to value from the status file.
-        # Initialize fields to zero in case info() is called.
-        self.status = {field: 0 for field in self.status_fields}
+    # Computed attributes included in __dict__
+    _view_properties = ('created_datetime', 'ended_datetime', 'duration', 'duration_text', 'user_seconds',
+                        'system_seconds', 'sample_time')
+    # class -> names in __dict__
+    _view_names = {}
 
-        self.path = path = P.join(PROC_DIR, str(pid))
+    def __init__(self, pid):
+
+        self._init_state(pid)
+
+        path = self.path
         if not P.exists(path):
             raise NoProcessFound(pid)
 
-        self.status_path = P.join(path, 'status')
-
         # Get the command that started the process
+        add_count('files_opened')
         with open(P.join(path, 'cmdline'), encoding='utf-8') as f:
             cmd = f.read()
             # args are separated by \x00 (Null byte)
-            self.command = cmd.replace('\x00', ' ').strip()
+            self.command = sys.intern(cmd.replace('\x00', ' ').strip())
 
             if self.command == '':
                 # Some processes (such as kworker) have nothing in cmdline, read comm instead
+                add_count('files_opened')
                 with open(P.join(path, 'comm')) as comm_file:
-                    self.command = self.executable = comm_file.read().strip()
+                    self.command = self.executable = sys.intern(comm_file.read().strip())
 
             else:
                 # Just use 1st arg instead of reading comm
-                self.executable = self.command.split()[0]
+                self.executable = sys.intern(self.command.split()[0])
 
         # Get the start time (/proc/PID file creation time)
-        self.created_datetime = datetime.fromtimestamp(P.getctime(path))
+        self.created = P.getctime(path)
+
+        if self.keep_open:
+            try:
+                self._status_fd = os.open(self.status_path, os.O_RDONLY)
+                self._stat_fd = os.open(self.stat_path, os.O_RDONLY)
+                add_count('files_opened', 2)
+                try:
+                    self._io_fd = os.open(self.io_path, os.O_RDONLY)
+                    add_count('files_opened')
+                except PermissionError:
+                    self._read_io = False
+            except (FileNotFoundError, ProcessLookupError):
+                # Ended between the opens, don't leak the ones already open
+                self.close()
+                raise NoProcessFound(pid)
 
         self.check()
 
+    def _init_state(self, pid):
+        """Set the attributes that don't come from /proc to their initial values"""
+        self.pid = pid
+        self.running = True
+        self.command = self.executable = ''
+        self.created = 0.0
+        self.ended = None
+        # Only known when an exit event was received (see process.netlink)
+        self.exit_code = None
+        self.exit_text = ''
+        self._status_fd = None
+        self._stat_fd = None
+        self._io_fd = None
+        self._read_io = True
+        # Clock ticks after boot the process started (from stat), with the PID
+        # it identifies the process since PIDs are reused
+        self.start_time = None
+        # CPU time in clock ticks
+        self.utime = self.stime = self.cpu_ticks = 0
+        self.history = SampleHistory(self.history_size)
+
+        # Value of each of status_fields from the status file, and io_fields.
+        # Zero until read in case info() is called.
+        self.status = Fields(self._status_index)
+        self.io = Fields(self._io_index)
+
+        # Rates between the last two checks
+        self.cpu_percent = self.read_rate = self.write_rate = self.ctxt_switch_rate = 0.0
+        self._last_time = None
+        self._last_cpu = self._last_read = self._last_write = self._last_ctxt = 0
+        self.tag = self.spec = None
+
+    @property
+    def path(self):
+        return P.join(PROC_DIR, str(self.pid))
+
+    @property
+    def status_path(self):
+        return P.join(self.path, 'status')
+
+    @property
+    def stat_path(self):
+        return P.join(self.path, 'stat')
+
+    @property
+    def io_path(self):
+        return P.join(self.path, 'io')
+
+    @property
+    def created_datetime(self):
+        return datetime.fromtimestamp(self.created)
+
+    @property
+    def ended_datetime(self):
+        return datetime.fromtimestamp(self.ended) if self.ended is not None else None
+
+    @property
+    def duration(self):
+        """timedelta from start to end, None while running"""
+        if self.ended is None:
+            return None
+        return self.ended_datetime - self.created_datetime
+
+    @property
+    def duration_text(self):
+        if self.ended is None:
+            return ''
+        # Formats like 3:06:29.873626, so cutoff microseconds
+        text = str(self.duration)
+        return text[:text.rfind('.')] if '.' in text else text
+
+    @property
+    def reads_io(self):
+        """Whether io is read on each check: read_io or kept open, and permitted"""
+        return self._read_io and (self.read_io or self.keep_open)
+
+    @property
+    def sample_time(self):
+        """Time of the latest statistics, None before the first check"""
+        return self._last_time
+
+    @property
+    def user_seconds(self):
+        return self.utime / CLOCK_TICKS
+
+    @property
+    def system_seconds(self):
+        return self.stime / CLOCK_TICKS
+
+    @property
+    def __dict__(self):
+        """Attributes and computed values by name, like an instance dict"""
+        cls = type(self)
+        names = self._view_names.get(cls)
+        if names is None:
+            names = [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ())
+                     if not name.startswith('_')]
+            names = self._view_names[cls] = names + list(self._view_properties)
+        return {name: getattr(self, name, None) for name in names}
+
     def info(self):
         """Get information about process.
         command, start_time"""
 
         if self.running:
-            return INFO_RUNNING_FORMAT.format(**self.__dict__)
+            info_format = INFO_RUNNING_FORMAT if self.reads_io else INFO_RUNNING_NO_IO_FORMAT
         else:
-            return INFO_ENDED_FORMAT.format(**self.__dict__)
+            info_format = INFO_ENDED_FORMAT if self.reads_io else INFO_ENDED_NO_IO_FORMAT
+        return info_format.format(**self.__dict__)
+
+    def as_dict(self):
+        """:return JSON serializable summary of the process and its latest statistics"""
+        history = self.history
+        return {'pid': self.pid, 'start_time': self.start_time, 'command': self.command, 'executable': self.executable,
+                'running': self.running, 'exit_code': self.exit_code,
+                'created': self.created, 'ended': self.ended,
+                'status': dict(self.status), 'io': dict(self.io),
+                'user_seconds': self.user_seconds, 'system_seconds': self.system_seconds,
+                'cpu_percent': self.cpu_percent, 'read_rate': self.read_rate, 'write_rate': self.write_rate,
+                'ctxt_switch_rate': self.ctxt_switch_rate,
+                'history': {'samples': history.samples, 'rss_mean': history.rss_mean, 'rss_p95': history.rss_p95,
+                            'rss_growth': history.rss_growth, 'cpu_percent': history.cpu_percent}}
 
-    def update_status(self):
-        """Update status statistics from file at self.status_path
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a process from as_dict() output, e.g. saved before a restart.
+
+        Nothing is read from /proc, so it's only good for reporting. The process
+        is still marked running; history and rates aren't restored.
+        """
+        self = cls.__new__(cls)
+        self._init_state(data['pid'])
+        self.start_time = data['start_time']
+        self.command = sys.intern(data['command'])
+        self.executable = sys.intern(data['executable'])
+        self.created = data['created']
+        for fields, values in ((self.status, data['status']), (self.io, data['io'])):
+            for name, value in values.items():
+                if name in fields:
+                    fields[name] = value
+        self.utime = round(data['user_seconds'] * CLOCK_TICKS)
+        self.stime = round(data['system_seconds'] * CLOCK_TICKS)
+        self.cpu_ticks = self.utime + self.stime
+        return self
+
+    def update_status(self, now=None):
+        """Update status statistics from file at self.status_path,
+        CPU time from self.stat_path, I/O from self.io_path, rates since the
+        last update and add a sample to history.
+
+        :param now: time of the sample, so all processes checked together share it
         """
 
         # Memory information can be found in status and statm /proc/PID files
@@ -106,93 +442,282 @@ class ProcessByPID:
         #       * VmSize: Virtual memory size.
         #       * VmHWM: Peak resident set size ("high water mark").
         #       * VmRSS: Resident set size.
+        #       * voluntary_ctxt_switches, nonvoluntary_ctxt_switches:
+        #         Number of voluntary and involuntary context switches.
+        if now is None:
+            now = time_now()
+
+        pid = self.pid
+        data, n = _read_proc_file(self._stat_fd, pid, 'stat')
+        # comm may contain spaces, fields are counted after its closing parenthesis
+        fields = data[data.rfind(b')', 0, n) + 2:n].split(None, STAT_STARTTIME + 1)
+        start_time = int(fields[STAT_STARTTIME])
+        if self.start_time is not None and start_time != self.start_time:
+            # The PID was reused, this process is gone
+            raise ProcessLookupError(pid)
+        self.start_time = start_time
+        self.utime = int(fields[STAT_UTIME])
+        self.stime = int(fields[STAT_STIME])
+        self.cpu_ticks = self.utime + self.stime
+
+        data, n = _read_proc_file(self._status_fd, pid, 'status')
+        # Positions in status_fields
+        vm_size, vm_rss, voluntary, nonvoluntary = 1, 3, 4, 5
+        status = self.status.values
+        _parse_fields(data, n, self._status_keys, status)
+
+        # Positions in io_fields
+        read_bytes, write_bytes = 0, 1
+        io = self.io.values
+        if self.reads_io:
+            try:
+                data, n = _read_proc_file(self._io_fd, pid, 'io')
+                _parse_fields(data, n, self._io_keys, io)
+            except PermissionError:
+                self._read_io = False
+
+        ctxt_switches = status[voluntary] + status[nonvoluntary]
+        last_time = self._last_time
+        if last_time is not None and now > last_time:
+            elapsed = now - last_time
+            self.cpu_percent = (self.cpu_ticks - self._last_cpu) / CLOCK_TICKS / elapsed * 100
+            self.read_rate = (io[read_bytes] - self._last_read) / elapsed
+            self.write_rate = (io[write_bytes] - self._last_write) / elapsed
+            self.ctxt_switch_rate = (ctxt_switches - self._last_ctxt) / elapsed
+        self._last_time = now
+        self._last_cpu = self.cpu_ticks
+        self._last_read = io[read_bytes]
+        self._last_write = io[write_bytes]
+        self._last_ctxt = ctxt_switches
+
+        self.history.append(now, status[vm_rss], status[vm_size], self.cpu_ticks)
 
-        # status_fields should be ordered as in the status file
-        fields = iter(self.status_fields)
-        field = next(fields)
-        with open(self.status_path) as f:
-            for line in f:
-                if line.startswith(field):
-                    # separated by white-space, 2nd element is value
-                    # 3rd is units e.g. kB
-                    # At the moment all fields are ints
-                    self.status[field] = int(line.split()[1])
-
-                    try:
-                        field = next(fields)
-                    except StopIteration:
-                        # Just found the last field in status_fields
-                        break
-
-    def check(self):
+    def check(self, now=None):
         """Check whether process is running and update statistics if it is.
+        :param now: time of the check, see update_status()
         :return True if running, otherwise False
         """
 
         if not self.running:
             return False
 
-        # On my machine, os.kill is faster and takes ~0.3usec while os.stat and P.exists take ~1.5usec (using timeit)
-        # However, with kill if the process is under a separate UID, PermissionError is raised
-        # Could try os.kill and fallback to P.exists and save the choice, but that's just overcomplicated
+        # No separate existence check: reading fails once the process is gone
+        # (kept open files too), and ProcessIDs reports the ones that ended
+        # between checks without reading anything of theirs
+        try:
+            self.update_status(now)
+            return True
+        except (ProcessLookupError, FileNotFoundError):
+            self.mark_ended()
+            return False
 
-        running = P.exists(self.path)
-        if running:
-            self.update_status()
-        else:
-            # Process ended since last check, recond end time
-            self.running = False
-            self.ended_datetime = datetime.now()
-            # TODO duration attribute could have a value while running; update in getter method
-            self.duration = self.ended_datetime - self.created_datetime
-            # Formats like 3:06:29.873626, so cutoff microseconds
-            text = str(self.duration)
-            self.duration_text = text[:text.rfind('.')]
+    def mark_ended(self, exit_code=None, ended_datetime=None):
+        """Record that the process ended, e.g. when notified by an exit event.
+
+        :param exit_code: returncode if known (negative for signal number)
+        :param ended_datetime: when it ended if not now
+        """
+        if not self.running:
+            return
+
+        self.running = False
+        self.close()
+        self.ended = ended_datetime.timestamp() if ended_datetime is not None else time_now()
 
-        return running
+        if exit_code is not None:
+            self.exit_code = exit_code
+            if exit_code < 0:
+                self.exit_text = '  (killed by signal {})'.format(-exit_code)
+            else:
+                self.exit_text = '  (exit code {})'.format(exit_code)
+
+    def close(self):
+        """Release the file descriptors kept open by keep_open mode."""
+        if self._status_fd is not None:
+            os.close(self._status_fd)
+            self._status_fd = None
+        if self._stat_fd is not None:
+            os.close(self._stat_fd)
+            self._stat_fd = None
+        if self._io_fd is not None:
+            os.close(self._io_fd)
+            self._io_fd = None
 
     def __eq__(self, other):
         return self.pid == other.pid
 
 
+def _check_shard(processes, now):
+    """:return list of (process, running, exception or None)"""
+    results = []
+    for process in processes:
+        try:
+            results.append((process, process.check(now), None))
+        except Exception as err:
+            results.append((process, True, err))
+    return results
+
+
+def check_all(processes, pool=None):
+    """Check and sample all processes in one pass sharing one timestamp.
+
+    :param processes: iterable of ProcessByPID
+    :param pool: optional parallel.ShardPool to read /proc on several threads
+    :return: (list of processes found to have ended,
+              list of (process, exception) for processes that couldn't be checked)
+              both in the order of processes
+    """
+    now = time_now()
+    if pool is None:
+        results = _check_shard(processes, now)
+    else:
+        results = pool.map(lambda shard: _check_shard(shard, now), processes)
+
+    ended = []
+    errors = []
+    for process, running, err in results:
+        if err is not None:
+            errors.append((process, err))
+        elif not running:
+            ended.append(process)
+    return ended, errors
+
+
 class ProcessIDs:
     """Provides an iterator over the current PIDs and any new ones spawned over time.
+
+    Each iteration lists /proc once and diffs it against the previous listing,
+    keyed by (PID, start time) so a reused PID is seen as one process ending
+    and another appearing. New PIDs are yielded; the ones gone are collected
+    in `disappeared`. stat is only read for new PIDs and when the inode of
+    /proc/PID changes, which it does when the PID is reused; besides the start
+    time, the command name and parent PID read with it are kept in `comms` and
+    `parents` so matching new processes and adding them to a tree doesn't read
+    it again. With a parallel.ShardPool those reads are done on its threads.
+
+    If given an event source (process.netlink.ProcConnector), /proc is only
+    listed on the first iteration (or after events were lost); afterwards new
+    PIDs come from fork/exec events. A PID is yielded again when it execs
+    since its command changed. Exit events are collected in `exited`.
     """
 
-    def __init__(self, cleanup_seen_interval=300):
-        self.cleanup_seen_interval = cleanup_seen_interval
-        self.last_cleanup_time = time_now()
-        self.seen = set()
+    def __init__(self, events=None, on_remove=None, pool=None):
+        # Called with each PID dropped from seen (ended, or exec'd with events)
+        # e.g. ProcessMatcher.forget
+        self.on_remove = on_remove
+        # PID -> start time of the processes found, None if not read (events)
+        self.seen = {}
+        # PID -> inode of /proc/PID in the last listing
+        self._inodes = {}
         self._new_pids = deque()
+        self.events = events
+        self.pool = pool
+        self._scanned = False
+        # PID -> start time of processes gone since they were seen (found by listing /proc)
+        # Consumer should pop/clear entries it handled.
+        self.disappeared = {}
+        # PID -> ProcEvent of processes that exited (only with events)
+        # Consumer should pop/clear entries it handled.
+        self.exited = {}
+        # PID -> command name and PID -> parent PID of the PIDs yielded by the
+        # last iteration, read from stat while listing /proc (parents also
+        # from fork events)
+        self.comms = {}
+        self.parents = {}
 
     def __iter__(self):
         """Loads new PIDs spawned since last iteration to be iterated over via next()
         """
-        seen = self.seen
-        if time_now() - self.last_cleanup_time > self.cleanup_seen_interval:
-            # Time to cleanup seen set
-            to_remove = set()
-            for pid in seen:
-                # Remove from seen if PID no longer running
-                if not P.exists(P.join(PROC_DIR, str(pid))):
-                    to_remove.add(pid)
-
-            seen -= to_remove
-            self.last_cleanup_time = time_now()
-
-        for file in os.listdir(PROC_DIR):
-            try:
-                pid = int(file)
-                if pid not in seen:
-                    self._new_pids.append(pid)
+        self.comms.clear()
+        self.parents.clear()
+        if self.events is not None:
+            self._read_events()
+            if self._scanned and not self.events.overrun:
+                return self
+            self.events.overrun = False
 
-            except ValueError:
+        self._scanned = True
+        self._scan()
+        return self
+
+    def _scan(self):
+        """List /proc and record the differences from the last listing"""
+        seen = self.seen
+        old_inodes = self._inodes
+        inodes = {}
+        # New PIDs, and seen ones whose /proc/PID was made again, either for a
+        # new process or because its cached inode was dropped
+        unknown = []
+        for entry in os.scandir(PROC_DIR):
+            name = entry.name
+            if not name.isdigit():
                 # Non PID file in /proc
-                pass
+                continue
+            pid = int(name)
+            inode = inodes[pid] = entry.inode()
+            if pid in seen:
+                old_inode = old_inodes.get(pid)
+                if old_inode is None or old_inode == inode:
+                    continue
+            unknown.append(pid)
 
-        seen.update(self._new_pids)
+        for pid in seen.keys() - inodes.keys():
+            self._remove(pid)
+        self._inodes = inodes
 
-        return self
+        if self.pool is not None:
+            stats = self.pool.map(lambda shard: [read_stat(pid) for pid in shard], unknown)
+        else:
+            stats = [read_stat(pid) for pid in unknown]
+        new_pids = self._new_pids
+        for pid, stat in zip(unknown, stats):
+            if stat is None:
+                # Ended already
+                continue
+            comm, fields = stat
+            start_time = int(fields[STAT_STARTTIME])
+            if pid in seen:
+                if start_time == seen[pid]:
+                    continue
+                self._remove(pid)
+            seen[pid] = start_time
+            self.comms[pid] = comm.decode(errors='replace')
+            self.parents[pid] = int(fields[STAT_PPID])
+            new_pids.append(pid)
+
+    def _remove(self, pid):
+        self.disappeared[pid] = self.seen.pop(pid)
+        if self.on_remove is not None:
+            self.on_remove(pid)
+
+    def _read_events(self):
+        seen = self.seen
+        new_pids = self._new_pids
+        on_remove = self.on_remove
+        for event in self.events.read_events():
+            if not event.is_process:
+                # Thread events
+                continue
+
+            pid = event.pid
+            if event.what == PROC_EVENT_EXEC:
+                # Same process with a new command
+                if on_remove is not None:
+                    on_remove(pid)
+                seen.setdefault(pid, None)
+                new_pids.append(pid)
+
+            elif event.what == PROC_EVENT_FORK:
+                self.parents[pid] = event.parent_tgid
+                if pid not in seen:
+                    seen[pid] = None
+                    new_pids.append(pid)
+
+            elif event.what == PROC_EVENT_EXIT:
+                seen.pop(pid, None)
+                self.exited[pid] = event
+                if on_remove is not None:
+                    on_remove(pid)
 
     def __next__(self):
         if self._new_pids:
@@ -202,61 +727,311 @@ class ProcessIDs:
             raise StopIteration
 
 
+# Leading global inline flags, e.g. (?i), which aren't allowed once the
+# regex is combined with others
+_GLOBAL_FLAGS_RE = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+def _scoped_regex(pattern):
+    """Turn leading global flags into scoped flags: (?i)abc -> (?i:abc)"""
+    m = _GLOBAL_FLAGS_RE.match(pattern)
+    if m:
+        return '(?{}:{})'.format(m.group(1), pattern[m.end():])
+    return '(?:{})'.format(pattern)
+
+
+# Backreferences by number or name, and conditional groups, which would refer
+# to other groups once the regex is combined with others
+_GROUP_REFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _combinable(pattern):
+    """:return whether a regex means the same as part of a combined regex:
+    it has no named groups (which can clash) nor references to groups
+    """
+    return not re.compile(pattern).groupindex and _GROUP_REFERENCE_RE.search(pattern) is None
+
+
+def parse_stat(data):
+    """Split /proc/PID/stat contents (bytes) into comm and the remaining fields.
+
+    comm is in parentheses and may itself contain spaces and parentheses.
+    :return (comm bytes, list of fields from state (field 3) onward)
+    """
+    start = data.find(b'(')
+    end = data.rfind(b')')
+    return data[start + 1:end], data[end + 2:].split()
+
+
+def read_stat(pid):
+    """:return (comm bytes, list of fields from state onward) of /proc/PID/stat, None if the process is gone"""
+    try:
+        with open(P.join(PROC_DIR, str(pid), 'stat'), 'rb') as f:
+            add_count('files_opened')
+            data = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return parse_stat(data)
+
+
+def read_start_time(pid):
+    """:return start time (clock ticks after boot) of the process, None if it is gone"""
+    stat = read_stat(pid)
+    return int(stat[1][STAT_STARTTIME]) if stat is not None else None
+
+
 class ProcessMatcher:
-    """Provides various conditions to match against process metadata"""
+    """Provides various conditions to match against process metadata
+
+    All command patterns, and those of watch specs (process.config.WatchSpec),
+    are compiled into a single regular expression, except regexes with named
+    groups or group references, which are matched one by one. The command name of each
+    process matched is cached per process identity (PID and start time, so a
+    reused PID is matched again) until forget() is called for the PID, so
+    conditions added later match known processes without reading them again.
+
+    Match expressions (see process.predicates) are tried, cheapest first, on
+    processes the command patterns don't match, reading only the /proc files
+    they need.
+    """
 
     def __init__(self):
         self._command_wildcards = []
         self._command_regexs = []
+        # MatchExpressions sorted by cost
+        self._expressions = []
+        # name -> spec with pattern, name and matches(comm), in the order they're tried by spec_for()
+        self._specs = {}
+        # Combined regex of the command conditions, None if there are none
+        self._command_re = None
+        # Compiled command conditions that can't be combined, see _combinable()
+        self._separate_res = []
+        # Incremented when conditions change, so cached results are matched again
+        self._version = 0
+        # PID -> (start time, comm, matched, version of the conditions it was matched against)
+        self._cache = {}
 
-    def matches(self, pid):
+    def matches(self, pid, start_time=None, comm=None, ppid=None):
         """Check if conditions match the process specified by the PID.
 
         :param pid: Running process PID to inspect
+        :param start_time: the process's start time if known, e.g. from ProcessIDs.seen:
+                           a process matched before isn't read again
+        :param comm: the process's command name if known with start_time, e.g. from ProcessIDs.comms:
+                     nothing is read to match it
+        :param ppid: parent PID if known, e.g. from ProcessIDs.parents
         :return: True if matches, otherwise False
         """
-        if self._command_wildcards or self._command_regexs:
-            # Matchers requiring comm file
-            path = P.join(PROC_DIR, str(pid), 'comm')
-            try:
-                with open(path) as f:
-                    comm = f.read().rstrip()
-                    for pattern in self._command_wildcards:
-                        if fnmatch(comm, pattern):
-                            return True
-
-                    for re_obj in self._command_regexs:
-                        if re_obj.match(comm):
-                            return True
-            except FileNotFoundError:
-                # process may have exited before file could be read
-                return False
+        if self._command_re is None and not self._separate_res and not self._expressions:
+            return False
+
+        cached = self._cache.get(pid)
+        if cached is None or start_time is None or cached[0] != start_time:
+            if start_time is None or comm is None:
+                # stat has both the comm and the start time, so one read gives the
+                # process identity and what to match
+                stat = read_stat(pid)
+                if stat is None:
+                    # process may have exited before file could be read
+                    return False
+                comm, fields = stat
+                comm = comm.decode(errors='replace')
+                start_time = int(fields[STAT_STARTTIME])
+                ppid = int(fields[STAT_PPID])
+            if cached is not None and cached[0] != start_time:
+                cached = None
 
+        if cached is not None:
+            add_count('matcher_cache_hits')
+            matched = cached[2]
+            if cached[3] != self._version:
+                matched = self._match(pid, cached[1], None)
+                self._cache[pid] = (start_time, cached[1], matched, self._version)
+        else:
+            matched = self._match(pid, comm, ppid)
+            self._cache[pid] = (start_time, comm, matched, self._version)
+        add_count('matcher_checks')
+        if matched:
+            add_count('matcher_hits')
+        return matched
+
+    def _match(self, pid, comm, ppid):
+        """:return whether the command patterns or an expression match
+        :param ppid: parent PID if known, so expressions don't read stat again
+        """
+        if self._command_re is not None and self._command_re.match(comm) is not None:
+            return True
+        if any(re_obj.match(comm) is not None for re_obj in self._separate_res):
+            return True
+        if self._expressions:
+            facts = ProcessFacts(pid, comm, ppid)
+            return any(expression.matches(facts) for expression in self._expressions)
         return False
 
-    def matching(self, pids):
+    def matching(self, pids, pool=None, start_times=None, comms=None, parents=None):
         """yields PIDs from the provided iterator that match conditions.
+
+        With a parallel.ShardPool the PIDs are all read first, on its threads,
+        and matches are yielded in their original order.
+
+        :param start_times: dict of PID -> start time or None, see matches()
+        :param comms: dict of PID -> command name, e.g. ProcessIDs.comms
+        :param parents: dict of PID -> parent PID, e.g. ProcessIDs.parents
         """
+        get_start_time = (start_times or {}).get
+        get_comm = (comms or {}).get
+        get_ppid = (parents or {}).get
+
+        def matches(pid):
+            return self.matches(pid, get_start_time(pid), get_comm(pid), get_ppid(pid))
+
+        if pool is not None:
+            pids = list(pids)
+            matched = pool.map(lambda shard: [matches(pid) for pid in shard], pids)
+            for pid, match in zip(pids, matched):
+                if match:
+                    yield pid
+            return
+
         for pid in pids:
-            if self.matches(pid):
+            if matches(pid):
                 yield pid
 
+    def forget(self, pid):
+        """Drop the cached result for a PID, e.g. when the process ended or exec'd."""
+        self._cache.pop(pid, None)
+
     @property
     def num_conditions(self):
-        return len(self._command_wildcards) + len(self._command_regexs)
+        return len(self._command_wildcards) + len(self._command_regexs) + len(self._expressions) + \
+            sum(1 for spec in self._specs.values() if spec.pattern)
+
+    def add_spec(self, spec):
+        """Match processes by a watch spec's pattern, replacing the spec with the same name
+        :raises re.error if its pattern can't be compiled, the conditions are then unchanged
+        """
+        specs = dict(self._specs)
+        specs[spec.name] = spec
+        self._compile(specs=specs)
+
+    def remove_spec(self, name):
+        """Stop matching processes by a spec
+        :return the spec or None if there's none with the name
+        """
+        spec = self._specs.get(name)
+        if spec is not None:
+            self._compile(specs={key: other for key, other in self._specs.items() if key != name})
+        return spec
+
+    def spec_for(self, pid):
+        """:return the first spec matching a process matches() found matching, None if no spec does"""
+        cached = self._cache.get(pid)
+        if cached is None:
+            return None
+        for spec in self._specs.values():
+            if spec.matches(cached[1]):
+                return spec
+        return None
 
     def add_command_wildcard(self, pattern):
         """Match processes whose command matches the pattern. (fnmatch)
         :param pattern: wildcard pattern (*,?, [])
         """
-        self._command_wildcards.append(pattern)
+        self._compile(wildcards=self._command_wildcards + [pattern])
 
     def add_command_regex(self, pattern):
         """Match processes whose command matches the Regular Expression.
 
         :param pattern: Regular Expression string
+        :raises re.error if it can't be compiled, the conditions are then unchanged
         """
         # Make regex match consistent with wildcards, i.e. full string match
         if not pattern.endswith('$'):
             pattern += '$'
-        self._command_regexs.append(re.compile(pattern))
+        # Compile on its own first so errors point at the bad pattern
+        self._compile(regexs=self._command_regexs + [re.compile(pattern)])
+
+    def remove_command_wildcard(self, pattern):
+        """Stop matching processes by a pattern given to add_command_wildcard()
+        :raises ValueError if there's no such pattern
+        """
+        if pattern not in self._command_wildcards:
+            raise ValueError('No command wildcard {!r}'.format(pattern))
+        self._compile(wildcards=[wildcard for wildcard in self._command_wildcards if wildcard != pattern])
+
+    def remove_command_regex(self, pattern):
+        """Stop matching processes by a pattern given to add_command_regex()
+        :raises ValueError if there's no such pattern
+        """
+        for re_obj in self._command_regexs:
+            if re_obj.pattern in (pattern, pattern + '$'):
+                self._compile(regexs=[other for other in self._command_regexs if other is not re_obj])
+                return
+        raise ValueError('No command regex {!r}'.format(pattern))
+
+    def add_expression(self, text):
+        """Match processes by an expression of predicates, e.g. "user = www-data and cmdline ~ gunicorn"
+        :raises ValueError if it can't be parsed
+        """
+        self._expressions.append(MatchExpression(text))
+        self._expressions.sort(key=lambda expression: expression.cost)
+        self._version += 1
+
+    def remove_expression(self, text):
+        """Stop matching processes by an expression given to add_expression()
+        :raises ValueError if there's no such expression
+        """
+        text = ' '.join(text.split())
+        for expression in self._expressions:
+            if expression.text == text:
+                self._expressions.remove(expression)
+                self._version += 1
+                return
+        raise ValueError('No match expression {!r}'.format(text))
+
+    @property
+    def expressions(self):
+        return [expression.text for expression in self._expressions]
+
+    @property
+    def command_wildcards(self):
+        return list(self._command_wildcards)
+
+    @property
+    def command_regexs(self):
+        return [re_obj.pattern for re_obj in self._command_regexs]
+
+    def _compile(self, wildcards=None, regexs=None, specs=None):
+        """Use new command conditions, those not given being unchanged: combine
+        them into one regex and mark cached results to be matched again.
+
+        Everything is compiled before any condition is changed, so a failure
+        leaves the matcher as it was.
+        :raises re.error
+        """
+        wildcards = self._command_wildcards if wildcards is None else wildcards
+        regexs = self._command_regexs if regexs is None else regexs
+        specs = self._specs if specs is None else specs
+
+        patterns = [fnmatch.translate(pattern) for pattern in wildcards]
+        separate = []
+        for re_obj in regexs:
+            if _combinable(re_obj.pattern):
+                patterns.append(_scoped_regex(re_obj.pattern))
+            else:
+                separate.append(re_obj)
+        for spec in specs.values():
+            if not spec.pattern:
+                continue
+            if _combinable(spec.pattern):
+                patterns.append(spec.pattern)
+            else:
+                separate.append(re.compile(spec.pattern))
+        command_re = re.compile('|'.join(patterns)) if patterns else None
+
+        self._command_wildcards = list(wildcards)
+        self._command_regexs = list(regexs)
+        self._specs = dict(specs)
+        self._command_re = command_re
+        self._separate_res = separate
+        self._version += 1
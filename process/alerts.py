@@ -0,0 +1,299 @@
+"""Threshold alerts on the statistics of watched processes.
+
+Rules are written like:
+
+    rss > 8GB                 resident memory above 8 GB
+    rss growth > 50% in 5m    resident memory grew by half within 5 minutes
+    cpu < 1% for 10m          (nearly) idle for 10 minutes, e.g. hung
+    write_rate > 50MB clear 10MB
+
+Each rule is parsed once into an AlertRule. AlertRules.evaluate() is given all
+the processes checked in a tick and evaluates rule by rule: the values of each
+metric are gathered once into a column shared by the rules using it, and the
+threshold comparison runs over the whole column with map(), so only the
+processes past a threshold (or with an alert pending or active) are handled
+one by one.
+
+An alert fires once when its condition holds (for the whole duration with
+"for") and resolves when the value crosses back past the threshold by the
+hysteresis margin (10% of the threshold unless given with "clear"), so a value
+hovering around the threshold doesn't flap.
+"""
+
+from datetime import datetime
+from itertools import compress, repeat
+import operator
+import re
+
+# Multipliers to kB, the unit of memory values in /proc/PID/status
+MEMORY_UNITS = {'': 1, 'b': 1 / 1024, 'k': 1, 'kb': 1, 'kib': 1, 'm': 1024, 'mb': 1024, 'mib': 1024,
+                'g': 1024 ** 2, 'gb': 1024 ** 2, 'gib': 1024 ** 2, 't': 1024 ** 3, 'tb': 1024 ** 3, 'tib': 1024 ** 3}
+# Multipliers to bytes per second
+RATE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'kib': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2, 'mib': 1024 ** 2,
+              'g': 1024 ** 3, 'gb': 1024 ** 3, 'gib': 1024 ** 3}
+PERCENT_UNITS = {'': 1, '%': 1}
+DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# name -> (function of a process giving the value, units accepted, format of values, SampleHistory column or None)
+METRICS = {
+    'rss': (lambda process: process.status['VmRSS'], MEMORY_UNITS, '{:,.0f} kB', 'rss'),
+    'vsz': (lambda process: process.status['VmSize'], MEMORY_UNITS, '{:,.0f} kB', 'vsz'),
+    'cpu': (operator.attrgetter('cpu_percent'), PERCENT_UNITS, '{:.1f}%', None),
+    'read_rate': (operator.attrgetter('read_rate'), RATE_UNITS, '{:,.0f} B/s', None),
+    'write_rate': (operator.attrgetter('write_rate'), RATE_UNITS, '{:,.0f} B/s', None),
+}
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+_RULE_RE = re.compile(r'''
+    (?P<metric>\w+) \s+
+    (?:(?P<growth>growth) \s+)?
+    (?P<op>[<>]=?) \s* (?P<value>\d+(?:\.\d*)?) \s* (?P<unit>[a-z%]*(?:/s)?)
+    (?: \s+ (?P<mode>in|for) \s+ (?P<duration>\d+(?:\.\d*)?) \s* (?P<duration_unit>[smhd]?) )?
+    (?: \s+ clear \s+ (?P<clear>\d+(?:\.\d*)?) \s* (?P<clear_unit>[a-z%]*(?:/s)?) )?
+    $''', re.VERBOSE | re.IGNORECASE)
+
+ALERT_FORMAT = "Alert {text}: {value_text}\n Fired: {fired_datetime:%a, %b %d %H:%M:%S}{resolved_text}\n"
+
+NAN = float('nan')
+
+
+class AlertRule:
+    """A parsed alert rule and the alerts pending and active for it
+
+    :param text: rule, see the module docstring
+    :param hysteresis: margin past the threshold to resolve, as a fraction of it, if the rule has no "clear"
+    :raises ValueError if the rule can't be parsed
+    """
+
+    def __init__(self, text, hysteresis=0.1):
+        m = _RULE_RE.match(text.strip())
+        if m is None:
+            raise ValueError('Invalid alert rule {!r}, expected e.g. "rss > 8GB", "rss growth > 50% in 5m" '
+                             'or "cpu < 1% for 10m"'.format(text))
+        self.text = ' '.join(text.split())
+        self.metric = metric = m.group('metric').lower()
+        if metric not in METRICS:
+            raise ValueError('Unknown metric {!r} in alert rule {!r}, one of: {}'.format(
+                metric, text, ', '.join(METRICS)))
+        self._get, units, self.value_format, history_column = METRICS[metric]
+
+        self.growth = m.group('growth') is not None
+        mode = m.group('mode')
+        duration = float(m.group('duration') or 0) * DURATION_UNITS[(m.group('duration_unit') or '').lower()]
+        # Seconds growth is measured over
+        self.window = duration if mode == 'in' else None
+        # Seconds the condition has to hold for
+        self.duration = duration if mode == 'for' else 0.0
+        if self.growth:
+            if history_column is None:
+                raise ValueError('No growth of {} in alert rule {!r}, only of rss and vsz'.format(metric, text))
+            if self.window is None:
+                raise ValueError('Alert rule {!r} needs "in DURATION" to measure growth over'.format(text))
+            self._history_column = history_column
+        elif self.window is not None:
+            raise ValueError('"in" is for growth, use "for" in alert rule {!r}'.format(text))
+
+        # Growth in % is relative to the value at the start of the window
+        self.relative = self.growth and m.group('unit') == '%'
+        if self.relative:
+            units = PERCENT_UNITS
+            self.value_format = '{:+.0f}%'
+        elif self.growth:
+            self.value_format = '+' + self.value_format
+        self.compare = OPERATORS[m.group('op')]
+        self.threshold = self._parse_value(m.group('value'), m.group('unit'), units, text)
+
+        if m.group('clear') is not None:
+            self.clear_threshold = self._parse_value(m.group('clear'), m.group('clear_unit'), units, text)
+        else:
+            margin = abs(self.threshold) * hysteresis
+            above = self.compare in (operator.gt, operator.ge)
+            self.clear_threshold = self.threshold - margin if above else self.threshold + margin
+
+        # Values are gathered once per tick for all the rules with the same key
+        self.column = (metric, self.window, self.relative)
+
+        # PID -> time the condition started holding, for rules with a duration
+        self.pending = {}
+        # PID -> Alert fired and not resolved
+        self.active = {}
+
+    @staticmethod
+    def _parse_value(value, unit, units, text):
+        try:
+            return float(value) * units[unit.lower().replace('/s', '') if unit else '']
+        except KeyError:
+            raise ValueError('Unknown unit {!r} in alert rule {!r}'.format(unit, text))
+
+    def __repr__(self):
+        return 'AlertRule({!r})'.format(self.text)
+
+    def values(self, processes, now):
+        """:return list of the metric of each process, NaN where it isn't known"""
+        if not self.growth:
+            return list(map(self._get, processes))
+
+        values = []
+        start_time = now - self.window
+        for process in processes:
+            history = process.history
+            i = history.index_at(start_time)
+            if i is None:
+                values.append(NAN)
+                continue
+            column = getattr(history, self._history_column)
+            before = column[i]
+            current = self._get(process)
+            if self.relative:
+                values.append((current - before) / before * 100 if before else NAN)
+            else:
+                values.append(current - before)
+        return values
+
+    def update(self, processes, values, index, now):
+        """Fire and resolve alerts from this tick's values
+
+        :param processes: processes checked this tick
+        :param values: values(processes, now)
+        :param index: dict of PID -> position in processes
+        :return list of Alert fired or resolved
+        """
+        compare = self.compare
+        pending = self.pending
+        active = self.active
+        changed = []
+
+        # Comparisons with NaN are false, so unknown values never match
+        hits = list(compress(range(len(values)), map(compare, values, repeat(self.threshold))))
+        hit_pids = set()
+        for i in hits:
+            process = processes[i]
+            pid = process.pid
+            hit_pids.add(pid)
+            alert = active.get(pid)
+            if alert is not None:
+                alert.value = values[i]
+                continue
+            if self.duration:
+                since = pending.setdefault(pid, now)
+                if now - since < self.duration:
+                    continue
+                del pending[pid]
+            alert = active[pid] = Alert(self, process, values[i], now)
+            changed.append(alert)
+
+        # The condition stopped holding before the duration
+        for pid in [pid for pid in pending if pid not in hit_pids and pid in index]:
+            del pending[pid]
+
+        for pid, alert in list(active.items()):
+            i = index.get(pid)
+            if i is None or pid in hit_pids:
+                continue
+            value = values[i]
+            if value == value and not compare(value, self.clear_threshold):
+                del active[pid]
+                alert.value = value
+                alert.resolve(now)
+                changed.append(alert)
+        return changed
+
+    def forget(self, pid):
+        """Drop the alerts of a process, e.g. when it ended
+        :return the Alert active for it or None
+        """
+        self.pending.pop(pid, None)
+        return self.active.pop(pid, None)
+
+
+class AlertRules:
+    """All the alert rules, evaluated together for the processes checked each tick"""
+
+    def __init__(self, hysteresis=0.1):
+        self.hysteresis = hysteresis
+        self.rules = []
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add(self, text):
+        """Add a rule
+        :return AlertRule
+        :raises ValueError if the rule can't be parsed
+        """
+        rule = AlertRule(text, self.hysteresis)
+        self.rules.append(rule)
+        return rule
+
+    def evaluate(self, processes, now):
+        """Evaluate all rules for processes that were just checked.
+
+        :param processes: running ProcessByPID objects with a new sample
+        :param now: time of the check
+        :return list of Alert fired or resolved
+        """
+        if not self.rules or not processes:
+            return []
+        index = {process.pid: i for i, process in enumerate(processes)}
+        columns = {}
+        changed = []
+        for rule in self.rules:
+            values = columns.get(rule.column)
+            if values is None:
+                values = columns[rule.column] = rule.values(processes, now)
+            changed += rule.update(processes, values, index, now)
+        return changed
+
+    def forget(self, pid):
+        """Drop the alerts of a process that is no longer watched"""
+        for rule in self.rules:
+            rule.forget(pid)
+
+    def active(self):
+        """:return list of the alerts fired and not resolved"""
+        return [alert for rule in self.rules for alert in rule.active.values()]
+
+
+class Alert:
+    """An alert about a process, fired and possibly resolved.
+
+    Has the attributes and info() the communicate modules use for a process,
+    with pid, command and executable of the process.
+    """
+
+    def __init__(self, rule, process, value, now):
+        self.rule = rule
+        self.text = rule.text
+        self.process = process
+        self.pid = process.pid
+        self.start_time = process.start_time
+        self.command = process.command
+        self.executable = process.executable
+        self.value = value
+        self.fired_datetime = datetime.fromtimestamp(now)
+        self.resolved_datetime = None
+        self.headline = 'Alert: {}'.format(rule.text)
+
+    @property
+    def resolved(self):
+        return self.resolved_datetime is not None
+
+    def resolve(self, now):
+        self.resolved_datetime = datetime.fromtimestamp(now)
+        self.headline = 'Alert resolved: {}'.format(self.rule.text)
+
+    @property
+    def value_text(self):
+        return self.rule.value_format.format(self.value)
+
+    def info(self):
+        if self.resolved:
+            resolved_text = '  Resolved: {:%a, %b %d %H:%M:%S}'.format(self.resolved_datetime)
+        else:
+            resolved_text = ''
+        return ALERT_FORMAT.format(value_text=self.value_text, resolved_text=resolved_text,
+                                   **self.__dict__) + self.process.info()
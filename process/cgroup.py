@@ -0,0 +1,196 @@
+"""Watch a cgroup v2 (e.g. a systemd service or a container) as one unit.
+
+A cgroup ends when its cgroup.events says "populated 0", i.e. no process is
+left in it or its descendants. The kernel signals changes to cgroup.events as
+file modifications, so a single inotify instance reports every watched group
+emptying without reading /proc for any of their processes.
+"""
+
+import os
+import os.path as P
+from datetime import datetime
+
+from .inotify import Inotify, IN_MODIFY, IN_IGNORED
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+CGROUP_RUNNING_FORMAT = """cgroup {name}: {processes} processes
+ Started: {created_datetime:%a, %b %d %H:%M:%S}"""
+
+CGROUP_ENDED_FORMAT = """cgroup {name}: emptied
+ Started: {created_datetime:%a, %b %d %H:%M:%S}  Ended: {ended_datetime:%a, %b %d %H:%M:%S}  (duration {duration_text})"""
+
+CGROUP_STATS_TEXT = "\n Memory (current/peak): {memory_current:,} / {memory_peak:,} bytes   " \
+                    "CPU time - User: {user_seconds:,.2f} s  System: {system_seconds:,.2f} s"
+
+
+class NoCgroupFound(Exception):
+    """Indicate a cgroup (v2) could not be found."""
+    def __init__(self, path):
+        super(NoCgroupFound, self).__init__('No cgroup v2 at {}'.format(path))
+        self.path = path
+
+
+def _read_int(path):
+    """:return int contents of a single value file, None if it doesn't exist (e.g. controller not enabled)"""
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _read_keyed(path):
+    """:return dict of "key value" lines such as cgroup.events and cpu.stat, empty if it doesn't exist"""
+    try:
+        with open(path) as f:
+            return {key: int(value) for key, value in (line.split() for line in f if line.strip())}
+    except FileNotFoundError:
+        return {}
+
+
+class CgroupByPath:
+    """Information about a cgroup v2 from its directory
+
+    Has the attributes and info() the communicate modules use for a process;
+    pid is the cgroup path.
+
+    :param path: cgroup directory, relative paths are relative to CGROUP_ROOT
+    :raises NoCgroupFound
+    """
+
+    def __init__(self, path):
+        self.path = path = P.normpath(P.join(CGROUP_ROOT, path))
+        self.events_path = P.join(path, 'cgroup.events')
+        if not P.isfile(self.events_path):
+            raise NoCgroupFound(path)
+
+        self.pid = path
+        self.name = P.relpath(path, CGROUP_ROOT) if path.startswith(CGROUP_ROOT + os.sep) else path
+        self.executable = self.name
+        self.created_datetime = datetime.fromtimestamp(P.getctime(path))
+        self.running = True
+        self.populated = True
+        self.ended_datetime = None
+        self.exit_text = ''
+        self.processes = 0
+        self.memory_current = self.memory_peak = 0
+        # cpu.stat values, e.g. usage_usec, user_usec, system_usec
+        self.cpu = {}
+
+        self.check()
+
+    @property
+    def user_seconds(self):
+        return self.cpu.get('user_usec', 0) / 1e6
+
+    @property
+    def system_seconds(self):
+        return self.cpu.get('system_usec', 0) / 1e6
+
+    def info(self):
+        text = CGROUP_RUNNING_FORMAT if self.running else CGROUP_ENDED_FORMAT
+        return (text + CGROUP_STATS_TEXT).format(user_seconds=self.user_seconds, system_seconds=self.system_seconds,
+                                                 **self.__dict__)
+
+    def update_stats(self):
+        """Read the memory and CPU statistics and the number of processes."""
+        path = self.path
+        try:
+            with open(P.join(path, 'cgroup.procs'), 'rb') as f:
+                self.processes = f.read().count(b'\n')
+        except FileNotFoundError:
+            pass
+
+        memory_current = _read_int(P.join(path, 'memory.current'))
+        if memory_current is not None:
+            self.memory_current = memory_current
+        # memory.peak is new in Linux 5.19, fall back to the highest value seen
+        memory_peak = _read_int(P.join(path, 'memory.peak'))
+        self.memory_peak = max(self.memory_peak, self.memory_current, memory_peak or 0)
+
+        cpu = _read_keyed(P.join(path, 'cpu.stat'))
+        if cpu:
+            self.cpu = cpu
+
+    def check(self):
+        """Check whether the cgroup still has processes and update statistics if it does.
+        :return True if populated, otherwise False
+        """
+        if not self.running:
+            return False
+
+        events = _read_keyed(self.events_path)
+        # A removed cgroup is empty too
+        self.populated = bool(events.get('populated', 0))
+        if self.populated:
+            self.update_stats()
+        else:
+            self.mark_ended()
+        return self.populated
+
+    def mark_ended(self):
+        if not self.running:
+            return
+        self.running = False
+        self.processes = 0
+        self.ended_datetime = datetime.now()
+        self.duration = self.ended_datetime - self.created_datetime
+        text = str(self.duration)
+        self.duration_text = text[:text.rfind('.')]
+
+
+class CgroupWatcher:
+    """Reports changes of watched cgroups' cgroup.events files using inotify.
+
+    Raises OSError if inotify isn't available, so callers can fall back to
+    polling. Has fileno() so it can be passed to select/selectors.
+    """
+
+    def __init__(self):
+        self._inotify = Inotify()
+        self._paths = {}  # watch descriptor -> cgroup path
+        self._wds = {}  # cgroup path -> watch descriptor
+
+    def __len__(self):
+        return len(self._wds)
+
+    def __contains__(self, path):
+        return path in self._wds
+
+    def fileno(self):
+        return self._inotify.fileno()
+
+    def add(self, cgroup):
+        """Start watching a CgroupByPath"""
+        if cgroup.path in self._wds:
+            return
+        wd = self._inotify.add_watch(cgroup.events_path, IN_MODIFY)
+        self._wds[cgroup.path] = wd
+        self._paths[wd] = cgroup.path
+
+    def remove(self, path):
+        wd = self._wds.pop(path, None)
+        if wd is not None:
+            del self._paths[wd]
+            self._inotify.rm_watch(wd)
+
+    def read_changed(self):
+        """:return paths of cgroups whose cgroup.events changed or was removed, without blocking"""
+        changed = []
+        for wd, mask, _ in self._inotify.read_events():
+            path = self._paths.get(wd)
+            if path is None:
+                continue
+            if mask & IN_IGNORED:
+                # cgroup removed, the watch is gone
+                del self._paths[wd]
+                del self._wds[path]
+            if path not in changed:
+                changed.append(path)
+        return changed
+
+    def close(self):
+        self._inotify.close()
+        self._paths.clear()
+        self._wds.clear()
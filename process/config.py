@@ -0,0 +1,212 @@
+"""JSON config files (-j) of watches, reloaded when they change.
+
+    {
+      "to": ["ops@example.com"],
+      "channel": ["ops"],
+      "alerts": ["rss > 8GB"],
+      "processes": [
+        {"name": "dropbox", "command": "dropbox"},
+        {"name": "workers", "regex": "worker-\\d+", "interval": 5, "to": ["team@example.com"], "tag": "batch"},
+        {"name": "db", "pid": 1234}
+      ]
+    }
+
+Each entry of "processes" is parsed once into a WatchSpec: its command
+wildcard and regex compiled into one pattern, and its own check interval,
+recipients ("to", "channel", used instead of the top level ones of the same
+kind) and tag. Empty strings, as in the example config.json, mean not set,
+and entries with none of pid, command and regex are skipped.
+
+ConfigWatcher reports changes to the files with inotify. Specs are compared
+by name to the ones loaded before, so only the watches of added, removed or
+changed specs are touched.
+"""
+
+from dataclasses import dataclass, field
+import fnmatch
+import json
+import os
+import re
+
+from . import _scoped_regex
+from .inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO
+
+SPEC_KEYS = {'name', 'pid', 'command', 'regex', 'interval', 'to', 'channel', 'tag'}
+TOP_LEVEL_KEYS = {'to', 'channel', 'alerts', 'processes'}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class WatchSpec:
+    """A watch from a config file. Equal specs are unchanged by a reload."""
+    name: str
+    pids: tuple = ()
+    command: str = ''
+    regex: str = ''
+    interval: float = None
+    to: tuple = ()
+    channel: tuple = ()
+    tag: str = None
+    # Command wildcard and regex as one full match regex, '' if neither
+    pattern: str = field(default='', compare=False)
+    _re: object = field(default=None, compare=False, repr=False)
+
+    @classmethod
+    def from_dict(cls, data):
+        """:raises ConfigError if an entry is invalid"""
+        if not isinstance(data, dict):
+            raise ConfigError('Expected an object for each process, got {!r}'.format(data))
+        unknown = set(data) - SPEC_KEYS
+        if unknown:
+            raise ConfigError('Unknown keys {} in process {!r}, expected some of: {}'.format(
+                ', '.join(sorted(unknown)), data, ', '.join(sorted(SPEC_KEYS))))
+
+        command = data.get('command') or ''
+        regex = data.get('regex') or ''
+        pids = _pids(data.get('pid'))
+        if not (command or regex or pids):
+            raise ConfigError('Process {!r} has no pid, command or regex'.format(data))
+        name = data.get('name') or command or regex or str(pids[0])
+
+        patterns = []
+        if regex:
+            try:
+                re.compile(regex)
+            except re.error as err:
+                raise ConfigError('Invalid regex {!r} of process {!r}: {}'.format(regex, name, err))
+            # First, so group references in it keep their numbers
+            patterns.append(_scoped_regex(regex if regex.endswith('$') else regex + '$'))
+        if command:
+            patterns.append(fnmatch.translate(command))
+        pattern = '|'.join(patterns)
+
+        interval = data.get('interval') or None
+        if interval is not None:
+            try:
+                interval = float(interval)
+            except (TypeError, ValueError):
+                raise ConfigError('Invalid interval {!r} of process {!r}'.format(interval, name))
+            if interval <= 0:
+                raise ConfigError('Interval of process {!r} must be positive'.format(name))
+
+        return cls(name=name, pids=pids, command=command, regex=regex, interval=interval,
+                   to=_strings(data.get('to')), channel=_strings(data.get('channel')), tag=data.get('tag') or None,
+                   pattern=pattern, _re=re.compile(pattern) if pattern else None)
+
+    def matches(self, comm):
+        """:return whether a process with this command name matches the command or regex"""
+        return self._re is not None and self._re.match(comm) is not None
+
+
+def _pids(value):
+    if value in (None, ''):
+        return ()
+    values = value if isinstance(value, list) else [value]
+    try:
+        return tuple(int(pid) for pid in values if pid != '')
+    except (TypeError, ValueError):
+        raise ConfigError('Invalid pid {!r}'.format(value))
+
+
+def _strings(value):
+    """:return tuple of the non-empty strings of a string or list"""
+    if value in (None, ''):
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ConfigError('Expected a string or list of strings, got {!r}'.format(value))
+    return tuple(item for item in value if item)
+
+
+class Config:
+    """Everything read from the config files
+
+    :param paths: JSON file paths, processes with the same name in several of them are an error
+    :raises ConfigError if a file can't be read or is invalid
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.to = ()
+        self.channel = ()
+        self.alerts = ()
+        # name -> WatchSpec, in file order
+        self.specs = {}
+        for path in self.paths:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as err:
+                raise ConfigError('Failed to read config {}: {}'.format(path, err))
+            try:
+                self._add(data)
+            except ConfigError as err:
+                raise ConfigError('{}: {}'.format(path, err))
+
+    def _add(self, data):
+        if not isinstance(data, dict):
+            raise ConfigError('Expected an object at the top level')
+        unknown = set(data) - TOP_LEVEL_KEYS
+        if unknown:
+            raise ConfigError('Unknown keys {}, expected some of: {}'.format(
+                ', '.join(sorted(unknown)), ', '.join(sorted(TOP_LEVEL_KEYS))))
+        self.to += _strings(data.get('to'))
+        self.channel += _strings(data.get('channel'))
+        self.alerts += _strings(data.get('alerts'))
+        processes = data.get('processes', [])
+        if not isinstance(processes, list):
+            raise ConfigError('Expected a list of processes')
+        for entry in processes:
+            if isinstance(entry, dict) and all(entry.get(key) in (None, '') for key in ('pid', 'command', 'regex')):
+                # A blank template entry, like the first one in config.json
+                continue
+            spec = WatchSpec.from_dict(entry)
+            if spec.name in self.specs:
+                raise ConfigError('More than one process named {!r}'.format(spec.name))
+            self.specs[spec.name] = spec
+
+    def diff(self, old):
+        """Compare the specs to an older Config's
+        :return (added, removed, changed) lists of specs, changed ones being the new specs
+        """
+        added = [spec for name, spec in self.specs.items() if name not in old.specs]
+        removed = [spec for name, spec in old.specs.items() if name not in self.specs]
+        changed = [spec for name, spec in self.specs.items() if name in old.specs and old.specs[name] != spec]
+        return added, removed, changed
+
+
+class ConfigWatcher:
+    """Reports changes to config files using inotify.
+
+    The directories are watched rather than the files, so a file replaced by
+    renaming another onto it (as editors and config management tools do) is
+    seen as well. Raises OSError if inotify isn't available. Has fileno() so it
+    can be passed to select/selectors.
+    """
+
+    def __init__(self, paths):
+        self._inotify = Inotify()
+        # watch descriptor -> names of config files in the directory
+        self._names = {}
+        try:
+            for path in paths:
+                directory, name = os.path.split(os.path.abspath(path))
+                wd = self._inotify.add_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+                self._names.setdefault(wd, set()).add(name)
+        except OSError:
+            self._inotify.close()
+            raise
+
+    def fileno(self):
+        return self._inotify.fileno()
+
+    def changed(self):
+        """:return whether a config file was written or replaced since the last call, without blocking"""
+        return any(name in self._names.get(wd, ()) for wd, _, name in self._inotify.read_events())
+
+    def close(self):
+        self._inotify.close()
@@ -0,0 +1,204 @@
+"""Unix domain socket API to change what a running watcher watches.
+
+Clients send one JSON object per line and get one JSON object per line back:
+
+    {"command": "add_pattern", "wildcard": "myapp*"}
+    {"ok": true, "result": [1234, 1240]}
+
+    {"command": "stats", "pid": 99}
+    {"ok": false, "error": "PID 99 is not watched"}
+
+The commands are functions supplied by the watcher, called with the other
+members of the request as keyword arguments. Clients are served from the
+watcher's main loop (see register()), so commands need no locking.
+
+From a shell:
+    python -m process.control /run/process-watcher.sock list
+    python -m process.control /run/process-watcher.sock add_pid '{"pid": 1234}'
+"""
+
+import functools
+import inspect
+import json
+import logging
+import os
+import selectors
+import socket
+import stat
+import sys
+
+# Longest request line accepted, the client is disconnected past it
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class ControlError(Exception):
+    """A request that can't be carried out, reported to the client."""
+
+
+class ControlServer:
+    """Accepts control connections on a Unix socket.
+
+    :param path: socket path, a stale socket left there is replaced
+    :param commands: dict of command name -> function returning a JSON serializable result
+    :param mode: permissions of the socket file, which limit who can connect
+    :param timeout: seconds to wait for a slow client to take a response before dropping it
+    """
+
+    def __init__(self, path, commands, mode=0o660, timeout=1.0):
+        self.path = path
+        self.commands = commands
+        self.timeout = timeout
+        self._selector = None
+        # client socket -> bytearray of received data not yet handled
+        self._clients = {}
+
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.bind(path)
+            os.chmod(path, mode)
+            self._sock.listen(16)
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.setblocking(False)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def register(self, selector):
+        """Handle connections and requests when the selector reports them.
+        Registered data are handler functions, to call with no arguments."""
+        self._selector = selector
+        selector.register(self._sock, selectors.EVENT_READ, self._accept)
+
+    def _accept(self):
+        try:
+            client, _ = self._sock.accept()
+        except BlockingIOError:
+            return
+        client.settimeout(self.timeout)
+        self._clients[client] = bytearray()
+        self._selector.register(client, selectors.EVENT_READ, functools.partial(self._read, client))
+
+    def _read(self, client):
+        try:
+            data = client.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(client)
+            return
+
+        buffer = self._clients[client]
+        buffer += data
+        while True:
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if not line.strip():
+                continue
+            try:
+                client.sendall(json.dumps(self.handle(line)).encode() + b'\n')
+            except OSError:
+                # Gone or not reading its responses
+                self._disconnect(client)
+                return
+
+        if len(buffer) > MAX_REQUEST_SIZE:
+            self._disconnect(client)
+
+    def handle(self, line):
+        """Run one request
+        :param line: JSON request (bytes or str)
+        :return response dict
+        """
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or not isinstance(request.get('command'), str):
+                raise ControlError('Request must be an object with a "command" string')
+            arguments = dict(request)
+            name = arguments.pop('command')
+            function = self.commands.get(name)
+            if function is None:
+                raise ControlError('Unknown command {!r}, expected one of: {}'.format(
+                    name, ', '.join(sorted(self.commands))))
+            try:
+                inspect.signature(function).bind(**arguments)
+            except TypeError as err:
+                raise ControlError('{}: {}'.format(name, err))
+            return {'ok': True, 'result': function(**arguments)}
+
+        except (ControlError, ValueError) as err:
+            return {'ok': False, 'error': str(err)}
+        except Exception as err:
+            logging.exception('Exception encountered handling control request {!r}'.format(line))
+            return {'ok': False, 'error': '{}: {}'.format(type(err).__name__, err)}
+
+    def _disconnect(self, client):
+        self._clients.pop(client, None)
+        try:
+            self._selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        client.close()
+
+    def close(self):
+        for client in list(self._clients):
+            self._disconnect(client)
+        if self._selector is not None:
+            try:
+                self._selector.unregister(self._sock)
+            except (KeyError, ValueError):
+                pass
+        self._sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def request(path, command, timeout=5.0, **arguments):
+    """Send one request to a ControlServer.
+    :return the command's result
+    :raises ControlError if the server reported an error
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(arguments, command=command)).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ControlError('Connection closed without a response')
+
+    response = json.loads(line)
+    if not response['ok']:
+        raise ControlError(response['error'])
+    return response['result']
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (2, 3):
+        print('usage: python -m process.control SOCKET COMMAND [JSON_ARGUMENTS]', file=sys.stderr)
+        return 2
+    arguments = json.loads(argv[2]) if len(argv) == 3 else {}
+    try:
+        result = request(argv[0], argv[1], **arguments)
+    except ControlError as err:
+        print(err, file=sys.stderr)
+        return 1
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
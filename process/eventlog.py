@@ -0,0 +1,228 @@
+"""Structured event output: one JSON object per line, for log pipelines.
+
+Events have an "event" type and a "time" (seconds since epoch):
+
+    watch-start          a process started being watched, with its command
+    sample               statistics of a process after a check
+    exit                 a watched process ended, with its final statistics
+    alert                an alert rule fired or resolved (see process.alerts)
+    notification-sent    a notification was delivered, or "notification-failed"
+
+Lines are buffered and written once the buffer reaches buffer_size or, from a
+background thread, flush_interval seconds after the first buffered line.
+Sample events, which every tick emits for every checked process, are
+formatted with a fixed % template instead of building a dict for json.dumps.
+
+The output can be stdout ("-"), a file, rotated by size like
+logging.handlers.RotatingFileHandler, or a FIFO. Writes to a FIFO never
+block: lines are dropped while no reader has it open or while it's full.
+"""
+
+import errno
+import json
+import logging
+import os
+import stat
+import sys
+import threading
+import time
+
+SAMPLE_FORMAT = ('{"event":"sample","time":%.3f,"pid":%d,"start_time":%d,"rss":%d,"vsz":%d,'
+                 '"cpu_percent":%.2f,"user_seconds":%.2f,"system_seconds":%.2f,'
+                 '"read_rate":%.1f,"write_rate":%.1f}')
+
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def event_line(event, now=None, **fields):
+    """:return JSON text of an event, without a newline
+    :param event: type, e.g. 'exit'
+    :param now: time of the event, defaults to now
+    :param fields: JSON serializable values
+    """
+    return _encode({'event': event, 'time': time.time() if now is None else now, **fields})
+
+
+def sample_lines(processes, now):
+    """:return list of the JSON text of a sample event for each process, without newlines"""
+    return [SAMPLE_FORMAT % (now, p.pid, p.start_time, p.status['VmRSS'], p.status['VmSize'], p.cpu_percent,
+                             p.user_seconds, p.system_seconds, p.read_rate, p.write_rate)
+            for p in processes]
+
+
+class EventLog:
+    """Writes events as JSON lines
+
+    :param path: file or FIFO path, "-" for stdout
+    :param buffer_size: bytes buffered before writing
+    :param flush_interval: max seconds a line is buffered
+    :param max_bytes: rotate a file once it would grow past this, 0 never rotates
+    :param backups: rotated files kept, path.1 being the newest
+    :param max_pending: bytes a FIFO may have waiting for its reader before lines are dropped
+    :raises OSError if the file can't be opened
+    """
+
+    def __init__(self, path, buffer_size=65536, flush_interval=1.0, max_bytes=0, backups=5,
+                 max_pending=1048576):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_pending = max_pending
+
+        self._lines = []
+        self._buffered = 0
+        # Bytes accepted by write() but not yet written, only for a FIFO that's full
+        self._unwritten = b''
+        self._lock = threading.Lock()
+        self._fd = None
+        self._size = 0
+        self.fifo = False
+
+        # Statistics
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+        if path == '-':
+            self._fd = sys.stdout.fileno()
+        else:
+            try:
+                self.fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+            except FileNotFoundError:
+                pass
+            self._open()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, name='event-log-flush', daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        if self.fifo:
+            try:
+                # Without a reader this fails instead of blocking
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+            except OSError as err:
+                if err.errno != errno.ENXIO:
+                    raise
+            return
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        self._size = os.fstat(self._fd).st_size
+
+    def emit(self, event, now=None, **fields):
+        """Add an event, see event_line()"""
+        self._add([event_line(event, now, **fields)])
+
+    def samples(self, processes, now):
+        """Add a sample event for each process, e.g. all the processes just checked"""
+        self._add(sample_lines(processes, now))
+
+    def _add(self, lines):
+        if not lines:
+            return
+        # With their newlines
+        size = sum(map(len, lines)) + len(lines)
+        with self._lock:
+            if self.fifo and len(self._unwritten) + self._buffered > self.max_pending:
+                # Reader isn't keeping up (or there's none)
+                self.dropped += len(lines)
+                return
+            first = not self._lines
+            self._lines += lines
+            self._buffered += size
+            if self._buffered >= self.buffer_size:
+                self._flush()
+                return
+        if first:
+            # Start the flush interval
+            self._wake.set()
+
+    def flush(self):
+        """Write buffered lines"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """Call with _lock held"""
+        lines = self._lines
+        if not lines and not self._unwritten:
+            return
+        count = len(lines)
+        # JSON is ASCII, and so are the numbers in the sample template
+        data = self._unwritten + ''.join(line + '\n' for line in lines).encode('ascii')
+        self._lines = []
+        self._buffered = 0
+        self._unwritten = b''
+
+        if self._fd is None and self.fifo and not self._stop.is_set():
+            # No reader had the FIFO open yet
+            self._open()
+        if self._fd is None:
+            self.dropped += count
+            return
+
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes and not self.fifo \
+                and self.path != '-':
+            self._rotate()
+
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(self._fd, data[written:])
+        except BlockingIOError:
+            # FIFO full, keep the rest (which may start mid line) for later
+            self._unwritten = data[written:]
+        except BrokenPipeError:
+            # Reader went away, lines not written are lost
+            self.dropped += data.count(b'\n', written)
+            os.close(self._fd)
+            self._fd = None
+            return
+        except OSError as err:
+            self.dropped += count
+            logging.error('Failed writing events to {}: {}'.format(self.path, err))
+            return
+        self._size += written
+        self.written += count
+
+    def _rotate(self):
+        """Call with _lock held: path -> path.1 -> path.2 ... dropping the oldest"""
+        os.close(self._fd)
+        for i in range(self.backups - 1, 0, -1):
+            source = '{}.{}'.format(self.path, i)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.truncate(self.path, 0)
+        self._open()
+        self.rotations += 1
+
+    def _flush_periodically(self):
+        while True:
+            # Wait for a line, then for the interval to pass
+            self._wake.wait()
+            self._wake.clear()
+            if self._stop.wait(self.flush_interval):
+                return
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'written': self.written, 'dropped': self.dropped,
+                    'rotations': self.rotations, 'buffered': len(self._lines)}
+
+    def close(self):
+        """Write what's buffered and close the file"""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        with self._lock:
+            self._flush()
+            if self._fd is not None and self.path != '-':
+                os.close(self._fd)
+            self._fd = None
+
@@ -0,0 +1,531 @@
+"""Agents on each host streaming events to one collector, which notifies for all of them.
+
+An agent is a watcher started with --agent ADDRESS: it sends the events of
+process.eventlog (watch-start, sample, exit, alert) to the collector, so it
+doesn't need email or Slack credentials itself. The collector (--collect
+ADDRESS) notifies about the exits and alerts of every agent through its own
+channels and keeps the latest sample of each process of each host.
+
+Protocol, JSON lines over TCP or a Unix socket:
+
+    agent:      {"hello": "web-1"}
+    agent:      {"batch": 1, "events": [{"event": "exit", ...}, ...]}
+    collector:  {"ack": 1}
+
+Events are sent in batches from a background thread, each batch waiting for
+its acknowledgement. While the collector can't be reached, events are kept
+in a spool file (or in memory without one) and sent once it's back. A batch
+whose acknowledgement was lost is sent again, so the collector drops events
+it has seen already, identified by host, type, PID, start time and time.
+"""
+
+from collections import OrderedDict, deque
+from datetime import datetime
+import functools
+import json
+import logging
+import os
+import selectors
+import socket
+import stat
+import threading
+import time
+
+from . import ProcessByPID
+from .eventlog import event_line, sample_lines
+from .metrics import parse_address
+
+# Longest line accepted from an agent, it is disconnected past it
+MAX_LINE_SIZE = 64 * 1024 * 1024
+
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+
+
+class Agent:
+    """Sends events to a collector in batches from a background thread.
+
+    Has the emit() and samples() of process.eventlog.EventLog.
+
+    :param address: collector's Unix socket path or [HOST:]PORT
+    :param host: name of this host for the collector, defaults to the hostname
+    :param spool: file to keep events in while the collector can't be reached, None keeps them in memory
+    :param batch_size: most events per batch
+    :param flush_interval: seconds between sends
+    :param timeout: seconds to wait for the collector to connect or acknowledge
+    :param max_buffered: most events kept in memory, older ones are dropped
+    :param max_spool_bytes: largest spool file, newer events are dropped
+    :param max_retry_interval: longest wait between connection attempts (seconds), doubled from flush_interval
+    """
+
+    def __init__(self, address, host=None, spool=None, batch_size=1000, flush_interval=1.0, timeout=5.0,
+                 max_buffered=100000, max_spool_bytes=100 * 1024 * 1024, max_retry_interval=60.0):
+        self.family, self.address = parse_address(address)
+        self.host = host or socket.gethostname()
+        self.spool = spool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.max_buffered = max_buffered
+        self.max_spool_bytes = max_spool_bytes
+        self.max_retry_interval = max_retry_interval
+
+        # Events not handed to the sending thread yet, JSON text
+        self._lines = []
+        # Events that couldn't be sent, when there's no spool file
+        self._backlog = deque()
+        self._spool_size = os.path.getsize(spool) if spool and os.path.exists(spool) else 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+        self._sock = None
+        self._reader = None
+        self._seq = 0
+        self._retry_at = 0.0
+        self._retry_interval = flush_interval
+
+        # Statistics
+        self.sent = 0
+        self.dropped = 0
+        self.connects = 0
+
+        self._thread = threading.Thread(target=self._run, name='agent-sender', daemon=True)
+        self._thread.start()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def emit(self, event, now=None, **fields):
+        """Queue an event, see process.eventlog.event_line()"""
+        self._add([event_line(event, now, **fields)])
+
+    def samples(self, processes, now):
+        """Queue a sample event for each process"""
+        self._add(sample_lines(processes, now))
+
+    def _add(self, lines):
+        with self._lock:
+            room = self.max_buffered - len(self._lines)
+            if len(lines) > room:
+                # Sending thread stuck, e.g. waiting for the collector
+                self.dropped += len(lines) - max(room, 0)
+                lines = lines[:max(room, 0)]
+            self._lines += lines
+            full = len(self._lines) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._send_pending()
+        # Last try, without waiting for the retry interval
+        self._retry_at = 0.0
+        self._send_pending()
+        self._disconnect()
+
+    def _send_pending(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if not self._connect():
+            self._keep(lines)
+            return
+
+        start = 0
+        try:
+            self._send_backlog()
+            self._send_spool()
+            for start in range(0, len(lines), self.batch_size):
+                self._send_batch(lines[start:start + self.batch_size])
+        except (OSError, ValueError) as err:
+            logging.warning('Lost connection to collector {}: {}'.format(self.address, err))
+            self._disconnect()
+            self._keep(lines[start:])
+
+    def _connect(self):
+        """:return True if connected"""
+        if self._sock is not None:
+            return True
+        now = time.monotonic()
+        if now < self._retry_at:
+            return False
+
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+            sock.sendall(_encode({'hello': self.host}).encode() + b'\n')
+        except OSError as err:
+            sock.close()
+            if self._retry_interval == self.flush_interval:
+                logging.warning('Failed to connect to collector {}: {}'.format(self.address, err))
+            self._retry_at = now + self._retry_interval
+            self._retry_interval = min(self._retry_interval * 2, self.max_retry_interval)
+            return False
+
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+        self._retry_interval = self.flush_interval
+        self.connects += 1
+        logging.info('Connected to collector {}'.format(self.address))
+        return True
+
+    def _disconnect(self):
+        if self._sock is None:
+            return
+        self._reader.close()
+        self._sock.close()
+        self._sock = self._reader = None
+        self._retry_at = time.monotonic() + self._retry_interval
+
+    def _send_batch(self, lines):
+        """Send events and wait for the collector to acknowledge them
+        :raises OSError or ValueError if they may not have been received
+        """
+        if not lines:
+            return
+        self._seq += 1
+        self._sock.sendall(('{"batch":%d,"events":[%s]}\n' % (self._seq, ','.join(lines))).encode())
+        reply = self._reader.readline()
+        if not reply:
+            raise ConnectionError('Connection closed by collector')
+        if json.loads(reply).get('ack') != self._seq:
+            raise ValueError('Unexpected reply from collector: {!r}'.format(reply[:100]))
+        self.sent += len(lines)
+
+    def _keep(self, lines):
+        """Keep events that couldn't be sent, to send them once connected"""
+        if not lines:
+            return
+        if self.spool is None:
+            backlog = self._backlog
+            backlog.extend(lines)
+            excess = len(backlog) - self.max_buffered
+            if excess > 0:
+                self.dropped += excess
+                for _ in range(excess):
+                    backlog.popleft()
+            return
+
+        data = ''.join(line + '\n' for line in lines).encode()
+        if self._spool_size + len(data) > self.max_spool_bytes:
+            self.dropped += len(lines)
+            return
+        try:
+            with open(self.spool, 'ab') as f:
+                f.write(data)
+            self._spool_size += len(data)
+        except OSError as err:
+            self.dropped += len(lines)
+            logging.error('Failed to spool events to {}: {}'.format(self.spool, err))
+
+    def _send_backlog(self):
+        backlog = self._backlog
+        while backlog:
+            batch = [backlog.popleft() for _ in range(min(len(backlog), self.batch_size))]
+            try:
+                self._send_batch(batch)
+            except Exception:
+                backlog.extendleft(reversed(batch))
+                raise
+
+    def _send_spool(self):
+        if not self._spool_size:
+            return
+        with open(self.spool, 'rb') as f:
+            offset = 0
+            while True:
+                batch = []
+                for line in f:
+                    batch.append(line.rstrip(b'\n').decode())
+                    if len(batch) >= self.batch_size:
+                        break
+                if not batch:
+                    break
+                try:
+                    self._send_batch(batch)
+                except Exception:
+                    # Keep the part not acknowledged
+                    f.seek(offset)
+                    remainder = f.read()
+                    with open(self.spool + '.tmp', 'wb') as tmp:
+                        tmp.write(remainder)
+                    os.replace(self.spool + '.tmp', self.spool)
+                    self._spool_size = len(remainder)
+                    raise
+                offset = f.tell()
+        os.truncate(self.spool, 0)
+        self._spool_size = 0
+
+    @property
+    def buffered(self):
+        """Events not sent yet"""
+        with self._lock:
+            waiting = len(self._lines)
+        return waiting + len(self._backlog)
+
+    def stats(self):
+        return {'collector': str(self.address), 'host': self.host, 'connected': self.connected, 'sent': self.sent,
+                'dropped': self.dropped, 'buffered': self.buffered, 'spool_bytes': self._spool_size,
+                'connects': self.connects}
+
+    def close(self, timeout=None):
+        """Send what's queued (or spool it) and stop
+        :param timeout: max seconds to wait, None waits until sent or given up on
+        """
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+
+class Collector:
+    """Receives events from agents. Served from the watcher's main loop.
+
+    :param address: Unix socket path or [HOST:]PORT to listen on
+    :param on_event: called as on_event(host, event dict) for each event except samples, once
+    :param timeout: seconds to wait for a slow agent to take an acknowledgement
+    :param dedupe_size: events remembered to drop ones sent again
+    """
+
+    def __init__(self, address, on_event=None, timeout=5.0, dedupe_size=100000):
+        self.on_event = on_event
+        self.timeout = timeout
+        self.dedupe_size = dedupe_size
+        self._selector = None
+        # agent socket -> [bytearray of data not handled yet, host or None before hello]
+        self._clients = {}
+        # host -> {'connections': open connections, 'last_seen': time,
+        #          'processes': PID -> latest watch-start/sample fields}
+        self.hosts = {}
+        # Recent event identities -> None, oldest first
+        self._seen = OrderedDict()
+
+        # Statistics
+        self.batches = 0
+        self.events = 0
+        self.duplicates = 0
+
+        family, self.address = parse_address(address)
+        if family == socket.AF_UNIX:
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except FileNotFoundError:
+                pass
+
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family != socket.AF_UNIX:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(self.address)
+            self._sock.listen(64)
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.setblocking(False)
+        if family != socket.AF_UNIX:
+            # Port 0 picks a free port
+            self.address = self._sock.getsockname()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def register(self, selector):
+        """Handle connections and events when the selector reports them.
+        Registered data are handler functions, to call with no arguments."""
+        self._selector = selector
+        selector.register(self._sock, selectors.EVENT_READ, self._accept)
+
+    def _accept(self):
+        try:
+            client, _ = self._sock.accept()
+        except BlockingIOError:
+            return
+        client.settimeout(self.timeout)
+        self._clients[client] = [bytearray(), None]
+        self._selector.register(client, selectors.EVENT_READ, functools.partial(self._read, client))
+
+    def _read(self, client):
+        try:
+            data = client.recv(1024 * 1024)
+        except OSError:
+            data = b''
+        if not data:
+            self._disconnect(client)
+            return
+
+        state = self._clients[client]
+        buffer = state[0]
+        buffer += data
+        while True:
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = bytes(buffer[:end])
+            del buffer[:end + 1]
+            try:
+                reply = self._handle_line(state, line)
+                if reply is not None:
+                    client.sendall(reply)
+            except (ValueError, KeyError, TypeError, AttributeError) as err:
+                logging.warning('Bad message from agent {}: {}'.format(state[1], err))
+                self._disconnect(client)
+                return
+            except OSError:
+                self._disconnect(client)
+                return
+
+        if len(buffer) > MAX_LINE_SIZE:
+            self._disconnect(client)
+
+    def _handle_line(self, state, line):
+        """:return reply bytes or None"""
+        if not line.strip():
+            return None
+        message = json.loads(line)
+        if 'hello' in message:
+            host = state[1] = str(message['hello'])
+            view = self._host(host)
+            view['connections'] += 1
+            view['last_seen'] = time.time()
+            return None
+
+        host = state[1]
+        if host is None:
+            raise ValueError('batch before hello')
+        events = message['events']
+        view = self.hosts[host]
+        view['last_seen'] = time.time()
+        for event in events:
+            self.handle_event(host, event)
+        self.batches += 1
+        return _encode({'ack': message['batch']}).encode() + b'\n'
+
+    def _host(self, host):
+        view = self.hosts.get(host)
+        if view is None:
+            view = self.hosts[host] = {'connections': 0, 'last_seen': None, 'processes': {}}
+        return view
+
+    def handle_event(self, host, event):
+        """Record an event from an agent and pass it on unless it was seen before"""
+        self.events += 1
+        processes = self._host(host)['processes']
+        kind = event['event']
+        pid = event.get('pid')
+        if kind == 'sample':
+            # Samples only update the view, a replayed older one is ignored
+            current = processes.get(pid)
+            if current is None or current.get('start_time') != event.get('start_time'):
+                if current is None or current.get('time', 0) <= event['time']:
+                    processes[pid] = dict(event)
+            elif current.get('time', 0) <= event['time']:
+                current.update(event)
+            return
+
+        key = (host, kind, pid, event.get('start_time'), event['time'])
+        seen = self._seen
+        if key in seen:
+            self.duplicates += 1
+            return
+        seen[key] = None
+        if len(seen) > self.dedupe_size:
+            seen.popitem(last=False)
+
+        if kind == 'watch-start':
+            processes[pid] = dict(event)
+        elif kind == 'exit':
+            current = processes.get(pid)
+            if current is not None and current.get('start_time') == event.get('start_time'):
+                del processes[pid]
+
+        if self.on_event is not None:
+            self.on_event(host, event)
+
+    def fleet(self):
+        """:return JSON serializable view of every host and its watched processes"""
+        return {host: {'connected': view['connections'] > 0, 'last_seen': view['last_seen'],
+                       'processes': list(view['processes'].values())}
+                for host, view in self.hosts.items()}
+
+    def stats(self):
+        return {'hosts': len(self.hosts),
+                'connected': sum(1 for view in self.hosts.values() if view['connections']),
+                'batches': self.batches, 'events': self.events, 'duplicates': self.duplicates}
+
+    def _disconnect(self, client):
+        state = self._clients.pop(client, None)
+        if state is not None and state[1] is not None:
+            self.hosts[state[1]]['connections'] -= 1
+        try:
+            self._selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        client.close()
+
+    def close(self):
+        for client in list(self._clients):
+            self._disconnect(client)
+        if self._selector is not None:
+            try:
+                self._selector.unregister(self._sock)
+            except (KeyError, ValueError):
+                pass
+        family = self._sock.family
+        self._sock.close()
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+
+
+class RemoteProcess(ProcessByPID):
+    """An ended process reported by an agent, rebuilt from its exit event.
+
+    tag is the host, so digests group by host as well as executable.
+    """
+
+    __slots__ = ('host', 'headline')
+
+    @classmethod
+    def from_event(cls, host, event):
+        self = cls.from_dict(event)
+        self.host = self.tag = host
+        self.headline = 'Process has stopped on {}.'.format(host)
+        ended = event.get('ended')
+        self.mark_ended(event.get('exit_code'), datetime.fromtimestamp(ended) if ended else None)
+        return self
+
+    def info(self):
+        return 'Host: {}\n'.format(self.host) + super().info()
+
+    def as_dict(self):
+        return dict(super().as_dict(), host=self.host)
+
+
+class RemoteAlert:
+    """An alert fired or resolved on an agent, rebuilt from its alert event.
+
+    Has the attributes of process.alerts.Alert that notifying about it uses.
+    """
+
+    def __init__(self, host, event):
+        self.host = self.tag = host
+        self.pid = event['pid']
+        self.start_time = event.get('start_time')
+        self.command = event.get('command', '')
+        self.executable = event.get('executable', '')
+        self.text = event['rule']
+        self.value = event['value']
+        self.value_text = event.get('value_text', str(self.value))
+        self.resolved = event.get('resolved', False)
+        self.datetime = datetime.fromtimestamp(event['time'])
+        self.headline = 'Alert {}on {}: {}'.format('resolved ' if self.resolved else '', host, self.text)
+
+    def info(self):
+        return 'Host: {}\nAlert {}: {}\n {}: {:%a, %b %d %H:%M:%S}\nPID {}: {}'.format(
+            self.host, self.text, self.value_text, 'Resolved' if self.resolved else 'Fired', self.datetime,
+            self.pid, self.command)
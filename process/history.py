@@ -0,0 +1,120 @@
+"""Fixed size history of memory and CPU samples for a process."""
+
+from array import array
+import os
+
+# Clock ticks per second, unit of CPU times in /proc/PID/stat
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+class SampleHistory:
+    """Ring buffer of (timestamp, RSS, VSZ, CPU ticks) samples.
+
+    Each column is an array so memory per process is fixed (about 32 bytes per
+    sample) and append is O(1). Once full, the oldest sample is overwritten.
+    Summary statistics are computed on demand, e.g. when formatting info().
+    """
+
+    __slots__ = ('size', 'count', 'times', 'rss', 'vsz', 'cpu')
+
+    def __init__(self, size=120):
+        self.size = size
+        # Total samples ever appended
+        self.count = 0
+        self.times = array('d', bytes(8 * size))
+        self.rss = array('q', bytes(8 * size))
+        self.vsz = array('q', bytes(8 * size))
+        self.cpu = array('q', bytes(8 * size))
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, rss, vsz, cpu_ticks):
+        """Add a sample
+        :param timestamp: seconds since epoch
+        :param rss: resident set size in kB
+        :param vsz: virtual memory size in kB
+        :param cpu_ticks: user + system CPU time in clock ticks
+        """
+        i = self.count % self.size
+        self.times[i] = timestamp
+        self.rss[i] = rss
+        self.vsz[i] = vsz
+        self.cpu[i] = cpu_ticks
+        self.count += 1
+
+    def _ordered(self, column):
+        """Values of column from oldest to newest"""
+        if self.count <= self.size:
+            return column[:self.count]
+        i = self.count % self.size
+        return column[i:] + column[:i]
+
+    def index_at(self, timestamp):
+        """:return index into the columns of the latest sample taken at or before timestamp,
+        the oldest sample if all are newer, None if there are no samples"""
+        n = len(self)
+        if not n:
+            return None
+        size = self.size
+        start = self.count - n
+        times = self.times
+        # Binary search over the samples in time order
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(start + mid) % size] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return (start + max(lo - 1, 0)) % size
+
+    @property
+    def samples(self):
+        return len(self)
+
+    @property
+    def rss_mean(self):
+        """Mean resident set size (kB)"""
+        n = len(self)
+        return sum(self._ordered(self.rss)) / n if n else 0.0
+
+    @property
+    def rss_p95(self):
+        """95th percentile of resident set size (kB)"""
+        n = len(self)
+        if not n:
+            return 0
+        values = sorted(self._ordered(self.rss))
+        return values[min(n - 1, int(0.95 * n))]
+
+    @property
+    def rss_growth(self):
+        """Resident set size growth rate (kB per minute), least squares slope over the samples"""
+        n = len(self)
+        if n < 2:
+            return 0.0
+        times = self._ordered(self.times)
+        rss = self._ordered(self.rss)
+        t0 = times[0]
+        t_mean = sum(times) / n - t0
+        rss_mean = sum(rss) / n
+        covariance = variance = 0.0
+        for t, value in zip(times, rss):
+            dt = t - t0 - t_mean
+            covariance += dt * (value - rss_mean)
+            variance += dt * dt
+        return covariance / variance * 60 if variance else 0.0
+
+    @property
+    def cpu_percent(self):
+        """Mean CPU utilisation over the samples (100 = one core)"""
+        n = len(self)
+        if n < 2:
+            return 0.0
+        last = (self.count - 1) % self.size
+        first = (self.count - n) % self.size
+        elapsed = self.times[last] - self.times[first]
+        if elapsed <= 0:
+            return 0.0
+        return (self.cpu[last] - self.cpu[first]) / CLOCK_TICKS / elapsed * 100
@@ -0,0 +1,98 @@
+"""Minimal inotify binding using ctypes, since the standard library has none.
+
+Used to be told when cgroup.events files change (process.cgroup) instead of
+polling them.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+# Sent when a watch is removed, explicitly or because the file was deleted
+IN_IGNORED = 0x00008000
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify:
+    """An inotify instance. Non-blocking, has fileno() so it can be passed to select/selectors.
+
+    Raises OSError if inotify isn't available.
+    """
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = _check(self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """:return watch descriptor"""
+        return _check(self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask))
+
+    def rm_watch(self, wd):
+        try:
+            _check(self._libc.inotify_rm_watch(self._fd, wd))
+        except OSError as err:
+            # Already removed, e.g. the file was deleted
+            if err.errno != errno.EINVAL:
+                raise
+
+    def read_events(self):
+        """:return list of (watch descriptor, mask, name) of the pending events, without blocking"""
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return events
+            events.extend(parse_events(data))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def parse_events(data):
+    """:return list of (watch descriptor, mask, name) from inotify read() data"""
+    events = []
+    offset = 0
+    while offset + _EVENT.size <= len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset + length].rstrip(b'\0').decode(errors='surrogateescape')
+        offset += length
+        events.append((wd, mask, name))
+    return events
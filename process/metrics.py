@@ -0,0 +1,321 @@
+"""OpenMetrics (Prometheus) exporter for watched processes and the watcher itself.
+
+Served over HTTP on a TCP port or a Unix socket from the watcher's main loop
+(see MetricsServer.register()), so rendering needs no locking.
+
+Per process samples are formatted once per check of the process and reused
+by later scrapes until the process is sampled again.
+"""
+
+import bisect
+import functools
+import logging
+import os
+import selectors
+import socket
+import stat
+import time
+
+from . import counters
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Longest HTTP request header accepted
+MAX_REQUEST_SIZE = 8192
+
+# Per process metric families: (name, type, function of ProcessByPID giving the value)
+# Counter sample names get the _total suffix.
+PROCESS_FAMILIES = (
+    ('process_watcher_process_resident_memory_bytes', 'gauge', lambda p: p.status['VmRSS'] * 1024),
+    ('process_watcher_process_resident_memory_peak_bytes', 'gauge', lambda p: p.status['VmHWM'] * 1024),
+    ('process_watcher_process_virtual_memory_bytes', 'gauge', lambda p: p.status['VmSize'] * 1024),
+    ('process_watcher_process_virtual_memory_peak_bytes', 'gauge', lambda p: p.status['VmPeak'] * 1024),
+    ('process_watcher_process_cpu_seconds', 'counter', lambda p: p.user_seconds + p.system_seconds),
+    ('process_watcher_process_read_bytes', 'counter', lambda p: p.io['read_bytes']),
+    ('process_watcher_process_written_bytes', 'counter', lambda p: p.io['write_bytes']),
+    ('process_watcher_process_context_switches', 'counter',
+     lambda p: p.status['voluntary_ctxt_switches'] + p.status['nonvoluntary_ctxt_switches']),
+    ('process_watcher_process_start_time_seconds', 'gauge', lambda p: p.created),
+)
+
+# Seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    # repr gives the shortest exact form of floats
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative histogram of observed values"""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        # Count of values in each bucket (not cumulative), last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, help_text):
+        lines = ['# TYPE {} histogram\n'.format(name), '# HELP {} {}\n'.format(name, help_text)]
+        total = 0
+        for bound, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append('{}_bucket{{le="{}"}} {}\n'.format(name, le, total))
+        lines.append('{}_count {}\n'.format(name, self.count))
+        lines.append('{}_sum {}\n'.format(name, repr(self.sum)))
+        return lines
+
+
+class Metrics:
+    """Collects the watcher's own timings and renders all metrics.
+
+    :param processes: dict of PID -> ProcessByPID being watched
+    :param dispatcher: communicate.dispatch.Dispatcher for notification statistics, optional
+    """
+
+    def __init__(self, processes, dispatcher=None):
+        self.processes = processes
+        self.dispatcher = dispatcher
+        self.tick_seconds = Histogram()
+        self.check_seconds = Histogram()
+        self.scan_seconds = Histogram()
+        self.tick_files_opened = 0
+        # (executable, exit code or '') -> number of processes that ended
+        self.exits = {}
+        # PID -> (sample time, process, lines of each PROCESS_FAMILIES)
+        self._rendered = {}
+        self._tick_start = None
+        self._tick_files_start = 0
+
+    def start_tick(self):
+        self._tick_start = time.perf_counter()
+        self._tick_files_start = counters['files_opened']
+
+    def end_tick(self):
+        if self._tick_start is None:
+            return
+        self.tick_seconds.observe(time.perf_counter() - self._tick_start)
+        self.tick_files_opened = counters['files_opened'] - self._tick_files_start
+        self._tick_start = None
+
+    def process_ended(self, process):
+        key = (process.executable, '' if process.exit_code is None else str(process.exit_code))
+        self.exits[key] = self.exits.get(key, 0) + 1
+
+    def _process_lines(self, process):
+        """:return lines of each PROCESS_FAMILIES for the process, formatted again only if it was sampled since"""
+        rendered = self._rendered.get(process.pid)
+        sample_time = process.sample_time
+        if rendered is not None and rendered[0] == sample_time and rendered[1] is process:
+            return rendered[2]
+
+        labels = 'pid="{}",executable="{}"'.format(process.pid, _label_value(process.executable))
+        lines = []
+        for name, kind, value in PROCESS_FAMILIES:
+            suffix = '_total' if kind == 'counter' else ''
+            lines.append('{}{}{{{}}} {}\n'.format(name, suffix, labels, _number(value(process))))
+        self._rendered[process.pid] = (sample_time, process, lines)
+        return lines
+
+    def render(self):
+        """:return metrics in OpenMetrics text format (str)"""
+        processes = self.processes
+        # Drop processes no longer watched
+        for pid in [pid for pid in self._rendered if pid not in processes]:
+            del self._rendered[pid]
+        per_process = [self._process_lines(process) for process in processes.values()]
+
+        out = []
+        for i, (name, kind, _) in enumerate(PROCESS_FAMILIES):
+            out.append('# TYPE {} {}\n'.format(name, kind))
+            out.extend(lines[i] for lines in per_process)
+
+        out.append('# TYPE process_watcher_watched_processes gauge\n')
+        out.append('process_watcher_watched_processes {}\n'.format(len(processes)))
+
+        out.append('# TYPE process_watcher_exits counter\n')
+        out.append('# HELP process_watcher_exits Watched processes that ended, '
+                   'exit_code is negative for a signal and empty if unknown\n')
+        for (executable, exit_code), n in sorted(self.exits.items()):
+            out.append('process_watcher_exits_total{{executable="{}",exit_code="{}"}} {}\n'.format(
+                _label_value(executable), exit_code, n))
+
+        out.extend(self.tick_seconds.lines('process_watcher_tick_seconds',
+                                           'Time spent handling each main loop wakeup'))
+        out.extend(self.check_seconds.lines('process_watcher_check_seconds',
+                                            'Time spent checking and sampling due processes'))
+        out.extend(self.scan_seconds.lines('process_watcher_scan_seconds',
+                                           'Time spent finding new matching processes in /proc'))
+
+        out.append('# TYPE process_watcher_tick_files_opened gauge\n')
+        out.append('process_watcher_tick_files_opened {}\n'.format(self.tick_files_opened))
+        for name in ('files_opened', 'matcher_checks', 'matcher_cache_hits', 'matcher_hits'):
+            out.append('# TYPE process_watcher_{} counter\n'.format(name))
+            out.append('process_watcher_{}_total {}\n'.format(name, counters[name]))
+
+        times = os.times()
+        out.append('# TYPE process_watcher_cpu_seconds counter\n')
+        out.append('process_watcher_cpu_seconds_total{{mode="user"}} {}\n'.format(repr(times.user)))
+        out.append('process_watcher_cpu_seconds_total{{mode="system"}} {}\n'.format(repr(times.system)))
+
+        if self.dispatcher is not None:
+            out.extend(self._notification_lines(self.dispatcher.stats()))
+
+        out.append('# EOF\n')
+        return ''.join(out)
+
+    @staticmethod
+    def _notification_lines(channel_stats):
+        labels = ['channel="{}"'.format(_label_value(stats['channel'])) for stats in channel_stats]
+        out = ['# TYPE process_watcher_notification_latency_seconds summary\n']
+        for label, stats in zip(labels, channel_stats):
+            out.append('process_watcher_notification_latency_seconds_count{{{}}} {}\n'.format(label, stats['sent']))
+            out.append('process_watcher_notification_latency_seconds_sum{{{}}} {}\n'.format(
+                label, repr(stats['latency_total'])))
+        out.append('# TYPE process_watcher_notification_queue_depth gauge\n')
+        for label, stats in zip(labels, channel_stats):
+            out.append('process_watcher_notification_queue_depth{{{}}} {}\n'.format(label, stats['queue_depth']))
+        for name in ('failed', 'dropped', 'retried', 'rate_limited'):
+            out.append('# TYPE process_watcher_notifications_{} counter\n'.format(name))
+            for label, stats in zip(labels, channel_stats):
+                out.append('process_watcher_notifications_{}_total{{{}}} {}\n'.format(name, label, stats[name]))
+        return out
+
+
+def parse_address(address):
+    """:return (socket family, address) from a Unix socket path or [HOST:]PORT (host defaults to localhost)"""
+    if '/' in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, (host.strip('[]') or '127.0.0.1', int(port))
+
+
+class MetricsServer:
+    """Minimal HTTP server answering GET requests with Metrics.render().
+
+    :param address: Unix socket path or [HOST:]PORT
+    :param metrics: Metrics
+    :param timeout: seconds to wait for a slow client before dropping it
+    """
+
+    def __init__(self, address, metrics, timeout=5.0):
+        self.metrics = metrics
+        self.timeout = timeout
+        self._selector = None
+        # client socket -> bytearray of the request received so far
+        self._clients = {}
+
+        family, self.address = parse_address(address)
+        if family == socket.AF_UNIX:
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except FileNotFoundError:
+                pass
+
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family != socket.AF_UNIX:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(self.address)
+            self._sock.listen(16)
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.setblocking(False)
+        if family != socket.AF_UNIX:
+            # Port 0 picks a free port
+            self.address = self._sock.getsockname()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def register(self, selector):
+        """Handle connections and requests when the selector reports them.
+        Registered data are handler functions, to call with no arguments."""
+        self._selector = selector
+        selector.register(self._sock, selectors.EVENT_READ, self._accept)
+
+    def _accept(self):
+        try:
+            client, _ = self._sock.accept()
+        except BlockingIOError:
+            return
+        client.settimeout(self.timeout)
+        self._clients[client] = bytearray()
+        self._selector.register(client, selectors.EVENT_READ, functools.partial(self._read, client))
+
+    def _read(self, client):
+        try:
+            data = client.recv(4096)
+        except OSError:
+            data = b''
+        buffer = self._clients[client]
+        buffer += data
+        if data and b'\r\n\r\n' not in buffer and len(buffer) <= MAX_REQUEST_SIZE:
+            # Wait for the rest of the header
+            return
+
+        try:
+            if data and len(buffer) <= MAX_REQUEST_SIZE:
+                client.sendall(self.respond(bytes(buffer)))
+        except OSError:
+            pass
+        self._disconnect(client)
+
+    def respond(self, request):
+        """:return HTTP response (bytes) to the request header"""
+        parts = request.split(b'\r\n', 1)[0].split()
+        method, path = (parts[0], parts[1]) if len(parts) == 3 else (b'', b'')
+        if method not in (b'GET', b'HEAD'):
+            return self._response('405 Method Not Allowed', 'text/plain', b'')
+        if path.split(b'?')[0] not in (b'/', b'/metrics'):
+            return self._response('404 Not Found', 'text/plain', b'')
+
+        try:
+            body = self.metrics.render().encode()
+        except Exception:
+            logging.exception('Exception encountered rendering metrics')
+            return self._response('500 Internal Server Error', 'text/plain', b'')
+        return self._response('200 OK', CONTENT_TYPE, b'' if method == b'HEAD' else body, len(body))
+
+    @staticmethod
+    def _response(status, content_type, body, length=None):
+        header = 'HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, content_type, len(body) if length is None else length)
+        return header.encode() + body
+
+    def _disconnect(self, client):
+        self._clients.pop(client, None)
+        try:
+            self._selector.unregister(client)
+        except (KeyError, ValueError):
+            pass
+        client.close()
+
+    def close(self):
+        for client in list(self._clients):
+            self._disconnect(client)
+        if self._selector is not None:
+            try:
+                self._selector.unregister(self._sock)
+            except (KeyError, ValueError):
+                pass
+        self._sock.close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,182 @@
+"""Process fork/exec/exit events from the Linux proc connector (netlink).
+
+The kernel broadcasts an event to every listener of the CN_IDX_PROC connector
+group whenever a task forks, execs or exits, so processes can't slip between
+two scans of /proc. Listening requires CAP_NET_ADMIN (in practice root).
+"""
+
+import errno
+import socket
+import struct
+from collections import namedtuple
+
+# From linux/netlink.h, linux/connector.h and linux/cn_proc.h
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLMSG_OVERRUN = 4
+
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+
+PROC_EVENT_NONE = 0
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_EXIT = 0x80000000
+
+# struct nlmsghdr: len, type, flags, seq, pid
+_NLMSGHDR = struct.Struct('=IHHII')
+# struct cn_msg: id.idx, id.val, seq, ack, len, flags
+_CN_MSG = struct.Struct('=IIIIHH')
+# struct proc_event header: what, cpu, timestamp_ns
+_PROC_EVENT = struct.Struct('=IIQ')
+# event_data members we use
+_FORK_DATA = struct.Struct('=iiii')  # parent pid/tgid, child pid/tgid
+_EXEC_DATA = struct.Struct('=ii')  # pid, tgid
+_EXIT_DATA = struct.Struct('=iiII')  # pid, tgid, exit_code, exit_signal
+
+_HEADERS_SIZE = _NLMSGHDR.size + _CN_MSG.size
+
+
+class ProcEvent(namedtuple('ProcEvent', 'what pid tgid parent_tgid exit_code timestamp_ns')):
+    """A single proc connector event.
+
+    pid is the task (thread) ID and tgid the process ID; they are equal for the
+    main thread of a process. parent_tgid is only set for fork events and
+    exit_code (raw wait status) only for exit events.
+    """
+    __slots__ = ()
+
+    @property
+    def is_process(self):
+        """True if the event is about a process rather than one of its threads."""
+        return self.pid == self.tgid
+
+    @property
+    def returncode(self):
+        """Exit status like subprocess.Popen.returncode:
+        negative signal number if killed by a signal, otherwise the exit status.
+        """
+        if self.exit_code is None:
+            return None
+        signal = self.exit_code & 0x7f
+        if signal:
+            return -signal
+        return (self.exit_code >> 8) & 0xff
+
+
+def _message(op):
+    """Build the netlink message to subscribe to (or unsubscribe from) proc events."""
+    payload = struct.pack('=I', op)
+    cn_msg = _CN_MSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0)
+    length = _NLMSGHDR.size + len(cn_msg) + len(payload)
+    return _NLMSGHDR.pack(length, NLMSG_DONE, 0, 0, 0) + cn_msg + payload
+
+
+def parse_events(data):
+    """Yield ProcEvent for each fork, exec and exit event in a buffer read from
+    the proc connector socket. Other event types and messages are skipped.
+
+    :param data: bytes received from the socket (may hold several messages)
+    """
+    offset = 0
+    end = len(data)
+    while offset + _NLMSGHDR.size <= end:
+        length, msg_type = _NLMSGHDR.unpack_from(data, offset)[:2]
+        if length < _NLMSGHDR.size or offset + length > end:
+            # Truncated or corrupt message, nothing more to trust
+            break
+
+        if msg_type == NLMSG_DONE and length >= _HEADERS_SIZE + _PROC_EVENT.size:
+            idx, val = _CN_MSG.unpack_from(data, offset + _NLMSGHDR.size)[:2]
+            if idx == CN_IDX_PROC and val == CN_VAL_PROC:
+                event = _parse_event(data, offset + _HEADERS_SIZE)
+                if event is not None:
+                    yield event
+
+        # Messages are aligned to 4 bytes
+        offset += (length + 3) & ~3
+
+
+def _parse_event(data, offset):
+    what, _cpu, timestamp_ns = _PROC_EVENT.unpack_from(data, offset)
+    offset += _PROC_EVENT.size
+
+    if what == PROC_EVENT_FORK:
+        _parent_pid, parent_tgid, pid, tgid = _FORK_DATA.unpack_from(data, offset)
+        return ProcEvent(what, pid, tgid, parent_tgid, None, timestamp_ns)
+
+    elif what == PROC_EVENT_EXEC:
+        pid, tgid = _EXEC_DATA.unpack_from(data, offset)
+        return ProcEvent(what, pid, tgid, None, None, timestamp_ns)
+
+    elif what == PROC_EVENT_EXIT:
+        pid, tgid, exit_code, _exit_signal = _EXIT_DATA.unpack_from(data, offset)
+        return ProcEvent(what, pid, tgid, None, exit_code, timestamp_ns)
+
+    return None
+
+
+class ProcConnector:
+    """Non-blocking subscription to the kernel proc connector.
+
+    Raises OSError (typically PermissionError) if the socket can't be opened,
+    so callers can fall back to polling /proc.
+    Has fileno() so it can be passed to select/selectors.
+    """
+
+    def __init__(self, bufsize=65536):
+        self.bufsize = bufsize
+        # Set when the kernel dropped events because the socket buffer was full;
+        # the owner should rescan /proc and then clear it.
+        self.overrun = False
+
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            # Port ID 0 lets the kernel assign one
+            sock.bind((0, CN_IDX_PROC))
+            sock.send(_message(PROC_CN_MCAST_LISTEN))
+            sock.setblocking(False)
+        except:
+            sock.close()
+            raise
+
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def read_events(self):
+        """Read all pending events without blocking.
+
+        :return: list of ProcEvent in the order the kernel sent them
+        """
+        events = []
+        while True:
+            try:
+                data = self._sock.recv(self.bufsize)
+            except BlockingIOError:
+                break
+            except OSError as err:
+                if err.errno == errno.ENOBUFS:
+                    self.overrun = True
+                    continue
+                raise
+
+            events.extend(parse_events(data))
+
+        return events
+
+    def close(self):
+        if self._sock is None:
+            return
+        try:
+            self._sock.send(_message(PROC_CN_MCAST_IGNORE))
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
@@ -0,0 +1,56 @@
+"""Read /proc for many PIDs on a thread pool, for hosts with very many processes.
+
+The open/read syscalls release the GIL, so contiguous shards of PIDs (or
+processes) are handled by worker threads and their results concatenated in
+the original order, keeping output deterministic.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def split(items, shards):
+    """Split a list into at most `shards` contiguous chunks of nearly equal size"""
+    shards = max(1, min(shards, len(items)))
+    size, extra = divmod(len(items), shards)
+    chunks = []
+    start = 0
+    for i in range(shards):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+class ShardPool:
+    """Thread pool that maps a function over shards of a list.
+
+    :param workers: number of threads
+    :param min_shard_size: lists shorter than twice this are handled in the
+                           calling thread since dispatching costs more than it saves
+    """
+
+    def __init__(self, workers, min_shard_size=64):
+        self.workers = workers
+        self.min_shard_size = min_shard_size
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='proc-scan')
+
+    def map(self, function, items):
+        """Call function(shard) for shards of items on the pool.
+
+        :param function: takes a list and returns a list
+        :param items: iterable, consumed up front
+        :return: concatenation of the results, in the order of items
+        """
+        items = list(items)
+        if len(items) < 2 * self.min_shard_size:
+            return function(items)
+
+        shards = min(self.workers, len(items) // self.min_shard_size)
+        results = []
+        # map() yields results in submission order
+        for result in self._executor.map(function, split(items, shards)):
+            results.extend(result)
+        return results
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,103 @@
+"""Exit detection for watched processes using pidfd_open (Linux 5.3+) and epoll.
+
+A pidfd becomes readable when its process exits, so one epoll instance reports
+exits of any number of processes as they happen, without polling /proc.
+"""
+
+import errno
+import os
+import resource
+import select
+
+
+def raise_open_file_limit():
+    """Raise the soft RLIMIT_NOFILE to the hard limit, since one fd is kept per process.
+
+    :return: new soft limit
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class PidfdWatcher:
+    """Wait on a pidfd per watched process with a single epoll.
+
+    Raises OSError if pidfds are not supported, so callers can fall back to
+    polling. Has fileno() (the epoll fd) so it can be passed to select/selectors.
+    """
+
+    def __init__(self):
+        pidfd_open = getattr(os, 'pidfd_open', None)
+        if pidfd_open is None:
+            raise OSError(errno.ENOSYS, 'os.pidfd_open not available (requires Python 3.9+)')
+        # Raises OSError(ENOSYS) on kernels older than 5.3
+        os.close(pidfd_open(os.getpid()))
+
+        self._epoll = select.epoll()
+        self._fds = {}  # PID -> pidfd
+        self._pids = {}  # pidfd -> PID
+
+    def __len__(self):
+        return len(self._fds)
+
+    def __contains__(self, pid):
+        return pid in self._fds
+
+    def fileno(self):
+        return self._epoll.fileno()
+
+    def add(self, pid):
+        """Start watching a process.
+
+        :return: True if watching, False if the process no longer exists or no
+                 more file descriptors are available (caller should poll it instead)
+        """
+        if pid in self._fds:
+            return True
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            return False
+        except OSError as err:
+            if err.errno in (errno.EMFILE, errno.ENFILE):
+                return False
+            raise
+
+        self._fds[pid] = fd
+        self._pids[fd] = pid
+        self._epoll.register(fd, select.EPOLLIN)
+        return True
+
+    def remove(self, pid):
+        fd = self._fds.pop(pid, None)
+        if fd is not None:
+            del self._pids[fd]
+            self._epoll.unregister(fd)
+            os.close(fd)
+
+    def read_exited(self, timeout=0):
+        """Get the PIDs of watched processes that exited, and stop watching them.
+
+        :param timeout: seconds to wait for an exit; 0 doesn't block, None blocks forever
+        :return: list of PIDs
+        """
+        if timeout is None:
+            timeout = -1
+        exited = []
+        for fd, _ in self._epoll.poll(timeout):
+            pid = self._pids.get(fd)
+            if pid is not None:
+                exited.append(pid)
+                self.remove(pid)
+        return exited
+
+    def close(self):
+        for pid in list(self._fds):
+            self.remove(pid)
+        self._epoll.close()
@@ -0,0 +1,296 @@
+"""Match processes by expressions over what /proc tells about them.
+
+Expressions combine predicates with and, or, not and parentheses:
+
+    user = www-data and cmdline ~ gunicorn
+    comm = python* and (cgroup = /system.slice/* or parent = cron)
+    uid = 0 and not cmdline ~ "--dry-run"
+
+Each predicate is FIELD OP VALUE, OP being = (shell-style wildcards, or
+equality for numbers), != (not =), ~ (regular expression search, so a plain
+word matches a substring) or !~. Values with spaces or parentheses are
+quoted. Fields, from cheapest to most expensive to know:
+
+    pid, comm     known before matching: the PID, and the command name the
+                  matcher read from stat to identify the process
+    ppid          parent PID, from stat (known too for PIDs new in a listing
+                  of /proc, see ProcessIDs.parents)
+    user, uid     real user (name or UID), from status
+    parent        parent's command name, from the parent's stat
+    cgroup        cgroup v2 path, e.g. /system.slice/nginx.service
+    cmdline       full command line, arguments separated by spaces
+
+An expression is parsed once into a tree whose and/or children are sorted by
+that cost, so cheap predicates decide the result first, and all()/any() stop
+as soon as it is decided. ProcessFacts reads each file for one process at
+most once however many predicates use it, and not at all if no predicate
+evaluated needs it.
+"""
+
+import fnmatch
+import os.path as P
+import pwd
+import re
+
+import process
+
+# Cost of knowing a field, in /proc files read
+KNOWN, STAT, STATUS, PARENT, CGROUP, CMDLINE = range(6)
+
+# field -> (cost, whether values are numbers)
+FIELDS = {
+    'pid': (KNOWN, True),
+    'comm': (KNOWN, False),
+    'ppid': (STAT, True),
+    'user': (STATUS, True),
+    'uid': (STATUS, True),
+    'parent': (PARENT, False),
+    'cgroup': (CGROUP, False),
+    'cmdline': (CMDLINE, False),
+}
+
+_TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<paren>[()]) |
+    (?P<op>!=|!~|=|~) |
+    (?P<quoted>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*') |
+    (?P<word>[^\s()=!~"']+) |
+    (?P<error>\S)
+    )''', re.VERBOSE)
+
+
+class ProcessFacts:
+    """Fields of one process, each /proc file read once when first needed.
+
+    :param pid: process ID
+    :param comm: command name if already known
+    :param ppid: parent PID if already known
+    :raises ProcessLookupError from the fields if the process is gone
+    """
+
+    __slots__ = ('pid', '_comm', '_ppid', '_uid', '_parent', '_cgroup', '_cmdline')
+
+    def __init__(self, pid, comm=None, ppid=None):
+        self.pid = pid
+        self._comm = comm
+        self._ppid = ppid
+        self._uid = self._parent = self._cgroup = self._cmdline = None
+
+    def _read(self, name):
+        try:
+            with open(P.join(process.PROC_DIR, str(self.pid), name), 'rb') as f:
+                process.add_count('files_opened')
+                return f.read()
+        except FileNotFoundError:
+            raise ProcessLookupError(self.pid)
+
+    def _read_stat(self):
+        stat = process.read_stat(self.pid)
+        if stat is None:
+            raise ProcessLookupError(self.pid)
+        comm, fields = stat
+        if self._comm is None:
+            self._comm = comm.decode(errors='replace')
+        self._ppid = int(fields[process.STAT_PPID])
+
+    @property
+    def comm(self):
+        if self._comm is None:
+            self._read_stat()
+        return self._comm
+
+    @property
+    def ppid(self):
+        if self._ppid is None:
+            self._read_stat()
+        return self._ppid
+
+    @property
+    def uid(self):
+        if self._uid is None:
+            data = self._read('status')
+            start = data.find(b'\nUid:')
+            self._uid = int(data[start + 5:data.index(b'\n', start + 1)].split()[0])
+        return self._uid
+
+    user = uid
+
+    @property
+    def parent(self):
+        if self._parent is None:
+            stat = process.read_stat(self.ppid)
+            self._parent = stat[0].decode(errors='replace') if stat is not None else ''
+        return self._parent
+
+    @property
+    def cgroup(self):
+        if self._cgroup is None:
+            lines = self._read('cgroup').decode(errors='replace').splitlines()
+            # 0::/path in cgroup v2, hierarchy:controllers:/path lines in v1
+            paths = [line.split(':', 2)[2] for line in lines if line.count(':') >= 2]
+            self._cgroup = next((line[3:] for line in lines if line.startswith('0::')), paths[0] if paths else '')
+        return self._cgroup
+
+    @property
+    def cmdline(self):
+        if self._cmdline is None:
+            self._cmdline = self._read('cmdline').decode(errors='replace').replace('\x00', ' ').strip()
+        return self._cmdline
+
+
+class Predicate:
+    """FIELD OP VALUE, see the module docstring"""
+
+    def __init__(self, field, op, value, text):
+        if field not in FIELDS:
+            raise ValueError('Unknown field {!r} in match {!r}, one of: {}'.format(field, text, ', '.join(FIELDS)))
+        self.field = field
+        self.op = op
+        self.value = value
+        self.cost, numeric = FIELDS[field]
+        self.negate = op.startswith('!')
+
+        if numeric:
+            if op not in ('=', '!='):
+                raise ValueError('{} is compared with = or != in match {!r}'.format(field, text))
+            if field == 'user' and not value.isdigit():
+                try:
+                    value = pwd.getpwnam(value).pw_uid
+                except KeyError:
+                    raise ValueError('Unknown user {!r} in match {!r}'.format(value, text))
+            try:
+                number = int(value)
+            except ValueError:
+                raise ValueError('{} needs a number, got {!r} in match {!r}'.format(field, value, text))
+            self._test = number.__eq__
+        elif op.endswith('~'):
+            try:
+                self._test = re.compile(value).search
+            except re.error as err:
+                raise ValueError('Invalid regex {!r} in match {!r}: {}'.format(value, text, err))
+        else:
+            self._test = re.compile(fnmatch.translate(value)).match
+
+    def __repr__(self):
+        return '{} {} {!r}'.format(self.field, self.op, self.value)
+
+    def evaluate(self, facts):
+        return bool(self._test(getattr(facts, self.field))) != self.negate
+
+
+class All:
+    """and of its children, cheapest first"""
+    word = 'and'
+
+    def __init__(self, children):
+        self.children = sorted(children, key=lambda child: child.cost)
+        self.cost = max(child.cost for child in self.children)
+
+    def __repr__(self):
+        return '({})'.format(' {} '.join(map(repr, self.children)).format(self.word))
+
+    def evaluate(self, facts):
+        return all(child.evaluate(facts) for child in self.children)
+
+
+class Any(All):
+    """or of its children, cheapest first"""
+    word = 'or'
+
+    def evaluate(self, facts):
+        return any(child.evaluate(facts) for child in self.children)
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+        self.cost = child.cost
+
+    def __repr__(self):
+        return 'not {!r}'.format(self.child)
+
+    def evaluate(self, facts):
+        return not self.child.evaluate(facts)
+
+
+class MatchExpression:
+    """A parsed expression
+
+    :param text: expression, see the module docstring
+    :raises ValueError if it can't be parsed
+    """
+
+    def __init__(self, text):
+        self.text = ' '.join(text.split())
+        self._tokens = self._tokenize(text)
+        self._position = 0
+        self.root = self._parse_or()
+        if self._position < len(self._tokens):
+            raise ValueError('Unexpected {!r} in match {!r}'.format(self._tokens[self._position][1], text))
+        del self._tokens
+        self.cost = self.root.cost
+
+    def __repr__(self):
+        return 'MatchExpression({!r})'.format(self.text)
+
+    def matches(self, facts):
+        """:return whether the process matches, False if it's gone before that's known"""
+        try:
+            return self.root.evaluate(facts)
+        except (ProcessLookupError, PermissionError):
+            return False
+
+    def _tokenize(self, text):
+        tokens = []
+        for m in _TOKEN_RE.finditer(text):
+            kind = m.lastgroup
+            if kind is None:
+                continue
+            value = m.group(kind)
+            if kind == 'error':
+                raise ValueError('Unexpected {!r} in match {!r}, quote values with it'.format(value, text))
+            if kind == 'quoted':
+                kind, value = 'word', re.sub(r'\\(.)', r'\1', value[1:-1])
+            elif kind == 'word' and value.lower() in ('and', 'or', 'not'):
+                kind, value = value.lower(), value.lower()
+            tokens.append((kind, value))
+        return tokens
+
+    def _next(self, *kinds):
+        """:return value of the next token if it is one of kinds, otherwise None"""
+        if self._position < len(self._tokens):
+            kind, value = self._tokens[self._position]
+            if kind in kinds or value in kinds:
+                self._position += 1
+                return value
+        return None
+
+    def _expect(self, kind, what):
+        value = self._next(kind)
+        if value is None:
+            found = self._tokens[self._position][1] if self._position < len(self._tokens) else 'end'
+            raise ValueError('Expected {} but found {!r} in match {!r}'.format(what, found, self.text))
+        return value
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._next('or'):
+            children.append(self._parse_and())
+        return children[0] if len(children) == 1 else Any(children)
+
+    def _parse_and(self):
+        children = [self._parse_not()]
+        while self._next('and'):
+            children.append(self._parse_not())
+        return children[0] if len(children) == 1 else All(children)
+
+    def _parse_not(self):
+        if self._next('not'):
+            return Not(self._parse_not())
+        if self._next('('):
+            node = self._parse_or()
+            self._expect(')', ')')
+            return node
+        field = self._expect('word', 'a field')
+        op = self._expect('op', 'one of = != ~ !~ after {}'.format(field))
+        value = self._expect('word', 'a value after {} {}'.format(field, op))
+        return Predicate(field.lower(), op, value, self.text)
@@ -0,0 +1,69 @@
+"""Deadline scheduling of checks so each process can have its own interval."""
+
+import heapq
+from itertools import count
+
+
+def adaptive_interval(age, min_interval, max_interval, factor=0.1):
+    """How long to wait before checking a process again.
+
+    New processes are checked often since short-lived ones are likely to end
+    soon; the interval grows with age (factor * age) up to max_interval.
+
+    :param age: seconds since the process started
+    :return: seconds
+    """
+    return min(max_interval, max(min_interval, age * factor))
+
+
+class Scheduler:
+    """Min-heap of task deadlines.
+
+    Tasks are any hashable key (e.g. a PID). Scheduling a task again replaces its
+    previous deadline; replaced and cancelled entries stay in the heap and are
+    skipped when they reach the top.
+    """
+
+    def __init__(self):
+        # [deadline, sequence, task, active]
+        self._heap = []
+        # task -> its active heap entry
+        self._entries = {}
+        # Tie breaker so tasks themselves are never compared
+        self._sequence = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, task):
+        return task in self._entries
+
+    def schedule(self, task, deadline):
+        """Run task at deadline (seconds since epoch), replacing any previous deadline."""
+        self.cancel(task)
+        entry = [deadline, next(self._sequence), task, True]
+        self._entries[task] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, task):
+        entry = self._entries.pop(task, None)
+        if entry is not None:
+            entry[3] = False
+
+    def next_deadline(self):
+        """:return earliest deadline, or None if nothing is scheduled"""
+        heap = self._heap
+        while heap and not heap[0][3]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        """Remove and return tasks whose deadline is at or before now, earliest first."""
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, _, task, active = heapq.heappop(heap)
+            if active:
+                del self._entries[task]
+                due.append(task)
+        return due
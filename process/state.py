@@ -0,0 +1,91 @@
+"""Checkpoint of watched processes in SQLite, to pick up where a restarted watcher left off.
+
+The database is in WAL mode with synchronous=NORMAL, so a checkpoint is one
+small append to the write-ahead log and a crash can at worst lose the last
+one. Only processes sampled since the previous checkpoint are written.
+"""
+
+import json
+import sqlite3
+
+from . import ProcessByPID
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS process (
+    pid INTEGER PRIMARY KEY,
+    start_time INTEGER,
+    requested INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    data TEXT NOT NULL
+)
+"""
+
+
+class SavedProcess:
+    """A process read from the checkpoint
+
+    :ivar process: ProcessByPID rebuilt from the saved data, see ProcessByPID.from_dict
+    :ivar requested: whether it was watched by PID rather than by a pattern
+    :ivar updated: time (seconds since epoch) it was last sampled, so known to be running
+    """
+
+    def __init__(self, process, requested, updated):
+        self.process = process
+        self.requested = requested
+        self.updated = updated
+
+
+class StateStore:
+    """Watched processes saved in a SQLite database
+
+    :param path: database file, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        # PID -> (start time, sample time, requested) of the saved rows
+        self._saved = {}
+
+    def load(self):
+        """:return list of SavedProcess from the last checkpoint"""
+        saved = []
+        for pid, start_time, requested, updated, data in self._db.execute(
+                'SELECT pid, start_time, requested, updated, data FROM process ORDER BY pid'):
+            process = ProcessByPID.from_dict(json.loads(data))
+            saved.append(SavedProcess(process, bool(requested), updated))
+            self._saved[pid] = (start_time, None, bool(requested))
+        return saved
+
+    def checkpoint(self, processes, requested_pids, now):
+        """Save the processes sampled since the last checkpoint and drop the ones no longer watched.
+
+        :param processes: dict of PID -> ProcessByPID being watched
+        :param requested_pids: PIDs watched by PID rather than by a pattern
+        :param now: time of the checkpoint
+        :return number of rows written or deleted
+        """
+        saved = self._saved
+        removed = [(pid,) for pid in saved if pid not in processes]
+        changed = []
+        for pid, process in processes.items():
+            key = (process.start_time, process.sample_time, pid in requested_pids)
+            if saved.get(pid) != key:
+                updated = process.sample_time or now
+                changed.append((pid, process.start_time, key[2], updated, json.dumps(process.as_dict())))
+                saved[pid] = key
+
+        if removed or changed:
+            with self._db:
+                self._db.executemany('DELETE FROM process WHERE pid = ?', removed)
+                self._db.executemany('INSERT OR REPLACE INTO process VALUES (?, ?, ?, ?, ?)', changed)
+            for pid, in removed:
+                del saved[pid]
+        return len(removed) + len(changed)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,204 @@
+"""Watch a process together with all its descendants, e.g. a build driver or job launcher.
+
+ProcessTree is a parent -> children index built from the ppid field of
+/proc/PID/stat. It is updated incrementally: only PIDs that ProcessIDs
+reports as new are read, and PIDs are dropped as they end.
+"""
+
+import logging
+from datetime import datetime
+
+from . import STAT_PPID, CLOCK_TICKS, ProcessByPID, NoProcessFound, check_all, read_stat
+
+TREE_INFO_FORMAT = "Process tree {pid}: {command}\n" \
+                   " Started: {created_datetime:%a, %b %d %H:%M:%S}{ended_text}\n" \
+                   " Processes: {processes_total:,} ({running_count:,} running)   " \
+                   "Resident memory (total now/peak): {rss_total:,} / {rss_total_peak:,} kB   " \
+                   "Largest process peak: {rss_process_peak:,} kB\n" \
+                   " CPU time - User: {user_seconds:,.2f} s  System: {system_seconds:,.2f} s"
+
+
+def read_ppid(pid):
+    """:return parent PID from /proc/PID/stat, None if the process is gone"""
+    stat = read_stat(pid)
+    return int(stat[1][STAT_PPID]) if stat is not None else None
+
+
+class ProcessTree:
+    """Parent -> children index of processes.
+
+    A process keeps its place under its original parent after that parent
+    ends (the kernel reparents it to init), so the descendants of an ended
+    process can still be found.
+    """
+
+    def __init__(self):
+        self.parents = {}  # PID -> parent PID
+        self.children = {}  # PID -> set of child PIDs
+
+    def __contains__(self, pid):
+        return pid in self.parents
+
+    def add(self, pids, parents=None):
+        """Add new processes, e.g. the PIDs ProcessIDs yields.
+
+        :param parents: dict of PID -> parent PID already known, e.g. ProcessIDs.parents,
+                        so stat isn't read again and processes that ended already are still linked
+        :return list of the PIDs added (ones that ended already and whose parent isn't known are skipped)
+        """
+        added = []
+        for pid in pids:
+            ppid = parents.get(pid) if parents else None
+            if ppid is None:
+                ppid = read_ppid(pid)
+            if ppid is None:
+                continue
+            old_ppid = self.parents.get(pid)
+            if old_ppid is not None and old_ppid != ppid:
+                # PID reused
+                self.children.get(old_ppid, set()).discard(pid)
+            self.parents[pid] = ppid
+            self.children.setdefault(ppid, set()).add(pid)
+            added.append(pid)
+        return added
+
+    def remove(self, pid):
+        """Drop an ended process. Its children stay indexed under it until they end."""
+        ppid = self.parents.pop(pid, None)
+        if ppid is None:
+            return
+        siblings = self.children.get(ppid)
+        if siblings is not None:
+            siblings.discard(pid)
+            if not siblings and ppid not in self.parents:
+                del self.children[ppid]
+        if not self.children.get(pid):
+            self.children.pop(pid, None)
+
+    def descendants(self, pid):
+        """:return list of the PIDs below pid, parents before their children"""
+        found = []
+        pending = [pid]
+        while pending:
+            for child in self.children.get(pending.pop(), ()):
+                found.append(child)
+                pending.append(child)
+        return found
+
+    def ancestor_in(self, pid, pids):
+        """:return the closest ancestor of pid in the collection pids, None if there isn't one"""
+        parents = self.parents
+        seen = set()
+        ppid = parents.get(pid)
+        while ppid is not None and ppid not in seen:
+            if ppid in pids:
+                return ppid
+            seen.add(ppid)
+            ppid = parents.get(ppid)
+        return None
+
+
+class TreeWatch:
+    """A process and its descendants watched until all of them end.
+
+    Has the attributes and info() the communicate modules use for a process,
+    with pid, command and executable of the root process.
+
+    :param pid: root process
+    :param tree: ProcessTree to find descendants in, with pid already added
+    :raises NoProcessFound
+    """
+
+    def __init__(self, pid, tree):
+        self.tree = tree
+        root = ProcessByPID(pid)
+        self.pid = pid
+        self.command = root.command
+        self.executable = root.executable
+        self.created_datetime = root.created_datetime
+        self.running = True
+        self.ended_datetime = None
+        # PID -> ProcessByPID of the processes in the tree still running
+        self.members = {pid: root}
+        # Every PID that has been in the tree, so descendants of ended members are found
+        self.pids = {pid}
+        self.processes_total = 1
+        # Totals of ended members
+        self._ended_utime = self._ended_stime = 0
+        # kB
+        self.rss_total = self.rss_total_peak = self.rss_process_peak = 0
+
+        self.add_descendants(tree.descendants(pid))
+        self._update_totals()
+
+    def add_descendants(self, pids):
+        """Watch the new PIDs that belong to the tree
+        :return number of processes now watched
+        """
+        added = 0
+        for pid in pids:
+            if pid in self.members or self.tree.ancestor_in(pid, self.pids) is None:
+                continue
+            # Counted even if it ended already, its children are still in the tree
+            self.pids.add(pid)
+            self.processes_total += 1
+            try:
+                self.members[pid] = ProcessByPID(pid)
+                added += 1
+            except NoProcessFound:
+                pass
+        return added
+
+    def check(self, pool=None):
+        """Check all the running members and update totals
+        :return True while any member is running
+        """
+        if not self.running:
+            return False
+
+        ended, errors = check_all(self.members.values(), pool)
+        for process, err in errors:
+            logging.error('Exception encountered while checking process {} of tree {}'.format(process.pid, self.pid),
+                          exc_info=err)
+        for process in ended + [process for process, _ in errors]:
+            del self.members[process.pid]
+            self.tree.remove(process.pid)
+            self._ended_utime += process.utime
+            self._ended_stime += process.stime
+            self.rss_process_peak = max(self.rss_process_peak, process.status['VmHWM'])
+        self._update_totals()
+
+        if not self.members:
+            self.running = False
+            self.ended_datetime = datetime.now()
+            text = str(self.ended_datetime - self.created_datetime)
+            self.duration_text = text[:text.rfind('.')]
+        return self.running
+
+    def _update_totals(self):
+        members = self.members.values()
+        self.rss_total = sum(process.status['VmRSS'] for process in members)
+        self.rss_total_peak = max(self.rss_total_peak, self.rss_total)
+        self.rss_process_peak = max([self.rss_process_peak] + [process.status['VmHWM'] for process in members])
+
+    @property
+    def user_seconds(self):
+        return (self._ended_utime + sum(process.utime for process in self.members.values())) / CLOCK_TICKS
+
+    @property
+    def system_seconds(self):
+        return (self._ended_stime + sum(process.stime for process in self.members.values())) / CLOCK_TICKS
+
+    def info(self):
+        if self.running:
+            ended_text = ''
+        else:
+            ended_text = '  Ended: {:%a, %b %d %H:%M:%S}  (duration {})'.format(self.ended_datetime,
+                                                                           self.duration_text)
+        return TREE_INFO_FORMAT.format(ended_text=ended_text, running_count=len(self.members),
+                                       user_seconds=self.user_seconds, system_seconds=self.system_seconds,
+                                       **self.__dict__)
+
+    def close(self):
+        for process in self.members.values():
+            process.close()
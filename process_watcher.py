@@ -2,33 +2,31 @@
 
 import sys
 import argparse
+import functools
 from argparse import RawTextHelpFormatter
 import logging
-import json
+import re
+import selectors
+import signal
+import time
+from datetime import datetime
 
-from dataclasses import dataclass
 from process import *
-
-@dataclass
-class JsonItems:
-    to = []
-    commands = []
-    commands_regex = []
-    pids = []
-
-
-def readjson(jsonfile):
-    with open(jsonfile) as f:
-        data = json.load(f)
-        items = JsonItems()
-        items.to = data['to']
-        for d in data['processes']:
-            if d['command'] != '':
-                items.commands.append(d['command'])
-            if d['regex'] != '':
-                items.commands_regex.append(d['regex'])
-            if d['pid'] != '':
-                items.pids.append(d['pid'])
+from communicate.dispatch import Dispatcher, parse_rate
+from communicate.digest import Coalescer, Digest
+from process.netlink import ProcConnector, PROC_EVENT_EXIT
+from process.pidfd import PidfdWatcher, raise_open_file_limit
+from process.schedule import Scheduler, adaptive_interval
+from process.parallel import ShardPool
+from process.control import ControlServer, ControlError
+from process.metrics import Metrics, MetricsServer
+from process.state import StateStore
+from process.cgroup import CgroupByPath, CgroupWatcher, NoCgroupFound
+from process.tree import ProcessTree, TreeWatch
+from process.alerts import AlertRules
+from process.eventlog import EventLog
+from process.fleet import Agent, Collector, RemoteAlert, RemoteProcess
+from process.config import Config, ConfigError, ConfigWatcher
 
 
 # Remember to update README.md after modifying
@@ -44,24 +42,87 @@ communication protocols.
 parser.add_argument('-p', '--pid', help='process ID(s) to watch [+]',
                     type=int,
                     action='append', default=[])
+parser.add_argument('--tree', help='process ID to watch together with all its descendants,\n'
+                                   'notifying once all of them have ended [+]',
+                    type=int, action='append', default=[], metavar='PID')
 parser.add_argument('-c', '--command',
                     help='watch all processes matching the command name pattern. (shell-style wildcards) [+]',
                     action='append', default=[], metavar='COMMAND_PATTERN')
 parser.add_argument('-crx', '--command-regex',
                     help='watch all processes matching the command name regular expression. [+]',
                     action='append', default=[], metavar='COMMAND_REGEX')
-parser.add_argument('-w', '--watch-new', help='watch for new processes that match --command. '
+parser.add_argument('-m', '--match', help='watch all processes matching an expression of cmdline, user, cgroup, parent, ...\n'
+                                          'e.g. "user = www-data and cmdline ~ gunicorn". (see README.md) [+]',
+                    action='append', default=[], metavar='EXPRESSION')
+parser.add_argument('--cgroup', help='cgroup v2 directory to watch as one unit, e.g. a service or container.\n'
+                                     'Notifies when no process is left in it. Relative paths are under /sys/fs/cgroup [+]',
+                    action='append', default=[], metavar='PATH')
+parser.add_argument('--alert', help='notify when a watched process crosses a threshold, e.g. "rss > 8GB",\n'
+                                    '"rss growth > 50%% in 5m" or "cpu < 1%% for 10m", and again once it\'s back. [+]',
+                    action='append', default=[], metavar='RULE')
+parser.add_argument('-w', '--watch-new', help='watch for new processes that match --command, --command-regex or --match. '
                                               '(run forever)', action='store_true')
+parser.add_argument('--control', help='run as a daemon, taking commands to add and remove PIDs and patterns,\n'
+                                      'list watches and get process stats on this Unix socket. (implies -w)',
+                    metavar='SOCKET')
+parser.add_argument('--metrics', help='serve OpenMetrics (Prometheus) metrics of watched processes and the watcher\n'
+                                      'itself over HTTP on [HOST:]PORT or a Unix socket path.', metavar='ADDRESS')
+parser.add_argument('--state', help='save watched processes to this file (SQLite) and resume watching them on restart,\n'
+                                    'reporting the ones that ended while stopped.', metavar='FILE')
+parser.add_argument('--state-interval', help='how often to save --state. (default: 60.0 seconds)',
+                    type=float, default=60.0, metavar='SECONDS')
+parser.add_argument('--events', help='write events (watch-start, sample, exit, alert, notification-sent) as JSON lines\n'
+                                     'to this file or FIFO, or - for stdout.', metavar='FILE')
+parser.add_argument('--events-max-size', help='rotate the --events file when it reaches this many bytes. (default: never)',
+                    type=int, default=0, metavar='BYTES')
+parser.add_argument('--events-backups', help='rotated --events files to keep. (default: 5)',
+                    type=int, default=5, metavar='N')
+parser.add_argument('--agent', help='send events to the collector at [HOST:]PORT or Unix socket path, which notifies\n'
+                                    'about them. Events are kept while it can\'t be reached.', metavar='ADDRESS')
+parser.add_argument('--agent-spool', help='keep --agent events in this file instead of memory while the collector\n'
+                                          'can\'t be reached, including across restarts.', metavar='FILE')
+parser.add_argument('--agent-name', help='name of this host for the collector. (default: hostname)', metavar='NAME')
+parser.add_argument('--collect', help='collect events from agents on [HOST:]PORT or a Unix socket path and notify about\n'
+                                      'their processes ending and alerts. (run forever)', metavar='ADDRESS')
 parser.add_argument('--to', help='email address to send to [+]', action='append', metavar='EMAIL_ADDRESS')
 parser.add_argument('--channel', help='channel to send to [+]', action='append')
 parser.add_argument('-n', '--notify', help='send DBUS Desktop notification', action='store_true')
+parser.add_argument('--proc-events', help='find new and ended processes as they happen using the kernel proc '
+                                          'connector (netlink).\nFalls back to polling /proc if unavailable. '
+                                          '(requires root)', action='store_true')
+parser.add_argument('--pidfd', help='detect when watched processes end as it happens using pidfds.\n'
+                                    'Falls back to polling /proc if unsupported. (Linux 5.3+)', action='store_true')
+parser.add_argument('--keep-open', help='keep each watched process\'s /proc/PID/status, stat and io open and re-read them.\n'
+                                        'Faster with many processes; uses three file descriptors per process.',
+                    action='store_true')
+parser.add_argument('--notify-workers', help='max notifications sent at once per protocol. (default: 1)',
+                    type=int, default=1, metavar='N')
+parser.add_argument('--notify-timeout', help='network timeout for email and Slack notifications. Exiting waits at most\n'
+                                             'twice this for unsent ones. (default: 30 seconds)',
+                    type=float, default=30.0, metavar='SECONDS')
+parser.add_argument('--notify-rate', help='most notifications sent per protocol, as COUNT/PERIOD with period s, m, h or d,\n'
+                                         'e.g. 10/m. More wait their turn. (default: no limit)', metavar='RATE')
+parser.add_argument('--digest', help='hold notifications about processes ending for this long, and send one\n'
+                                     'summary per executable for the ones that ended meanwhile. (default: 0, off)',
+                    type=float, default=0.0, metavar='SECONDS')
+parser.add_argument('--notify-retries', help='how many times to retry a failed notification. (default: 3)',
+                    type=int, default=3, metavar='N')
+parser.add_argument('--workers', help='threads reading /proc, for hosts with very many processes. (default: 1)',
+                    type=int, default=1, metavar='N')
+parser.add_argument('--history', help='number of memory/CPU samples kept per process for statistics. (default: 120)',
+                    type=int, default=120, metavar='SAMPLES')
 parser.add_argument('-i', '--interval', help='how often to check on processes. (default: 15.0 seconds)',
                     type=float, default=15.0, metavar='SECONDS')
+parser.add_argument('--min-interval', help='check new processes this often, backing off as they get older.\n'
+                                           '(default: --interval)', type=float, metavar='SECONDS')
+parser.add_argument('--max-interval', help='longest time between checks of long running processes. (default: --interval)',
+                    type=float, metavar='SECONDS')
 parser.add_argument('-q', '--quiet', help="don't print anything to stdout except warnings and errors",
                     action='store_true')
 parser.add_argument('--log', help="log style output (timestamps and log level)", action='store_true')
 parser.add_argument('--tag', help='label for process [+]', action='append', metavar='LABEL')
-parser.add_argument('-j', '--json', help='json file path to import PIDs, commands, emails and messages from',
+parser.add_argument('-j', '--json', help='JSON config file of processes to watch, recipients and alerts,\n'
+                                   'reloaded when it changes. (see README.md) [+]',
                     action='append', metavar='JSON_FILE')
 
 # Just print help and exit if no arguments specified.
@@ -76,22 +137,43 @@ log_level = logging.WARNING if args.quiet else logging.INFO
 log_format = '%(asctime)s %(levelname)s: %(message)s' if args.log else '%(message)s'
 logging.basicConfig(format=log_format, level=log_level)
 
+# Watch specs, recipients and alerts from the -j files
+config = None
+if args.json:
+    try:
+        config = Config(args.json)
+    except ConfigError as err:
+        logging.error(str(err))
+        sys.exit(1)
+to = (args.to or []) + list(config.to if config else ())
+slack_channels = (args.channel or []) + list(config.channel if config else ())
 
 # Load communication protocols based present arguments
-# (library, send function keyword args)
-comms = []
-if args.to:
+# Notifications are sent in background threads so checking isn't held up
+dispatcher = Dispatcher()
+# On exit, notifications still unsent after this many --notify-timeouts are dropped
+SHUTDOWN_NOTIFY_TIMEOUTS = 2
+channel_options = {'workers': args.notify_workers, 'retries': args.notify_retries}
+if args.notify_rate:
+    try:
+        channel_options['rate_limit'] = parse_rate(args.notify_rate)
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
+network_options = dict(channel_options, timeout=args.notify_timeout)
+if to:
     try:
         import communicate.email
-        comms.append((communicate.email, {'to': args.to}))
+        dispatcher.add_channel(communicate.email, {'to': to}, **network_options)
     except:
         logging.exception('Failed to load email module. (required by --to)')
         sys.exit(1)
 
-if args.channel:
+if slack_channels:
     try:
         import communicate.slack
-        comms.append((communicate.slack, {'channel': args.channel}))
+        # Processes ending around the same time are posted as one message
+        dispatcher.add_channel(communicate.slack, {'channel': slack_channels}, batch_delay=1.0, **network_options)
     except:
         logging.exception('Failed to load slack module. (required by --channel)')
         sys.exit(1)
@@ -100,7 +182,7 @@ if args.notify:
     exception_message = 'Failed to load Desktop Notification module. (required by --notify)'
     try:
         import communicate.dbus_notify
-        comms.append((communicate.dbus_notify, {}))
+        dispatcher.add_channel(communicate.dbus_notify, **channel_options)
     except ImportError as err:
         if err.name == 'notify2':
             logging.error("{}\n 'notify2' python module not installed.\n"
@@ -113,22 +195,267 @@ if args.notify:
         logging.exception(exception_message)
         sys.exit(1)
 
+# Threshold alerts on the statistics of watched processes
+alert_rules = AlertRules()
+for rule in args.alert + list(config.alerts if config else ()):
+    try:
+        alert_rules.add(rule)
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
+# Exits of processes with the same executable are notified about together.
+# Each group is a ('digest', key) task, due when its window ends.
+coalescer = Coalescer(args.digest) if args.digest > 0 else None
+
+# Where events go: JSON lines for log pipelines and/or a collector
+event_sinks = []
+if args.events:
+    try:
+        event_sinks.append(EventLog(args.events, max_bytes=args.events_max_size, backups=args.events_backups))
+    except OSError as err:
+        logging.error('Failed to open events file {}: {}'.format(args.events, err))
+        sys.exit(1)
+
+agent = None
+if args.agent:
+    try:
+        agent = Agent(args.agent, host=args.agent_name, spool=args.agent_spool)
+    except (OSError, ValueError) as err:
+        logging.error('Failed to set up sending events to {}: {}'.format(args.agent, err))
+        sys.exit(1)
+    event_sinks.append(agent)
+    logging.info('Sending events to collector {} as {}'.format(args.agent, agent.host))
+
+
+def emit_event(event, now=None, **fields):
+    for sink in event_sinks:
+        sink.emit(event, now, **fields)
+
+
+if event_sinks:
+    def notification_event(channel, job, error):
+        process = job.process
+        fields = {'channel': channel, 'pid': process.pid, 'attempts': job.attempts,
+                  'subject': job.subject_format.format(**process.__dict__)}
+        if error is None:
+            emit_event('notification-sent', **fields)
+        else:
+            emit_event('notification-failed', error=str(error), **fields)
+
+    dispatcher.on_result = notification_event
+
 
 # dict of all the process watching objects pid -> ProcessByPID
 # items removed when process ends
 watched_processes = {}
 
+# PIDs watched because they were asked for, rather than because they matched
+# a pattern. Kept when patterns are removed.
+requested_pids = set()
+
+process_matcher = ProcessMatcher()
+
+# PID -> WatchSpec from the config listing it
+spec_pids = {}
+
+# Sources of events to handle while waiting between checks,
+# registered with a handler function as data
+selector = selectors.DefaultSelector()
+
+# Next check of each watched process (by PID) and of DISCOVER_TASK
+scheduler = Scheduler()
+DISCOVER_TASK = 'discover'
+min_interval = args.interval if args.min_interval is None else args.min_interval
+max_interval = max(min_interval, args.interval if args.max_interval is None else args.max_interval)
+
+
+def schedule_check(process, now):
+    spec = process.spec
+    if spec is not None and spec.interval is not None:
+        scheduler.schedule(process.pid, now + spec.interval)
+        return
+    age = now - process.created
+    scheduler.schedule(process.pid, now + adaptive_interval(age, min_interval, max_interval))
+
+proc_events = None
+if args.proc_events:
+    try:
+        # Subscribe before the initial /proc scan so nothing is missed in between
+        proc_events = ProcConnector()
+    except OSError as err:
+        logging.warning('Failed to open proc connector, polling /proc instead. ({})'.format(err))
+
+pidfds = None
+if args.pidfd:
+    try:
+        pidfds = PidfdWatcher()
+        raise_open_file_limit()
+    except OSError as err:
+        logging.warning('pidfd not supported, polling /proc instead. ({})'.format(err))
+
+# dict of cgroup path -> CgroupByPath, items removed when the group empties.
+# Scheduled as ('cgroup', path) tasks to update their statistics.
+watched_cgroups = {}
+cgroup_events = None
+if args.cgroup:
+    try:
+        cgroup_events = CgroupWatcher()
+    except OSError as err:
+        logging.warning('inotify not available, polling cgroups instead. ({})'.format(err))
+
+# dict of root PID -> TreeWatch, removed when the whole tree ended.
+# Checked as ('tree', PID) tasks.
+watched_trees = {}
+# Parent -> children index of all processes, only kept when watching trees
+process_tree = ProcessTree() if args.tree else None
+
+
+def watch(pid, process=None):
+    """Start watching a process.
+    :param process: ProcessByPID already made for the PID
+    :return ProcessByPID
+    :raises NoProcessFound
+    """
+    if process is None:
+        process = ProcessByPID(pid)
+    set_spec(process, spec_of(pid))
+    watched_processes[pid] = process
+    schedule_check(process, time_now())
+    if event_sinks:
+        emit_event('watch-start', pid=pid, start_time=process.start_time, command=process.command,
+                   executable=process.executable, created=process.created)
+    if pidfds is not None:
+        # If it fails (e.g. out of file descriptors) the process is still polled
+        pidfds.add(pid)
+    return process
+
+
+def spec_of(pid):
+    """:return the WatchSpec a process is watched for, None if not watched for one"""
+    spec = spec_pids.get(pid)
+    return spec if spec is not None else process_matcher.spec_for(pid)
+
+
+def set_spec(process, spec):
+    process.spec = spec
+    process.tag = spec.tag if spec is not None else None
+
+
+def end_watch(pid):
+    """Stop watching a process
+    :return ProcessByPID or None if not watched
+    """
+    if pidfds is not None:
+        pidfds.remove(pid)
+    requested_pids.discard(pid)
+    scheduler.cancel(pid)
+    alert_rules.forget(pid)
+    process = watched_processes.pop(pid, None)
+    if process is not None:
+        process.close()
+    return process
+
+
+def watch_cgroup(cgroup):
+    watched_cgroups[cgroup.path] = cgroup
+    scheduler.schedule(('cgroup', cgroup.path), time_now() + args.interval)
+    if cgroup_events is not None:
+        cgroup_events.add(cgroup)
+
+
+def end_watch_cgroup(path):
+    """Stop watching a cgroup
+    :return CgroupByPath or None if not watched
+    """
+    if cgroup_events is not None:
+        cgroup_events.remove(path)
+    scheduler.cancel(('cgroup', path))
+    return watched_cgroups.pop(path, None)
+
+
+def watching():
+    """Whether there's anything left to watch"""
+    return bool(watched_processes or watched_cgroups or watched_trees or watch_new or collector)
+
+
+ProcessByPID.history_size = max(1, args.history)
+
+if args.keep_open:
+    ProcessByPID.keep_open = True
+    raise_open_file_limit()
+
+# io is a third file opened per check, only read for what reports I/O (kept
+# open files are read anyway). Notifications leave I/O out without it.
+ProcessByPID.read_io = bool(args.keep_open or args.metrics or args.control or event_sinks or
+                            any(rule.metric in ('read_rate', 'write_rate') for rule in alert_rules.rules))
+
+# Shards /proc reads of discovery and checks across threads
+scan_pool = ShardPool(args.workers) if args.workers > 1 else None
+
+# Resume watching processes saved before a restart, and collect the ones
+# that ended in the meantime to report them
+ended_while_stopped = []
+state = None
+if args.state:
+    try:
+        state = StateStore(args.state)
+        saved_processes = state.load()
+    except Exception as err:
+        logging.error('Failed to load state from {}: {}'.format(args.state, err))
+        sys.exit(1)
+
+    for saved in saved_processes:
+        process = saved.process
+        try:
+            current = ProcessByPID(process.pid)
+        except NoProcessFound:
+            current = None
+        if current is not None and current.start_time == process.start_time:
+            watch(process.pid, current)
+            if saved.requested:
+                requested_pids.add(process.pid)
+            continue
+
+        if current is not None:
+            # PID reused by another process
+            current.close()
+        process.mark_ended(ended_datetime=datetime.fromtimestamp(saved.updated))
+        process.exit_text = '  (ended while not watched, after the time shown)'
+        ended_while_stopped.append(process)
+
+    if saved_processes:
+        logging.info('Restored {} of {} saved processes from {}'.format(
+            len(saved_processes) - len(ended_while_stopped), len(saved_processes), args.state))
+
 # Initialize processes from arguments, get metadata
 for pid in args.pid:
     try:
         if pid not in watched_processes:
-            watched_processes[pid] = ProcessByPID(pid)
+            watch(pid)
+        requested_pids.add(pid)
 
     except NoProcessFound as ex:
         logging.warning('No process with PID {}'.format(ex.pid))
 
-process_matcher = ProcessMatcher()
-new_processes = ProcessIDs()
+for path in args.cgroup:
+    try:
+        cgroup = CgroupByPath(path)
+        if cgroup.running:
+            watch_cgroup(cgroup)
+        else:
+            logging.warning('No processes in cgroup {}'.format(cgroup.path))
+
+    except NoCgroupFound as ex:
+        logging.warning(str(ex))
+
+def forget_process(pid):
+    """Drop what is known about a process that ended or exec'd"""
+    process_matcher.forget(pid)
+    if process_tree is not None:
+        process_tree.remove(pid)
+
+
+new_processes = ProcessIDs(events=proc_events, on_remove=forget_process, pool=scan_pool)
 
 for pattern in args.command:
     process_matcher.add_command_wildcard(pattern)
@@ -136,95 +463,710 @@ for pattern in args.command:
 for regex in args.command_regex:
     process_matcher.add_command_regex(regex)
 
-if args.json:
-    json_data = readjson(args.json)
+for expression in args.match:
+    try:
+        process_matcher.add_expression(expression)
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
 
-    if json_data.to:
+def add_spec(spec):
+    """Watch what a config spec asks for: its PIDs now, processes its patterns match once matched"""
+    if spec.pattern:
+        process_matcher.add_spec(spec)
+    for pid in spec.pids:
+        spec_pids[pid] = spec
         try:
-            import communicate.email
-        except:
-            logging.exception('Failed to load email module. (required by --to)')
-            sys.exit(1)
-    for tos in json_data.to:
-        comms.append((communicate.email, {'to': args.to}))
+            process = watched_processes.get(pid)
+            if process is None:
+                watch(pid)
+            else:
+                set_spec(process, spec)
+                schedule_check(process, time_now())
+            requested_pids.add(pid)
+        except NoProcessFound as ex:
+            logging.warning('No process with PID {} of {}'.format(ex.pid, spec.name))
 
-    for pid in json_data.pids:
-        try:
-            if pid not in watched_processes:
-                watched_processes[pid] = ProcessByPID(pid)
 
-        except NoProcessFound as ex:
-            logging.warning('No process with PID {}'.format(ex.pid))
+def remove_spec(spec):
+    """Stop using a config spec. Its processes are still watched until update_spec_watches()."""
+    process_matcher.remove_spec(spec.name)
+    for pid in spec.pids:
+        if spec_pids.get(pid) == spec:
+            del spec_pids[pid]
+            if pid not in args.pid:
+                requested_pids.discard(pid)
+
 
-    for pattern in json_data.commands:
-        process_matcher.add_command_wildcard(pattern)
+if config is not None:
+    for spec in config.specs.values():
+        add_spec(spec)
 
-    for regex in json_data.commands_regex:
-        process_matcher.add_command_regex(regex)
+# /proc is only listed for something to match or trees to fill, a plain -p
+# watch just checks its processes
+if process_matcher.num_conditions > 0 or args.tree or args.control is not None:
+    initial_pids = list(new_processes)
+else:
+    initial_pids = []
+if process_tree is not None:
+    process_tree.add(initial_pids, new_processes.parents)
+
+for pid in args.tree:
+    try:
+        watched_trees[pid] = TreeWatch(pid, process_tree)
+        scheduler.schedule(('tree', pid), time_now() + min_interval)
+
+    except NoProcessFound as ex:
+        logging.warning('No process with PID {}'.format(ex.pid))
 
 # Initial processes matching conditions
-for pid in process_matcher.matching(new_processes):
+for pid in process_matcher.matching(initial_pids, scan_pool, new_processes.seen, new_processes.comms,
+                                    new_processes.parents):
     if pid not in watched_processes:
-        watched_processes[pid] = ProcessByPID(pid)
+        try:
+            watch(pid)
+        except NoProcessFound:
+            pass
+# Not needed anymore, don't keep them for every process until the next listing
+new_processes.comms.clear()
+new_processes.parents.clear()
 
 # Whether program needs to check for new processes matching conditions
 # Would a user ever watch for a specific PID number to recur?
-watch_new = args.watch_new and process_matcher.num_conditions > 0
+# A daemon keeps discovering since patterns can be added at any time.
+daemon = args.control is not None
+watch_new = (args.watch_new and process_matcher.num_conditions > 0) or daemon
+# Receives events from agents, set up with the other servers
+collector = None
 
-if not watched_processes and not watch_new:
+if not watching() and not ended_while_stopped and not args.collect:
     logging.warning('No processes found to watch.')
     sys.exit()
 
-logging.info('Watching {} processes:'.format(len(watched_processes)))
+if watched_processes or not watched_cgroups:
+    logging.info('Watching {} processes:'.format(len(watched_processes)))
 for pid, process in watched_processes.items():
     logging.info(process.info())
+if watched_cgroups:
+    logging.info('Watching {} cgroups:'.format(len(watched_cgroups)))
+for cgroup in watched_cgroups.values():
+    logging.info(cgroup.info())
+for tree in watched_trees.values():
+    logging.info(tree.info())
+
+
+if args.tag:
+    subject_template = '{executable} process {pid} ended' + ': {}'.format(args.tag)
+    cgroup_subject_template = '{name} cgroup emptied' + ': {}'.format(args.tag)
+    tree_subject_template = '{executable} process tree {pid} ended' + ': {}'.format(args.tag)
+    digest_subject_template = '{count} {executable} processes ended' + ': {}'.format(args.tag)
+    alert_subject_template = '{executable} process {pid} alert {text}' + ': {}'.format(args.tag)
+    resolved_subject_template = '{executable} process {pid} alert resolved {text}' + ': {}'.format(args.tag)
+else:
+    subject_template = '{executable} process {pid} ended'
+    cgroup_subject_template = '{name} cgroup emptied'
+    tree_subject_template = '{executable} process tree {pid} ended'
+    digest_subject_template = '{count} {executable} processes ended'
+    alert_subject_template = '{executable} process {pid} alert {text}'
+    resolved_subject_template = '{executable} process {pid} alert resolved {text}'
+
+
+@functools.lru_cache(maxsize=None)
+def spec_channels(spec):
+    """:return channels for notifications about the processes of a config spec, None for the default ones.
+    Its "to" and "channel" replace the default email and Slack channels."""
+    if not spec.to and not spec.channel:
+        return None
+    replaced = ({'email'} if spec.to else set()) | ({'slack'} if spec.channel else set())
+    channels = [channel for channel in dispatcher.default_channels if channel.name not in replaced]
+    if spec.to:
+        import communicate.email
+        channels.append(dispatcher.get_channel(communicate.email, {'to': list(spec.to)}, **network_options))
+    if spec.channel:
+        import communicate.slack
+        channels.append(dispatcher.get_channel(communicate.slack, {'channel': list(spec.channel)}, batch_delay=1.0,
+                                               **network_options))
+    return channels
+
+
+def notify(item, template):
+    """Queue notifications about a process, digest or alert on its channels.
+    Subjects start with the host for the ones from agents, and end with the tag of config specs."""
+    if getattr(item, 'host', None):
+        template = '{host}: ' + template
+    elif getattr(item, 'tag', None):
+        template += ': {tag}'
+    if isinstance(item, Digest):
+        process = item.processes[0]
+    else:
+        process = getattr(item, 'process', item)
+    spec = getattr(process, 'spec', None)
+    dispatcher.submit(item, template, spec_channels(spec) if spec is not None else None)
+
+
+def notify_ended(process):
+    """Log and queue notifications about an ended process."""
+    if metrics is not None:
+        metrics.process_ended(process)
+    if event_sinks:
+        emit_event('exit', process.ended, **process.as_dict())
+    logging.info('Process stopped\n%s', process.info())
+    if coalescer is None:
+        notify(process, subject_template)
+        return
+    group = coalescer.add(process, time_now())
+    if group is not None:
+        key, deadline = group
+        scheduler.schedule(('digest', key), deadline)
+
+
+def notify_group(item):
+    """Queue notifications about a group of ended processes from the coalescer."""
+    if isinstance(item, Digest):
+        logging.info('Sending digest about {} {} processes'.format(item.count, item.executable))
+        notify(item, digest_subject_template)
+    elif item is not None:
+        notify(item, subject_template)
+
+
+def notify_alert(alert):
+    """Log and queue notifications about an alert fired or resolved."""
+    if event_sinks:
+        emit_event('alert', pid=alert.pid, start_time=alert.start_time, rule=alert.text, value=alert.value,
+                   value_text=alert.value_text, resolved=alert.resolved, executable=alert.executable,
+                   command=alert.command)
+    if alert.resolved:
+        logging.info('Alert resolved\n%s', alert.info())
+        notify(alert, resolved_subject_template)
+    else:
+        logging.warning('Alert\n%s', alert.info())
+        notify(alert, alert_subject_template)
+
+
+def collected_event(host, event):
+    """Notify about a process ending or an alert on an agent's host"""
+    try:
+        if event['event'] == 'exit':
+            notify_ended(RemoteProcess.from_event(host, event))
+        elif event['event'] == 'alert':
+            notify_alert(RemoteAlert(host, event))
+    except:
+        logging.exception('Exception encountered while communicating about process {} on {}'
+                          .format(event.get('pid'), host))
+
+
+def process_ended(pid, exit_code=None):
+    """Stop watching a process that is known to have exited and notify about it."""
+    process = end_watch(pid)
+    if process is None:
+        return
+    try:
+        process.mark_ended(exit_code)
+        notify_ended(process)
+    except:
+        logging.exception('Exception encountered while communicating about process {}'.format(pid))
+
+
+def watch_new_processes():
+    """Add processes started since the last call to watched trees, and watch the
+    ones matching conditions if watching for new processes."""
+    start = time.perf_counter()
+    new_pids = list(new_processes)
+    if process_tree is not None:
+        added = process_tree.add(new_pids, new_processes.parents)
+        for tree in watched_trees.values():
+            tree.add_descendants(added)
+
+    matching = process_matcher.matching(new_pids, scan_pool, new_processes.seen, new_processes.comms,
+                                        new_processes.parents)
+    for pid in matching if watch_new else ():
+        if pid in watched_processes:
+            # proc events yield a PID again when it execs
+            continue
+        try:
+            p = watch(pid)
+            logging.info('watching new process\n%s', p.info())
+
+        except NoProcessFound:
+            # Short-lived process already gone
+            pass
+        except:
+            logging.exception('Exception encountered while attempting to watch new process {}'.format(pid))
+    if metrics is not None:
+        metrics.scan_seconds.observe(time.perf_counter() - start)
+
+
+def end_disappeared():
+    """Report watched processes that listing /proc found gone."""
+    disappeared = new_processes.disappeared
+    for pid, start_time in disappeared.items():
+        process = watched_processes.get(pid)
+        # Unless the PID was reused by the process being watched
+        if process is not None and process.start_time in (start_time, None):
+            process_ended(pid)
+    disappeared.clear()
+
+
+def end_exited():
+    """Report watched processes that proc connector exit events were read for (with their exit code).
+    Events are also read when iterating new_processes outside of handle_proc_events()."""
+    exited = new_processes.exited
+    for pid, event in exited.items():
+        if pid in watched_processes:
+            process_ended(pid, event.returncode)
+    exited.clear()
+
+
+def handle_proc_events():
+    """Read pending proc connector events: watch new matching processes and
+    report watched processes that exited (with their exit code)."""
+    if not (watch_new or watched_trees):
+        # Nothing to discover: only drain the socket for exit events of the
+        # watched processes, without listing /proc or reading new processes
+        for event in proc_events.read_events():
+            if event.what == PROC_EVENT_EXIT and event.is_process and event.pid in watched_processes:
+                process_ended(event.pid, event.returncode)
+        # What new_processes knows is stale once discovery starts, e.g. after a
+        # config reload, so it lists /proc again then
+        proc_events.overrun = True
+        return
+
+    watch_new_processes()
+    end_exited()
+    # /proc is listed again after events were lost
+    end_disappeared()
+
+
+def handle_pidfds():
+    """Report watched processes whose pidfd signalled exit."""
+    for pid in pidfds.read_exited():
+        process_ended(pid)
+
+
+def check_cgroup(cgroup):
+    """Check a watched cgroup and notify if it emptied.
+    :return True if it still has processes
+    """
+    try:
+        if cgroup.check():
+            return True
+    except Exception:
+        logging.exception('Exception encountered while checking cgroup {}'.format(cgroup.path))
+        end_watch_cgroup(cgroup.path)
+        return False
+
+    end_watch_cgroup(cgroup.path)
+    logging.info('cgroup emptied\n%s', cgroup.info())
+    try:
+        dispatcher.submit(cgroup, cgroup_subject_template)
+    except:
+        logging.exception('Exception encountered while communicating about cgroup {}'.format(cgroup.path))
+    return False
+
+
+def check_tree(tree):
+    """Check a watched process tree and notify if all of it ended.
+    :return True while any process in it is running
+    """
+    if tree.check(scan_pool):
+        return True
+
+    watched_trees.pop(tree.pid, None)
+    logging.info('Process tree ended\n%s', tree.info())
+    try:
+        dispatcher.submit(tree, tree_subject_template)
+    except:
+        logging.exception('Exception encountered while communicating about process tree {}'.format(tree.pid))
+    return False
+
+
+def handle_cgroup_events():
+    """Check watched cgroups whose cgroup.events changed."""
+    for path in cgroup_events.read_changed():
+        cgroup = watched_cgroups.get(path)
+        if cgroup is not None:
+            check_cgroup(cgroup)
+
+
+def watch_matching():
+    """Watch all running processes that match the conditions, e.g. after one was added.
+    :return list of PIDs newly watched
+    """
+    pids = []
+    # Processes not listed yet are matched when they are
+    # Processes matched before aren't read again
+    seen = new_processes.seen
+    if not seen:
+        # Not listed yet since nothing needed discovery before, e.g. a config reload added the first pattern
+        list(new_processes)
+    for pid in process_matcher.matching(list(seen), scan_pool, seen, new_processes.comms):
+        if pid not in watched_processes:
+            try:
+                watch(pid)
+                pids.append(pid)
+            except NoProcessFound:
+                pass
+    return pids
+
+
+def update_spec_watches(names, added):
+    """Update the watches of processes watched for changed config specs or, if specs were added, for none.
+    Processes no longer watched for anything stop being watched.
+
+    :param names: names of the specs added, removed or changed
+    :param added: whether specs were added or changed, so unaffected processes may match one now
+    """
+    now = time_now()
+    for pid, process in list(watched_processes.items()):
+        old = process.spec
+        if (old.name not in names) if old is not None else not added:
+            continue
+        spec = spec_of(pid)
+        if spec is None and old is not None and pid not in requested_pids \
+                and not process_matcher.matches(pid, process.start_time):
+            logging.info('No longer watching process {} ({} removed from config)'.format(pid, old.name))
+            end_watch(pid)
+            continue
+        if spec is not old:
+            set_spec(process, spec)
+            schedule_check(process, now)
+
+
+def reload_config():
+    """Read the config files again and change only the watches of the specs that changed"""
+    global config, watch_new
+    try:
+        new_config = Config(config.paths)
+    except ConfigError as err:
+        logging.error('{}, keeping the previous config'.format(err))
+        return
+    if (new_config.to, new_config.channel, new_config.alerts) != (config.to, config.channel, config.alerts):
+        logging.warning('Changes to "to", "channel" and "alerts" in the config take effect on restart')
+    added, removed, changed = new_config.diff(config)
+    old_specs = config.specs
+    config = new_config
+    if not (added or removed or changed):
+        return
+
+    for spec in removed + changed:
+        remove_spec(old_specs[spec.name])
+    for spec in added + changed:
+        add_spec(spec)
+    spec_channels.cache_clear()
+    update_spec_watches({spec.name for spec in added + removed + changed}, bool(added or changed))
+    discovering = watch_new
+    watch_new = (args.watch_new and process_matcher.num_conditions > 0) or daemon
+    if watch_new and not discovering:
+        scheduler.schedule(DISCOVER_TASK, time_now() + args.interval)
+    if added or changed:
+        # From the processes already listed, without listing /proc again
+        for pid in watch_matching():
+            logging.info('watching new process\n%s', watched_processes[pid].info())
+    logging.info('Reloaded config: {} added, {} removed, {} changed'.format(len(added), len(removed), len(changed)))
+
+
+def handle_config_change():
+    if config_watcher.changed():
+        reload_config()
+
+
+def pattern_command(function):
+    """Make a control command taking exactly one of wildcard, regex or match"""
+    def command(wildcard=None, regex=None, match=None):
+        if [wildcard, regex, match].count(None) != 2:
+            raise ControlError('Give one of "wildcard", "regex" or "match"')
+        return function(wildcard, regex, match)
+    return command
+
+
+def control_add_pid(pid):
+    pid = int(pid)
+    try:
+        process = watched_processes.get(pid) or watch(pid)
+    except NoProcessFound as err:
+        raise ControlError(str(err))
+    requested_pids.add(pid)
+    return process.as_dict()
+
+
+def control_remove_pid(pid):
+    """:return whether the PID was watched"""
+    return end_watch(int(pid)) is not None
+
+
+@pattern_command
+def control_add_pattern(wildcard, regex, match):
+    """:return PIDs of running processes that matched and are now watched"""
+    if wildcard is not None:
+        process_matcher.add_command_wildcard(wildcard)
+    elif match is not None:
+        try:
+            process_matcher.add_expression(match)
+        except ValueError as err:
+            raise ControlError(str(err))
+    else:
+        try:
+            process_matcher.add_command_regex(regex)
+        except re.error as err:
+            raise ControlError('Invalid regex {!r}: {}'.format(regex, err))
+    return watch_matching()
+
+
+@pattern_command
+def control_remove_pattern(wildcard, regex, match):
+    """Stop watching processes that no longer match any condition, unless requested by PID.
+    :return PIDs no longer watched
+    """
+    if wildcard is not None:
+        process_matcher.remove_command_wildcard(wildcard)
+    elif match is not None:
+        process_matcher.remove_expression(match)
+    else:
+        process_matcher.remove_command_regex(regex)
+
+    removed = [pid for pid in watched_processes
+               if pid not in requested_pids and not process_matcher.matches(pid)]
+    for pid in removed:
+        end_watch(pid)
+    return removed
+
+
+def control_list():
+    return {'pids': sorted(watched_processes), 'requested_pids': sorted(requested_pids),
+            'wildcards': process_matcher.command_wildcards, 'regexes': process_matcher.command_regexs,
+            'matches': process_matcher.expressions}
+
+
+def control_stats(pid=None):
+    """:return statistics of one watched process, or a list for all of them"""
+    if pid is None:
+        return [process.as_dict() for process in watched_processes.values()]
+    process = watched_processes.get(int(pid))
+    if process is None:
+        raise ControlError('PID {} is not watched'.format(pid))
+    return process.as_dict()
+
+
+def control_fleet():
+    """:return hosts sending events to this collector and their watched processes"""
+    if collector is None:
+        raise ControlError('Not collecting events from agents, see --collect')
+    return collector.fleet()
+
+
+metrics = metrics_server = None
+if args.metrics:
+    metrics = Metrics(watched_processes, dispatcher)
+    try:
+        metrics_server = MetricsServer(args.metrics, metrics)
+    except (OSError, ValueError) as err:
+        logging.error('Failed to serve metrics on {}: {}'.format(args.metrics, err))
+        sys.exit(1)
+    metrics_server.register(selector)
+    logging.info('Serving metrics on {}'.format(args.metrics))
+
+if args.collect:
+    try:
+        collector = Collector(args.collect, collected_event)
+    except (OSError, ValueError) as err:
+        logging.error('Failed to listen for agents on {}: {}'.format(args.collect, err))
+        sys.exit(1)
+    collector.register(selector)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    logging.info('Collecting events from agents on {}'.format(args.collect))
+
+control_server = None
+if daemon:
+    try:
+        control_server = ControlServer(args.control, {
+            'add_pid': control_add_pid, 'remove_pid': control_remove_pid,
+            'add_pattern': control_add_pattern, 'remove_pattern': control_remove_pattern,
+            'list': control_list, 'stats': control_stats,
+            'notifications': dispatcher.stats, 'fleet': control_fleet})
+    except OSError as err:
+        logging.error('Failed to listen on control socket {}: {}'.format(args.control, err))
+        sys.exit(1)
+    control_server.register(selector)
+    # Stopped by service managers with SIGTERM, exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    logging.info('Listening for commands on {}'.format(args.control))
+
+if proc_events is not None:
+    selector.register(proc_events, selectors.EVENT_READ, handle_proc_events)
+
+if pidfds is not None:
+    selector.register(pidfds, selectors.EVENT_READ, handle_pidfds)
+
+if cgroup_events is not None:
+    selector.register(cgroup_events, selectors.EVENT_READ, handle_cgroup_events)
+
+config_watcher = None
+if config is not None:
+    try:
+        config_watcher = ConfigWatcher(config.paths)
+        selector.register(config_watcher, selectors.EVENT_READ, handle_config_change)
+    except OSError as err:
+        logging.warning('Failed to watch config for changes, restart to apply them. ({})'.format(err))
+
+
+def wait_until(deadline):
+    """Sleep until the deadline, handling events as they arrive."""
+    if not selector.get_map():
+        time.sleep(max(0.0, deadline - time_now()))
+        return
+
+    while True:
+        timeout = None if deadline is None else deadline - time_now()
+        if timeout is not None and timeout <= 0:
+            break
+        for key, _ in selector.select(timeout):
+            key.data()
+
+        # A handler may have scheduled something sooner, e.g. a digest
+        next_deadline = scheduler.next_deadline()
+        if next_deadline is not None and (deadline is None or next_deadline < deadline):
+            break
+
+        if not watching():
+            break
+
+
+if watch_new or watched_trees:
+    scheduler.schedule(DISCOVER_TASK, time_now() + args.interval)
+
+CHECKPOINT_TASK = 'checkpoint'
+if state is not None:
+    state.checkpoint(watched_processes, requested_pids, time_now())
+    scheduler.schedule(CHECKPOINT_TASK, time_now() + args.state_interval)
+
+for process in ended_while_stopped:
+    notify_ended(process)
 
 try:
-    to_delete = []
     while True:
-        time.sleep(args.interval)
-        # Need to iterate copy since removing within loop.
-        for pid, process in watched_processes.items():
-            try:
-                running = process.check()
-                if not running:
-                    to_delete.append(pid)
+        if not watching():
+            sys.exit()
 
-                    logging.info('Process stopped\n%s', process.info())
+        wait_until(scheduler.next_deadline())
 
-                    for comm, send_args in comms:
-                        if args.tag:
-                            template = '{executable} process {pid} ended' + ': {}'.format(args.tag)
-                        else:
-                            template = '{executable} process {pid} ended'
+        # Check the processes due, together in one pass
+        if metrics is not None:
+            metrics.start_tick()
+        now = time_now()
+        due = scheduler.pop_due(now)
 
-                        comm.send(process=process, subject_format=template, **send_args)
+        due_trees = [watched_trees[task[1]] for task in due
+                     if isinstance(task, tuple) and task[0] == 'tree' and task[1] in watched_trees]
+        # Only when discovery or a tree is due, not on each wakeup for the checks:
+        # a due process's own stat read finds that it ended
+        if (watch_new or watched_trees) and (DISCOVER_TASK in due or due_trees):
+            # One listing of /proc finds both the new processes (trees need the
+            # ones started since they were last checked) and the ended ones,
+            # which are reported without reading anything of theirs
+            watch_new_processes()
+            # Exit events read while iterating for new processes, before the
+            # checks below find those processes gone without their exit code
+            end_exited()
+            end_disappeared()
+            if watch_new or watched_trees:
+                scheduler.schedule(DISCOVER_TASK, now + args.interval)
 
+        processes = [watched_processes[pid] for pid in due if pid in watched_processes]
+
+        start = time.perf_counter()
+        ended, errors = check_all(processes, scan_pool)
+        if metrics is not None:
+            metrics.check_seconds.observe(time.perf_counter() - start)
+        for process in ended:
+            end_watch(process.pid)
+            try:
+                notify_ended(process)
             except:
-                logging.exception('Exception encountered while checking or communicating about process {}'.format(pid))
+                logging.exception('Exception encountered while communicating about process {}'.format(process.pid))
 
-                if pid not in to_delete:
-                    # Exception raised in check(), queue PID to be deleted
-                    to_delete.append(pid)
+        for process, err in errors:
+            logging.error('Exception encountered while checking process {}'.format(process.pid), exc_info=err)
+            end_watch(process.pid)
 
-        if to_delete:
-            for pid in to_delete:
-                del watched_processes[pid]
+        checked = [process for process in processes if process.running and process.pid in watched_processes]
+        for process in checked:
+            schedule_check(process, now)
+        for sink in event_sinks:
+            sink.samples(checked, now)
 
-            to_delete.clear()
+        # All rules over all the new samples at once
+        for alert in alert_rules.evaluate(checked, now):
+            try:
+                notify_alert(alert)
+            except:
+                logging.exception('Exception encountered while communicating about alert on process {}'
+                                  .format(alert.pid))
 
-        if watch_new:
-            for pid in process_matcher.matching(new_processes):
-                try:
-                    watched_processes[pid] = p = ProcessByPID(pid)
-                    logging.info('watching new process\n%s', p.info())
+        # Without inotify this is also what finds emptied cgroups
+        for task in due:
+            if isinstance(task, tuple) and task[0] == 'cgroup' and task[1] in watched_cgroups:
+                if check_cgroup(watched_cgroups[task[1]]):
+                    scheduler.schedule(task, now + args.interval)
 
+        for tree in due_trees:
+            if check_tree(tree):
+                scheduler.schedule(('tree', tree.pid), now + min_interval)
+
+        for task in due:
+            if isinstance(task, tuple) and task[0] == 'digest':
+                try:
+                    notify_group(coalescer.pop(task[1]))
                 except:
-                    logging.exception('Exception encountered while attempting to watch new process {}'.format(pid))
+                    logging.exception('Exception encountered while communicating about {} processes'
+                                      .format(task[1][0]))
 
-        elif not watched_processes:
-            sys.exit()
+        if CHECKPOINT_TASK in due:
+            try:
+                state.checkpoint(watched_processes, requested_pids, now)
+            except Exception:
+                logging.exception('Failed to save state to {}'.format(args.state))
+            scheduler.schedule(CHECKPOINT_TASK, now + args.state_interval)
+
+        if metrics is not None:
+            metrics.end_tick()
 
 except KeyboardInterrupt:
     # Force command prompt onto new line
     print()
+
+finally:
+    # Don't wait for the digest windows to end
+    if coalescer is not None:
+        for item in coalescer.pop_all():
+            notify_group(item)
+    # Retries and their backoff (or a server's Retry-After) could take much
+    # longer than --notify-timeout, so what isn't sent by then is dropped
+    if dispatcher.depth:
+        logging.info('Waiting for {} notifications to be sent...'.format(dispatcher.depth))
+    dispatcher.close(timeout=SHUTDOWN_NOTIFY_TIMEOUTS * args.notify_timeout)
+    if dispatcher.pending:
+        logging.warning('Dropped {} notifications not sent within {:g} seconds of exiting'
+                        .format(dispatcher.pending, SHUTDOWN_NOTIFY_TIMEOUTS * args.notify_timeout))
+    for sink in event_sinks:
+        sink.close()
+    if collector is not None:
+        collector.close()
+    if config_watcher is not None:
+        config_watcher.close()
+    if state is not None:
+        state.checkpoint(watched_processes, requested_pids, time_now())
+        state.close()
+    if control_server is not None:
+        control_server.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    if scan_pool is not None:
+        scan_pool.close()
+    if proc_events is not None:
+        proc_events.close()
+    if pidfds is not None:
+        pidfds.close()
+    if cgroup_events is not None:
+        cgroup_events.close()
+    for stats in dispatcher.stats():
+        logging.debug('Notification stats: {}'.format(stats))
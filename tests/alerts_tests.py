@@ -0,0 +1,109 @@
+import unittest
+
+from process import ProcessByPID
+from process.alerts import AlertRule, AlertRules
+
+
+def make_process(pid, rss=0, cpu_percent=0.0):
+    """:return ProcessByPID not backed by /proc"""
+    process = ProcessByPID.from_dict({'pid': pid, 'start_time': pid, 'command': 'app --pid {}'.format(pid),
+                                      'executable': 'app', 'created': 0, 'status': {'VmRSS': rss}, 'io': {},
+                                      'user_seconds': 0, 'system_seconds': 0})
+    process.cpu_percent = cpu_percent
+    return process
+
+
+def sample(process, now, rss):
+    process.status['VmRSS'] = rss
+    process.history.append(now, rss, 0, 0)
+
+
+class AlertRuleTests(unittest.TestCase):
+
+    def test_parse(self):
+        rule = AlertRule('rss > 8GB')
+        self.assertEqual(rule.threshold, 8 * 1024 ** 2)
+        self.assertEqual(rule.clear_threshold, 8 * 1024 ** 2 * 0.9)
+
+        rule = AlertRule('rss  growth > 50% in 5m')
+        self.assertEqual((rule.threshold, rule.window, rule.relative), (50, 300, True))
+        self.assertEqual(rule.text, 'rss growth > 50% in 5m')
+
+        rule = AlertRule('cpu < 1% for 10m clear 5%')
+        self.assertEqual((rule.threshold, rule.duration, rule.clear_threshold), (1, 600, 5))
+
+        self.assertEqual(AlertRule('write_rate >= 2MB/s').threshold, 2 * 1024 ** 2)
+
+    def test_invalid(self):
+        for text in ('rss', 'rss > lots', 'heat > 5', 'rss > 5%', 'cpu growth > 5 in 1m', 'rss growth > 5%',
+                     'rss > 5 in 1m', 'rss > 5 parsecs'):
+            self.assertRaises(ValueError, AlertRule, text)
+
+
+class AlertRulesTests(unittest.TestCase):
+
+    def test_threshold_hysteresis(self):
+        rules = AlertRules()
+        rules.add('rss > 1000')
+        processes = [make_process(1, rss=500), make_process(2, rss=1500)]
+
+        fired = rules.evaluate(processes, 100)
+        self.assertEqual([(alert.pid, alert.resolved) for alert in fired], [(2, False)])
+        self.assertIn('Alert rss > 1000: 1,500 kB', fired[0].info())
+        # Fires once
+        self.assertEqual(rules.evaluate(processes, 110), [])
+
+        # Inside the hysteresis band: still active
+        processes[1].status['VmRSS'] = 950
+        self.assertEqual(rules.evaluate(processes, 120), [])
+        processes[1].status['VmRSS'] = 800
+        resolved = rules.evaluate(processes, 130)
+        self.assertEqual(resolved, fired)
+        self.assertTrue(resolved[0].resolved)
+        self.assertEqual(rules.active(), [])
+
+    def test_duration(self):
+        rules = AlertRules()
+        rules.add('cpu < 1% for 10m')
+        process = make_process(1, cpu_percent=0.0)
+
+        self.assertEqual(rules.evaluate([process], 0), [])
+        self.assertEqual(rules.evaluate([process], 300), [])
+        # Condition broken, the duration starts again
+        process.cpu_percent = 50.0
+        self.assertEqual(rules.evaluate([process], 400), [])
+        process.cpu_percent = 0.0
+        self.assertEqual(rules.evaluate([process], 500), [])
+        self.assertEqual(rules.evaluate([process], 1000), [])
+        self.assertEqual(len(rules.evaluate([process], 1100)), 1)
+
+        # Not checked this tick: nothing changes
+        self.assertEqual(rules.evaluate([make_process(2, cpu_percent=5.0)], 1200), [])
+        self.assertEqual(len(rules.active()), 1)
+
+        rules.forget(1)
+        self.assertEqual(rules.active(), [])
+
+    def test_growth(self):
+        rules = AlertRules()
+        relative = rules.add('rss growth > 50% in 5m')
+        absolute = rules.add('rss growth > 1MB in 5m')
+        process = make_process(1)
+        for t, rss in ((0, 1000), (60, 1100), (120, 1200), (300, 1400)):
+            sample(process, t, rss)
+        self.assertEqual(rules.evaluate([process], 300), [])
+
+        sample(process, 360, 1700)
+        fired = rules.evaluate([process], 360)
+        # 1700 kB now against 1100 kB at 60 s
+        self.assertEqual([alert.rule for alert in fired], [relative])
+        self.assertEqual(fired[0].value_text, '+55%')
+
+        sample(process, 420, 2300)
+        fired = rules.evaluate([process], 420)
+        self.assertEqual([alert.rule for alert in fired], [absolute])
+        self.assertEqual(fired[0].value_text, '+1,100 kB')
+
+
+if __name__ == '__main__':
+    unittest.main()
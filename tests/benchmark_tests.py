@@ -0,0 +1,105 @@
+import unittest
+import os
+
+import process
+from process import *
+from benchmarks.fakeproc import FakeProc
+from benchmarks.watcher_bench import run
+from benchmarks import memory_bench
+from process.parallel import ShardPool
+from process.tree import ProcessTree
+
+
+class FakeProcTests(unittest.TestCase):
+    """Test the watcher against a synthetic /proc tree"""
+
+    def setUp(self):
+        self.fake = FakeProc(seed=1)
+        process.PROC_DIR = self.fake.path
+
+    def tearDown(self):
+        process.PROC_DIR = '/proc'
+        self.fake.cleanup()
+
+    def test_watch_fake_processes(self):
+        self.fake.populate(20)
+        worker = self.fake.add(comm='worker', cmdline=['worker', '--id', '1'])
+
+        processes = ProcessIDs()
+        self.assertEqual(sorted(processes), sorted(self.fake.pids))
+
+        matcher = ProcessMatcher()
+        matcher.add_command_wildcard('work*')
+        self.assertIn(worker, list(matcher.matching(self.fake.pids)))
+
+        p = ProcessByPID(worker)
+        self.assertEqual(p.command, 'worker --id 1')
+        self.assertGreater(p.status['VmRSS'], 0)
+        self.assertGreater(p.utime, 0)
+
+        self.fake.remove(worker)
+        self.assertEqual(check_all([p]), ([p], []))
+
+    def test_stat_read_once(self):
+        """Listing /proc reads the stat of new PIDs once for matching them and adding them to a tree"""
+        self.fake.populate(300)
+        matcher = ProcessMatcher()
+        matcher.add_command_wildcard('work*')
+        tree = ProcessTree()
+        pool = ShardPool(4, min_shard_size=10)
+        try:
+            for processes in (ProcessIDs(), ProcessIDs(pool=pool)):
+                opened = counters['files_opened']
+                pids = list(processes)
+                tree.add(pids, processes.parents)
+                matched = list(matcher.matching(pids, None, processes.seen, processes.comms, processes.parents))
+                self.assertEqual(counters['files_opened'], opened + 300)
+                self.assertEqual(len(tree.parents), 300)
+                self.assertEqual(matched, [pid for pid in pids if processes.comms[pid].startswith('work')])
+
+                removed, added = self.fake.churn(20)
+                matcher_checks = counters['matcher_checks']
+                opened = counters['files_opened']
+                pids = list(processes)
+                tree.add(pids, processes.parents)
+                list(matcher.matching(pids, None, processes.seen, processes.comms, processes.parents))
+                self.assertEqual(sorted(pids), sorted(added))
+                self.assertEqual(sorted(processes.disappeared), sorted(removed))
+                self.assertEqual(counters['files_opened'], opened + 20)
+                self.assertEqual(counters['matcher_checks'], matcher_checks + 20)
+                for pid in removed:
+                    tree.remove(pid)
+                    matcher.forget(pid)
+        finally:
+            pool.close()
+
+    def test_keep_open_ended_between_opens(self):
+        pid = self.fake.add()
+        # As if the process ended after status and stat were opened
+        os.remove(os.path.join(self.fake.path, str(pid), 'io'))
+        fds = len(os.listdir('/proc/self/fd'))
+        ProcessByPID.keep_open = True
+        try:
+            self.assertRaises(NoProcessFound, ProcessByPID, pid)
+        finally:
+            ProcessByPID.keep_open = False
+        self.assertEqual(len(os.listdir('/proc/self/fd')), fds)
+
+    def test_benchmark_report(self):
+        report = run(30, watched=10, repeat=1)
+        self.assertEqual(report['pids'], 30)
+        self.assertEqual(set(report['results']), {'process_ids_scan', 'process_ids_rescan', 'matcher_matching',
+                                                  'process_check', 'alert_evaluate', 'main_loop_tick'})
+        self.assertEqual(report['results']['process_check']['items'], 10)
+
+    def test_memory_report(self):
+        report = memory_bench.run(20, histories=(1, 10))
+        small, large = report['results']
+        self.assertEqual((small['watched'], large['watched']), (20, 20))
+        self.assertGreater(small['record_bytes_per_process'], 0)
+        self.assertGreater(large['history_bytes_per_process'], small['history_bytes_per_process'])
+        self.assertEqual(process.PROC_DIR, '/proc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from process.cgroup import CgroupByPath, CgroupWatcher, NoCgroupFound
+
+
+class CgroupTests(unittest.TestCase):
+    """Test cgroup watching against a fake cgroup directory"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write('cgroup.events', 'populated 1\nfrozen 0\n')
+        self.write('cgroup.procs', '100\n101\n102\n')
+        self.write('memory.current', '4096\n')
+        self.write('cpu.stat', 'usage_usec 1500000\nuser_usec 1000000\nsystem_usec 500000\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write(self, name, text):
+        with open(os.path.join(self.path, name), 'w') as f:
+            f.write(text)
+
+    def test_stats(self):
+        cgroup = CgroupByPath(self.path)
+        self.assertTrue(cgroup.running)
+        self.assertEqual(cgroup.processes, 3)
+        self.assertEqual(cgroup.memory_current, 4096)
+        # No memory.peak, highest value seen instead
+        self.assertEqual(cgroup.memory_peak, 4096)
+        self.assertEqual((cgroup.user_seconds, cgroup.system_seconds), (1.0, 0.5))
+        self.assertIn('3 processes', cgroup.info())
+
+        self.write('memory.current', '1024\n')
+        self.write('memory.peak', '8192\n')
+        self.assertTrue(cgroup.check())
+        self.assertEqual((cgroup.memory_current, cgroup.memory_peak), (1024, 8192))
+
+        self.write('cgroup.events', 'populated 0\nfrozen 0\n')
+        self.assertFalse(cgroup.check())
+        self.assertFalse(cgroup.running)
+        self.assertIn('emptied', cgroup.info())
+        self.assertEqual('{name} cgroup emptied'.format(**cgroup.__dict__), self.path + ' cgroup emptied')
+
+    def test_not_cgroup(self):
+        os.remove(os.path.join(self.path, 'cgroup.events'))
+        self.assertRaises(NoCgroupFound, CgroupByPath, self.path)
+
+    def test_watcher(self):
+        cgroup = CgroupByPath(self.path)
+        watcher = CgroupWatcher()
+        watcher.add(cgroup)
+        self.assertIn(cgroup.path, watcher)
+        self.assertEqual(watcher.read_changed(), [])
+
+        self.write('cgroup.events', 'populated 0\nfrozen 0\n')
+        self.assertEqual(watcher.read_changed(), [cgroup.path])
+        self.assertFalse(cgroup.check())
+
+        # Removing the group removes the watch
+        shutil.rmtree(self.path)
+        self.assertEqual(watcher.read_changed(), [cgroup.path])
+        self.assertEqual(len(watcher), 0)
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import json
+import os
+import select
+import shutil
+import subprocess
+import tempfile
+
+from process import ProcessMatcher, read_start_time
+from process.config import Config, ConfigError, ConfigWatcher, WatchSpec
+
+
+class ConfigTests(unittest.TestCase):
+    """Test parsing config files into watch specs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'config.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, data, path=None):
+        with open(path or self.path, 'w') as f:
+            json.dump(data, f)
+
+    def test_example_config(self):
+        """The example config.json, with empty strings for unset fields"""
+        config = Config([os.path.join(os.path.dirname(__file__), '..', 'config.json')])
+        self.assertEqual(list(config.specs), ['dropbox', 'capture RV and sync'])
+        spec = config.specs['dropbox']
+        self.assertEqual((spec.pids, spec.command, spec.regex, spec.to), ((), 'dropbox', '', ()))
+        self.assertEqual(config.to, ())
+
+    def test_specs(self):
+        self.write({'to': 'ops@example.com', 'alerts': ['rss > 1GB'], 'processes': [
+            {'name': 'workers', 'command': 'work*', 'regex': '(?i)JOB-\\d+', 'interval': 5, 'to': ['team@example.com'],
+             'tag': 'batch'},
+            {'pid': [12, '34']}]})
+        config = Config([self.path])
+        self.assertEqual((config.to, config.alerts), (('ops@example.com',), ('rss > 1GB',)))
+        workers = config.specs['workers']
+        self.assertEqual((workers.interval, workers.to, workers.tag), (5.0, ('team@example.com',), 'batch'))
+        self.assertTrue(workers.matches('worker'))
+        self.assertTrue(workers.matches('job-12'))
+        self.assertFalse(workers.matches('job-12x'))
+        self.assertEqual(config.specs['12'].pids, (12, 34))
+
+    def test_invalid(self):
+        for data in ({'processes': [{'command': 'a', 'colour': 'red'}]},
+                     {'processes': [{'regex': '('}]}, {'processes': [{'command': 'a', 'interval': -1}]},
+                     {'processes': [{'command': 'a'}, {'command': 'a'}]}, {'process': []}, []):
+            self.write(data)
+            self.assertRaises(ConfigError, Config, [self.path])
+        self.assertRaises(ConfigError, Config, [os.path.join(self.directory, 'missing.json')])
+
+    def test_diff(self):
+        self.write({'processes': [{'command': 'a'}, {'command': 'b'}, {'name': 'c', 'command': 'c'}]})
+        old = Config([self.path])
+        self.write({'processes': [{'command': 'a'}, {'name': 'c', 'command': 'c', 'interval': 5},
+                                  {'command': 'd'}]})
+        new = Config([self.path])
+        added, removed, changed = new.diff(old)
+        self.assertEqual([spec.name for spec in added], ['d'])
+        self.assertEqual([spec.name for spec in removed], ['b'])
+        self.assertEqual(changed, [new.specs['c']])
+        self.assertEqual(new.diff(Config([self.path])), ([], [], []))
+
+    def test_watcher(self):
+        self.write({'processes': []})
+        try:
+            watcher = ConfigWatcher([self.path])
+        except OSError:
+            self.skipTest('inotify not available')
+        try:
+            self.write({'processes': []}, os.path.join(self.directory, 'other.json'))
+            self.assertFalse(watcher.changed())
+
+            # Replaced the way editors save files
+            new_path = self.path + '.new'
+            self.write({'processes': [{'command': 'a'}]}, new_path)
+            os.replace(new_path, self.path)
+            self.assertTrue(select.select([watcher], [], [], 5)[0])
+            self.assertTrue(watcher.changed())
+            self.assertFalse(watcher.changed())
+        finally:
+            watcher.close()
+
+
+class SpecMatcherTests(unittest.TestCase):
+    """Test matching processes by watch specs"""
+
+    def test_specs(self):
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        pid = sleep_process.pid
+        try:
+            matcher = ProcessMatcher()
+            matcher.add_command_wildcard('sle*')
+            self.assertTrue(matcher.matches(pid))
+            self.assertIsNone(matcher.spec_for(pid))
+
+            # Matched by the cached command name, not read again
+            spec = WatchSpec.from_dict({'name': 'sleepers', 'regex': 's.eep'})
+            matcher.add_spec(spec)
+            self.assertEqual(matcher.num_conditions, 2)
+            self.assertIs(matcher.spec_for(pid), spec)
+            start_time = read_start_time(pid)
+        finally:
+            sleep_process.kill()
+            sleep_process.communicate()
+        self.assertTrue(matcher.matches(pid, start_time))
+        self.assertFalse(matcher.matches(pid))
+
+        self.assertIs(matcher.remove_spec('sleepers'), spec)
+        self.assertIsNone(matcher.remove_spec('sleepers'))
+        self.assertEqual(matcher.num_conditions, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
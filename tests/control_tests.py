@@ -0,0 +1,76 @@
+import unittest
+import os
+import selectors
+import socket
+import tempfile
+import threading
+
+from process.control import ControlServer, ControlError, request
+
+
+class ControlTests(unittest.TestCase):
+    """Test the Unix socket control API"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control.sock')
+        self.pids = set()
+        commands = {'add_pid': self.add_pid, 'list': lambda: sorted(self.pids), 'fail': lambda: 1 / 0}
+        self.server = ControlServer(self.path, commands)
+        self.selector = selectors.DefaultSelector()
+        self.server.register(self.selector)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def add_pid(self, pid):
+        if pid < 0:
+            raise ControlError('Bad PID')
+        self.pids.add(pid)
+        return pid
+
+    def serve(self):
+        while self.running:
+            for key, _ in self.selector.select(0.05):
+                key.data()
+
+    def tearDown(self):
+        self.running = False
+        self.thread.join()
+        self.server.close()
+        self.selector.close()
+        self.assertFalse(os.path.exists(self.path))
+        os.rmdir(self.directory)
+
+    def test_commands(self):
+        self.assertEqual(request(self.path, 'add_pid', pid=5), 5)
+        self.assertEqual(request(self.path, 'list'), [5])
+
+        with self.assertRaisesRegex(ControlError, 'Bad PID'):
+            request(self.path, 'add_pid', pid=-1)
+        with self.assertRaisesRegex(ControlError, 'unexpected keyword'):
+            request(self.path, 'add_pid', pid=1, other=2)
+        with self.assertRaisesRegex(ControlError, 'Unknown command'):
+            request(self.path, 'remove_pid', pid=1)
+        with self.assertRaisesRegex(ControlError, 'ZeroDivisionError'):
+            request(self.path, 'fail')
+
+    def test_pipelined_requests(self):
+        """Several requests in one packet, and a request split across packets"""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(self.path)
+            sock.sendall(b'{"command": "add_pid", "pid": 1}\n\nnot json\n{"command": "add_')
+            sock.sendall(b'pid", "pid": 2}\n{"command": "list"}\n')
+            with sock.makefile('r') as f:
+                responses = [f.readline() for _ in range(4)]
+
+        self.assertEqual(responses[0], '{"ok": true, "result": 1}\n')
+        self.assertIn('"ok": false', responses[1])
+        self.assertEqual(responses[2], '{"ok": true, "result": 2}\n')
+        self.assertEqual(responses[3], '{"ok": true, "result": [1, 2]}\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from datetime import datetime
+
+from process import ProcessByPID
+from communicate.digest import Coalescer, Digest, distribution
+
+
+def ended_process(pid, executable, seconds, peak, exit_code=None):
+    """:return ended ProcessByPID not backed by /proc"""
+    process = ProcessByPID.from_dict({'pid': pid, 'start_time': pid, 'command': executable, 'executable': executable,
+                                      'created': 1000, 'status': {'VmHWM': peak}, 'io': {},
+                                      'user_seconds': 0, 'system_seconds': 0})
+    process.mark_ended(exit_code, datetime.fromtimestamp(1000 + seconds))
+    return process
+
+
+class DigestTests(unittest.TestCase):
+
+    def test_distribution(self):
+        self.assertEqual(distribution([5]), (5, 5, 5, 5))
+        self.assertEqual(distribution(list(range(100, 0, -1))), (1, 51, 96, 100))
+
+    def test_coalesce(self):
+        coalescer = Coalescer(30)
+        self.assertEqual(coalescer.add(ended_process(1, 'worker', 10, 1000, 0), 100), (('worker', None), 130))
+        self.assertIsNone(coalescer.add(ended_process(2, 'worker', 20, 3000, 1), 110))
+        self.assertIsNone(coalescer.add(ended_process(3, 'worker', 30, 2000, 0), 120))
+        self.assertEqual(coalescer.add(ended_process(4, 'db', 60, 5000), 120), (('db', None), 150))
+        self.assertEqual(len(coalescer), 4)
+
+        digest = coalescer.pop(('worker', None))
+        self.assertIsInstance(digest, Digest)
+        self.assertEqual(digest.pids, [1, 2, 3])
+        self.assertEqual('{count} {executable} processes ended'.format(**digest.__dict__), '3 worker processes ended')
+        info = digest.info()
+        self.assertIn('Duration min/median/p95/max: 0:00:10 / 0:00:20 / 0:00:30 / 0:00:30', info)
+        self.assertIn('Resident memory peak min/median/p95/max: 1,000 / 2,000 / 3,000 / 3,000 kB', info)
+        self.assertIn('Exit codes: 0: 2, 1: 1', info)
+        self.assertIsNone(coalescer.pop(('worker', None)))
+
+        # Alone in its group: sent as it is
+        db, = coalescer.pop_all()
+        self.assertEqual(db.pid, 4)
+        self.assertEqual(len(coalescer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
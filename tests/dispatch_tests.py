@@ -0,0 +1,162 @@
+import unittest
+import threading
+import time
+import types
+
+from communicate.dispatch import Dispatcher, TokenBucket, parse_rate
+
+
+class FakeProcess:
+    pid = 1234
+    executable = 'fake'
+
+
+def fake_module(send):
+    module = types.ModuleType('communicate.fake')
+    module.send = send
+    return module
+
+
+class DispatchTests(unittest.TestCase):
+    """Test background notification delivery"""
+
+    def test_delivery_and_stats(self):
+        sent = []
+        dispatcher = Dispatcher()
+        dispatcher.add_channel(fake_module(lambda process, subject_format, to: sent.append((process.pid, to))),
+                               {'to': ['a@b']}, workers=2)
+        for _ in range(5):
+            dispatcher.submit(FakeProcess())
+        self.assertTrue(dispatcher.close(timeout=5))
+
+        self.assertEqual(sent, [(1234, ['a@b'])] * 5)
+        stats, = dispatcher.stats()
+        self.assertEqual(stats['channel'], 'fake')
+        self.assertEqual(stats['sent'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreaterEqual(stats['latency_max'], stats['latency_mean'])
+
+    def test_routed_channels(self):
+        sent = []
+        module = fake_module(lambda process, subject_format, to: sent.append(to))
+        dispatcher = Dispatcher()
+        default = dispatcher.add_channel(module, {'to': ['all@b']})
+        team = dispatcher.get_channel(module, {'to': ['team@b']})
+        self.assertIs(dispatcher.get_channel(module, {'to': ['team@b']}), team)
+        self.assertIs(dispatcher.get_channel(module, {'to': ['all@b']}), default)
+        self.assertEqual(dispatcher.default_channels, [default])
+
+        dispatcher.submit(FakeProcess())
+        dispatcher.submit(FakeProcess(), channels=[team])
+        self.assertTrue(dispatcher.close(timeout=5))
+        self.assertEqual(sorted(sent), [['all@b'], ['team@b']])
+        self.assertEqual(len(dispatcher.stats()), 2)
+
+    def test_retry_with_backoff(self):
+        attempts = []
+        done = threading.Event()
+
+        def flaky_send(process, subject_format, timeout):
+            attempts.append(timeout)
+            if len(attempts) < 3:
+                raise OSError('connection refused')
+            done.set()
+
+        dispatcher = Dispatcher()
+        channel = dispatcher.add_channel(fake_module(flaky_send), timeout=7, retries=3, backoff=0.01)
+        dispatcher.submit(FakeProcess())
+        self.assertTrue(done.wait(5))
+        dispatcher.close(timeout=5)
+
+        self.assertEqual(attempts, [7, 7, 7])
+        self.assertEqual((channel.sent, channel.retried, channel.failed), (1, 2, 0))
+
+    def test_give_up_and_drop(self):
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def blocking_send(process, subject_format):
+            blocked.set()
+            release.wait(5)
+            raise OSError('down')
+
+        dispatcher = Dispatcher()
+        channel = dispatcher.add_channel(fake_module(blocking_send), retries=0, queue_size=1)
+        dispatcher.submit(FakeProcess())
+        blocked.wait(5)
+        # Worker busy: one job fits in the queue, the next is dropped instead of blocking
+        dispatcher.submit(FakeProcess())
+        dispatcher.submit(FakeProcess())
+        self.assertEqual(channel.dropped, 1)
+
+        release.set()
+        dispatcher.close(timeout=5)
+        self.assertEqual(channel.failed, 2)
+
+    def test_close_timeout(self):
+        """Retries waiting for a long backoff don't hold up close() past its timeout"""
+        dispatcher = Dispatcher()
+        dispatcher.add_channel(fake_module(lambda process, subject_format: 1 / 0), retries=3, backoff=60)
+        dispatcher.submit(FakeProcess())
+        dispatcher.submit(FakeProcess())
+
+        start = time.monotonic()
+        self.assertFalse(dispatcher.close(timeout=0.2))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(dispatcher.pending, 2)
+
+    def test_on_result(self):
+        results = []
+
+        def send(process, subject_format):
+            if process.pid == 1:
+                raise OSError('down')
+
+        dispatcher = Dispatcher()
+        dispatcher.add_channel(fake_module(send), retries=0)
+        # Set after the channel was added
+        dispatcher.on_result = lambda channel, job, error: results.append((channel, job.process.pid, str(error)))
+        failing = FakeProcess()
+        failing.pid = 1
+        dispatcher.submit(failing)
+        dispatcher.submit(FakeProcess())
+        dispatcher.close(timeout=5)
+        self.assertEqual(results, [('fake', 1, 'down'), ('fake', 1234, 'None')])
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/m'), (10 / 60, 10))
+        self.assertEqual(parse_rate('2'), (2, 2))
+        for text in ('ten/m', '10/w', '0/s'):
+            self.assertRaises(ValueError, parse_rate, text)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, burst=2)
+        self.assertEqual(bucket.try_take(), 0)
+        self.assertEqual(bucket.try_take(), 0)
+        self.assertGreater(bucket.try_take(), 0)
+        stop = threading.Event()
+        stop.set()
+        self.assertTrue(bucket.take())
+        bucket.rate = 0.001
+        self.assertFalse(bucket.take(stop))
+
+    def test_rate_limit(self):
+        sent = []
+        dispatcher = Dispatcher()
+        channel = dispatcher.add_channel(fake_module(lambda process, subject_format: sent.append(time.monotonic())),
+                                         rate_limit=(20, 2))
+        for _ in range(4):
+            dispatcher.submit(FakeProcess())
+        for _ in range(100):
+            if len(sent) == 4:
+                break
+            time.sleep(0.01)
+        dispatcher.close(timeout=5)
+        self.assertEqual(len(sent), 4)
+        # Burst of 2, then 20 per second
+        self.assertGreaterEqual(sent[3] - sent[0], 0.09)
+        self.assertEqual(channel.stats()['rate_limited'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import socketserver
+import threading
+import time
+
+import communicate.email
+from communicate.email import SMTPPool
+from communicate.dispatch import Dispatcher
+
+
+class FakeProcess:
+    def __init__(self):
+        self.pid = 1234
+        self.executable = 'fake'
+
+    def info(self):
+        return 'PID 1234: fake'
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept messages"""
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.wfile.write(b'220 localhost ESMTP fake\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.wfile.write(b'250 localhost\r\n')
+            elif command == b'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    lines.append(line)
+                server.messages.append(b''.join(lines))
+                self.wfile.write(b'250 queued\r\n')
+                if server.drop_after_message:
+                    server.drop_after_message = False
+                    return
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                # MAIL, RCPT, NOOP, RSET
+                self.wfile.write(b'250 ok\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = 0
+        self.messages = []
+        self.drop_after_message = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class EmailTests(unittest.TestCase):
+    """Test email sending against a local SMTP stand-in"""
+
+    def setUp(self):
+        self.server = FakeSMTPServer()
+
+    def tearDown(self):
+        communicate.email.close_pools()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send(self):
+        communicate.email.send(to=['a@b'], process=FakeProcess(), host='127.0.0.1', port=self.server.port)
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.send()
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+        self.assertIn(b'Subject: [VTAG0 ALERT]fake process 1234 ended', self.server.messages[0])
+
+    def test_reconnect_when_dropped(self):
+        self.server.drop_after_message = True
+        self.send()
+        self.send()
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_idle_connection_replaced(self):
+        pool = SMTPPool('127.0.0.1', self.server.port, idle_timeout=0.05)
+        msg = communicate.email.make_message(['a@b'], FakeProcess())
+        self.assertEqual(pool.send_messages([msg]), [None])
+        time.sleep(0.1)
+        self.assertEqual(pool.send_messages([msg]), [None])
+        pool.close()
+        self.assertEqual(self.server.connections, 2)
+
+    def test_batch_in_one_session(self):
+        errors = communicate.email.send_batch([(FakeProcess(), '{pid} ended')] * 5, to=['a@b'],
+                                              host='127.0.0.1', port=self.server.port)
+        self.assertEqual(errors, [None] * 5)
+        self.assertEqual(len(self.server.messages), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_dispatcher_batches(self):
+        dispatcher = Dispatcher()
+        channel = dispatcher.add_channel(communicate.email, {'to': ['a@b'], 'host': '127.0.0.1',
+                                                             'port': self.server.port})
+        for _ in range(20):
+            dispatcher.submit(FakeProcess())
+        dispatcher.close(timeout=5)
+        self.assertEqual(channel.sent, 20)
+        self.assertEqual(len(self.server.messages), 20)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_server_down(self):
+        port = self.server.port
+        self.server.shutdown()
+        self.server.server_close()
+        errors = communicate.email.send_batch([(FakeProcess(), '{pid} ended')] * 2, to=['a@b'],
+                                              host='127.0.0.1', port=port)
+        self.assertEqual(len(errors), 2)
+        self.assertIsInstance(errors[0], ConnectionRefusedError)
+
+
+if __name__ == '__main__':
+    unittest.main()
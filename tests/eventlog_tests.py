@@ -0,0 +1,89 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from process import ProcessByPID
+from process.eventlog import EventLog
+
+
+class EventLogTests(unittest.TestCase):
+    """Test JSON lines event output"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_buffered_file(self):
+        log = EventLog(self.path, buffer_size=300, flush_interval=60)
+        log.emit('watch-start', 10.0, pid=1, command='sleep "5"')
+        # Buffered until the size threshold
+        self.assertEqual(self.read(), [])
+
+        process = ProcessByPID(os.getpid())
+        log.samples([process] * 3, 11.0)
+        events = self.read()
+        self.assertEqual(events[0], {'event': 'watch-start', 'time': 10.0, 'pid': 1, 'command': 'sleep "5"'})
+        self.assertEqual([event['event'] for event in events], ['watch-start'] + ['sample'] * 3)
+        self.assertEqual(events[1]['pid'], os.getpid())
+        self.assertEqual(events[1]['start_time'], process.start_time)
+        self.assertEqual(events[1]['rss'], process.status['VmRSS'])
+
+        log.emit('exit', pid=1)
+        log.close()
+        self.assertEqual(self.read()[-1]['event'], 'exit')
+        self.assertEqual(log.stats()['written'], 5)
+        process.close()
+
+    def test_flush_interval(self):
+        log = EventLog(self.path, flush_interval=0.05)
+        log.emit('exit', pid=1)
+        for _ in range(100):
+            if self.read():
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(len(self.read()), 1)
+        log.close()
+
+    def test_rotation(self):
+        log = EventLog(self.path, buffer_size=1, max_bytes=100, backups=2)
+        for i in range(10):
+            log.emit('exit', 0.0, pid=i)
+        log.close()
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['events.jsonl', 'events.jsonl.1', 'events.jsonl.2'])
+        for path in (self.path + '.2', self.path + '.1', self.path):
+            self.assertLessEqual(os.path.getsize(path), 100)
+        # Newest events in the current file, oldest rotated out
+        self.assertEqual(self.read()[-1]['pid'], 9)
+        self.assertEqual(log.rotations, 4)
+
+    def test_fifo(self):
+        os.mkfifo(self.path)
+        log = EventLog(self.path, buffer_size=1)
+        # No reader: dropped instead of blocking
+        log.emit('exit', pid=1)
+        self.assertEqual(log.dropped, 1)
+
+        reader = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        log.emit('exit', pid=2)
+        self.assertEqual(json.loads(os.read(reader, 1000))['pid'], 2)
+
+        # Reader gone
+        os.close(reader)
+        log.emit('exit', pid=3)
+        self.assertEqual(log.dropped, 2)
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import unittest
+import os
+import selectors
+import shutil
+import tempfile
+import threading
+import time
+
+import process
+from process import ProcessByPID
+from process.fleet import Agent, Collector, RemoteAlert, RemoteProcess
+from benchmarks.fakeproc import FakeProc
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out waiting')
+        time.sleep(0.01)
+
+
+class FleetTests(unittest.TestCase):
+    """Test agents sending events to a collector on localhost"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'collector.sock')
+        self.received = []
+        self.selector = None
+        self.collector = None
+
+    def tearDown(self):
+        if self.collector is not None:
+            self._stop.set()
+            self._thread.join()
+            self.collector.close()
+        process.PROC_DIR = '/proc'
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def start_collector(self):
+        """Serve a collector from a thread, like the watcher's main loop"""
+        self.collector = Collector(self.address, lambda host, event: self.received.append((host, event)))
+        self.selector = selectors.DefaultSelector()
+        self.collector.register(self.selector)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            for key, _ in self.selector.select(0.05):
+                key.data()
+
+    def read_processes(self, fake):
+        """:return ProcessByPID for each process in a fake /proc"""
+        process.PROC_DIR = fake.path
+        try:
+            return [ProcessByPID(pid) for pid in sorted(fake.pids)]
+        finally:
+            process.PROC_DIR = '/proc'
+
+    def test_fleet(self):
+        self.start_collector()
+        hosts = ['web-1', 'web-2', 'db-1']
+        agents = []
+        for i, host in enumerate(hosts):
+            with FakeProc(seed=i) as fake:
+                fake.populate(5)
+                processes = self.read_processes(fake)
+            agent = Agent(self.address, host=host, batch_size=4, flush_interval=0.05)
+            agents.append(agent)
+            for p in processes:
+                agent.emit('watch-start', 100.0, pid=p.pid, start_time=p.start_time, command=p.command,
+                           executable=p.executable, created=p.created)
+            agent.samples(processes, 101.0)
+            ended = processes[0]
+            ended.mark_ended(-9)
+            agent.emit('exit', ended.ended, **ended.as_dict())
+
+        for agent in agents:
+            agent.close()
+            self.assertEqual(agent.stats()['sent'], 11)
+            self.assertEqual(agent.connects, 1)
+        wait_for(lambda: self.collector.events == 33)
+
+        exits = [(host, event['exit_code']) for host, event in self.received if event['event'] == 'exit']
+        self.assertEqual(sorted(exits), sorted((host, -9) for host in hosts))
+        self.assertEqual(self.collector.duplicates, 0)
+
+        fleet = self.collector.fleet()
+        self.assertEqual(sorted(fleet), sorted(hosts))
+        for host in hosts:
+            processes = fleet[host]['processes']
+            # The ended one is gone, the others have their command and latest sample
+            self.assertEqual(len(processes), 4)
+            self.assertTrue(all(p['event'] == 'sample' and p['time'] == 101.0 and p['command'] for p in processes))
+            wait_for(lambda: not self.collector.fleet()[host]['connected'])
+
+    def test_spool_until_collector_starts(self):
+        spool = os.path.join(self.directory, 'spool.jsonl')
+        agent = Agent(self.address, host='web-1', spool=spool, flush_interval=0.05, max_retry_interval=0.1)
+        for pid in range(1, 4):
+            agent.emit('alert', 100.0 + pid, pid=pid, start_time=pid, rule='rss > 1GB', value=2e6,
+                       resolved=False)
+        wait_for(lambda: os.path.exists(spool) and os.path.getsize(spool) > 0)
+        self.assertEqual(agent.sent, 0)
+
+        self.start_collector()
+        wait_for(lambda: agent.sent == 3)
+        self.assertEqual(os.path.getsize(spool), 0)
+        agent.emit('exit', 200.0, pid=1, start_time=1)
+        agent.close()
+        wait_for(lambda: len(self.received) == 4)
+        self.assertEqual([event['pid'] for _, event in self.received], [1, 2, 3, 1])
+        self.assertEqual(agent.dropped, 0)
+
+    def test_replayed_events(self):
+        collector = Collector(self.address)
+        received = []
+        collector.on_event = lambda host, event: received.append(event)
+        try:
+            exit_event = {'event': 'exit', 'time': 10.0, 'pid': 5, 'start_time': 50}
+            collector.handle_event('web-1', exit_event)
+            # Same event sent again after a lost acknowledgement
+            collector.handle_event('web-1', dict(exit_event))
+            # Another host's process with the same PID
+            collector.handle_event('web-2', dict(exit_event))
+            self.assertEqual(len(received), 2)
+            self.assertEqual(collector.duplicates, 1)
+
+            collector.handle_event('web-1', {'event': 'sample', 'time': 20.0, 'pid': 6, 'start_time': 60, 'rss': 2})
+            collector.handle_event('web-1', {'event': 'sample', 'time': 15.0, 'pid': 6, 'start_time': 60, 'rss': 1})
+            self.assertEqual(collector.fleet()['web-1']['processes'][0]['rss'], 2)
+            # Samples aren't passed on
+            self.assertEqual(len(received), 2)
+        finally:
+            collector.close()
+
+    def test_remote_objects(self):
+        p = ProcessByPID(os.getpid())
+        p.mark_ended(3)
+        ended = RemoteProcess.from_event('web-1', dict(p.as_dict(), event='exit', time=1.0))
+        self.assertFalse(ended.running)
+        self.assertEqual((ended.pid, ended.exit_code, ended.tag), (p.pid, 3, 'web-1'))
+        self.assertTrue(ended.info().startswith('Host: web-1\n'))
+        self.assertEqual(ended.as_dict()['host'], 'web-1')
+
+        alert = RemoteAlert('web-1', {'event': 'alert', 'time': 1.0, 'pid': 5, 'start_time': 50,
+                                      'rule': 'rss > 1GB', 'value': 2e6, 'value_text': '2,000,000 kB',
+                                      'resolved': True, 'executable': 'app', 'command': 'app --serve'})
+        self.assertEqual('{executable} process {pid} alert resolved {text}'.format(**alert.__dict__),
+                         'app process 5 alert resolved rss > 1GB')
+        self.assertIn('Alert rss > 1GB: 2,000,000 kB', alert.info())
+
+
+if __name__ == '__main__':
+    unittest.main()
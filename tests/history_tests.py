@@ -0,0 +1,43 @@
+import unittest
+
+from process.history import SampleHistory, CLOCK_TICKS
+
+
+class HistoryTests(unittest.TestCase):
+    """Test the sample ring buffer"""
+
+    def test_empty(self):
+        history = SampleHistory(4)
+        self.assertEqual(len(history), 0)
+        self.assertEqual(history.rss_mean, 0)
+        self.assertEqual(history.rss_p95, 0)
+        self.assertEqual(history.rss_growth, 0)
+        self.assertEqual(history.cpu_percent, 0)
+
+    def test_wraps_around(self):
+        history = SampleHistory(4)
+        for i in range(10):
+            # 60 kB more each minute, half a core
+            history.append(1000.0 + 60 * i, 100 + 60 * i, 500, i * 30 * CLOCK_TICKS)
+
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.count, 10)
+        # Only the last 4 samples remain
+        self.assertEqual(list(history._ordered(history.rss)), [460, 520, 580, 640])
+        self.assertEqual(history.rss_mean, 550)
+        self.assertEqual(history.rss_p95, 640)
+        self.assertAlmostEqual(history.rss_growth, 60)
+        self.assertAlmostEqual(history.cpu_percent, 50)
+
+    def test_spike_vs_leak(self):
+        spike = SampleHistory(10)
+        leak = SampleHistory(10)
+        for i in range(10):
+            spike.append(i, 5000 if i == 5 else 100, 0, 0)
+            leak.append(i, 100 + 50 * i, 0, 0)
+        self.assertLess(abs(spike.rss_growth), leak.rss_growth)
+        self.assertEqual(spike.rss_p95, 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
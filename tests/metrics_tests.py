@@ -0,0 +1,99 @@
+import unittest
+import http.client
+import selectors
+import subprocess
+import threading
+
+from process import *
+from process.metrics import Metrics, MetricsServer, Histogram, parse_address
+
+
+class MetricsTests(unittest.TestCase):
+    """Test the OpenMetrics exporter"""
+
+    def setUp(self):
+        self.sleep_process = subprocess.Popen(['sleep', '5'])
+        self.process = ProcessByPID(self.sleep_process.pid)
+        self.metrics = Metrics({self.process.pid: self.process})
+
+    def tearDown(self):
+        self.sleep_process.kill()
+        self.sleep_process.communicate()
+
+    def test_render(self):
+        self.metrics.start_tick()
+        self.metrics.end_tick()
+        text = self.metrics.render()
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('process_watcher_process_resident_memory_bytes{{pid="{}",executable="{}"}} {}\n'.format(
+            self.process.pid, self.process.executable, self.process.status['VmRSS'] * 1024), text)
+        self.assertIn('process_watcher_watched_processes 1\n', text)
+        self.assertIn('process_watcher_tick_seconds_count 1\n', text)
+        self.assertIn('process_watcher_files_opened_total ', text)
+
+        self.process.mark_ended(-9)
+        self.metrics.process_ended(self.process)
+        self.assertIn('process_watcher_exits_total{{executable="{}",exit_code="-9"}} 1\n'.format(
+            self.process.executable), self.metrics.render())
+
+    def test_incremental(self):
+        """Process samples are only formatted again after the process is checked"""
+        lines = self.metrics._process_lines(self.process)
+        self.metrics.render()
+        self.assertIs(self.metrics._process_lines(self.process), lines)
+
+        self.process.check(self.process.sample_time + 1)
+        self.assertIsNot(self.metrics._process_lines(self.process), lines)
+
+        self.metrics.processes.clear()
+        self.metrics.render()
+        self.assertEqual(self.metrics._rendered, {})
+
+    def test_histogram(self):
+        histogram = Histogram((1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.lines('x', 'help')[2:], [
+            'x_bucket{le="1.0"} 2\n', 'x_bucket{le="2.0"} 3\n', 'x_bucket{le="+Inf"} 4\n',
+            'x_count 4\n', 'x_sum 6.0\n'])
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('9100')[1], ('127.0.0.1', 9100))
+        self.assertEqual(parse_address('0.0.0.0:9100')[1], ('0.0.0.0', 9100))
+        self.assertEqual(parse_address('[::1]:9100')[1], ('::1', 9100))
+        self.assertEqual(parse_address('/run/metrics.sock')[1], '/run/metrics.sock')
+
+    def test_http(self):
+        server = MetricsServer('127.0.0.1:0', self.metrics)
+        selector = selectors.DefaultSelector()
+        server.register(selector)
+        running = True
+
+        def serve():
+            while running:
+                for key, _ in selector.select(0.05):
+                    key.data()
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            connection = http.client.HTTPConnection(*server.address, timeout=5)
+            connection.request('GET', '/metrics')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertIn(b'process_watcher_watched_processes 1\n', response.read())
+            connection.close()
+
+            connection = http.client.HTTPConnection(*server.address, timeout=5)
+            connection.request('GET', '/other')
+            self.assertEqual(connection.getresponse().status, 404)
+            connection.close()
+        finally:
+            running = False
+            thread.join()
+            server.close()
+            selector.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
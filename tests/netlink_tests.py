@@ -0,0 +1,67 @@
+import unittest
+
+from process import *
+from process.netlink import parse_events, PROC_EVENT_FORK, PROC_EVENT_EXEC, PROC_EVENT_EXIT
+
+# Recorded from the proc connector while running `sh -c 'exit 3'` (PID 3224, parent 3171)
+FORK_BUFFER = bytes.fromhex(
+    '4c000000030000009e0600000000000001000000010000009e0600000000000028000000010000000000000014c3491175000000'
+    '630c0000630c0000980c0000980c00000000000000000000')
+EXEC_BUFFER = bytes.fromhex(
+    '4c000000030000009f0600000000000001000000010000009f06000000000000280000000200000000000000645f4d1175000000'
+    '980c0000980c000000000000000000000000000000000000')
+EXIT_BUFFER = bytes.fromhex(
+    '4c00000003000000a0060000000000000100000001000000a006000000000000280000000000008000000000a3df531175000000'
+    '980c0000980c00000003000011000000630c0000630c0000')
+
+
+class FakeConnector:
+    """Replays recorded buffers in place of process.netlink.ProcConnector"""
+
+    def __init__(self, *buffers):
+        self.buffers = list(buffers)
+        self.overrun = False
+
+    def read_events(self):
+        events = []
+        for data in self.buffers:
+            events.extend(parse_events(data))
+        self.buffers.clear()
+        return events
+
+
+class NetlinkTests(unittest.TestCase):
+    """Test proc connector event parsing"""
+
+    def test_parse_recorded_events(self):
+        events = list(parse_events(FORK_BUFFER + EXEC_BUFFER + EXIT_BUFFER))
+        self.assertEqual([e.what for e in events], [PROC_EVENT_FORK, PROC_EVENT_EXEC, PROC_EVENT_EXIT])
+        self.assertTrue(all(e.pid == 3224 and e.is_process for e in events))
+        self.assertEqual(events[0].parent_tgid, 3171)
+        self.assertIsNone(events[1].returncode)
+        self.assertEqual(events[2].returncode, 3)
+
+    def test_truncated_buffer(self):
+        self.assertEqual(list(parse_events(EXIT_BUFFER[:40])), [])
+
+    def test_process_ids_from_events(self):
+        connector = FakeConnector()
+        processes = ProcessIDs(events=connector)
+        # First iteration still lists /proc for already running processes
+        self.assertGreater(len(list(processes)), 1)
+        # In case the recorded PID happens to be running now
+        processes.seen.pop(3224, None)
+
+        connector.buffers = [FORK_BUFFER, EXEC_BUFFER]
+        # Yielded for the fork and again for the exec (new command)
+        self.assertEqual(list(processes), [3224, 3224])
+        self.assertIn(3224, processes.seen)
+
+        connector.buffers = [EXIT_BUFFER]
+        self.assertEqual(list(processes), [])
+        self.assertNotIn(3224, processes.seen)
+        self.assertEqual(processes.exited[3224].returncode, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import subprocess
+
+from process.pidfd import PidfdWatcher
+
+
+class PidfdTests(unittest.TestCase):
+    """Test pidfd exit detection"""
+
+    def test_exit_detected(self):
+        watcher = PidfdWatcher()
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        short_process = subprocess.Popen(['sleep', '0.1'])
+
+        self.assertTrue(watcher.add(sleep_process.pid))
+        self.assertTrue(watcher.add(short_process.pid))
+        self.assertEqual(len(watcher), 2)
+        self.assertEqual(watcher.read_exited(timeout=0), [])
+
+        self.assertEqual(watcher.read_exited(timeout=2), [short_process.pid])
+        self.assertNotIn(short_process.pid, watcher)
+        self.assertIn(sleep_process.pid, watcher)
+
+        sleep_process.kill()
+        self.assertEqual(watcher.read_exited(timeout=2), [sleep_process.pid])
+        self.assertEqual(len(watcher), 0)
+
+        sleep_process.communicate()
+        short_process.communicate()
+        watcher.close()
+
+    def test_gone_process(self):
+        watcher = PidfdWatcher()
+        process = subprocess.Popen(['true'])
+        process.communicate()
+        self.assertFalse(watcher.add(process.pid))
+        watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
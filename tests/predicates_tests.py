@@ -0,0 +1,91 @@
+import unittest
+
+import process
+from process import ProcessMatcher, counters
+from process.predicates import MatchExpression, ProcessFacts
+from benchmarks.fakeproc import FakeProc
+
+
+class PredicateTests(unittest.TestCase):
+    """Test match expressions against a synthetic /proc tree"""
+
+    def setUp(self):
+        self.fake = FakeProc(seed=1)
+        process.PROC_DIR = self.fake.path
+        fake = self.fake
+        self.cron = fake.add(comm='cron', cmdline=['/usr/sbin/cron', '-f'], uid=0, cgroup='/system.slice/cron.service')
+        self.backup = fake.add(comm='python3', cmdline=['python3', 'backup.py', '--full'], ppid=self.cron, uid=0,
+                               cgroup='/system.slice/cron.service')
+        self.web = fake.add(comm='gunicorn', cmdline=['gunicorn', 'app:main', '--workers', '4'], uid=33,
+                            cgroup='/system.slice/web.service')
+        self.script = fake.add(comm='python3', cmdline=['python3', 'report.py'], ppid=self.web, uid=1000)
+
+    def tearDown(self):
+        process.PROC_DIR = '/proc'
+        self.fake.cleanup()
+
+    def matching(self, text):
+        matcher = ProcessMatcher()
+        matcher.add_expression(text)
+        return sorted(matcher.matching(sorted(self.fake.pids)))
+
+    def test_fields(self):
+        self.assertEqual(self.matching('comm = python* and parent = cron'), [self.backup])
+        self.assertEqual(self.matching('user = root and not pid = {}'.format(self.cron)), [self.backup])
+        self.assertEqual(self.matching('uid = 33 or cmdline ~ report'), [self.web, self.script])
+        self.assertEqual(self.matching('cgroup = /system.slice/* and cmdline !~ "--full"'), [self.cron, self.web])
+        self.assertEqual(self.matching('ppid = {} or (cgroup = *cron* and comm != cron)'.format(self.web)),
+                         [self.backup, self.script])
+        self.assertEqual(self.matching("cmdline = 'gunicorn app:main *'"), [self.web])
+
+    def test_cost_order(self):
+        expression = MatchExpression('cmdline ~ backup and (cgroup = /system.slice/* or user = 0) and comm = python3')
+        self.assertEqual([child.cost for child in expression.root.children], [0, 4, 5])
+        self.assertEqual(expression.root.children[1].children[0].field, 'user')
+
+    def test_reads(self):
+        """Each file is read at most once, and not at all once the result is known"""
+        expression = MatchExpression('comm = gunicorn and (cmdline ~ app or cmdline ~ workers) and uid = 33 '
+                                     'and user != 0')
+        opened = counters['files_opened']
+        self.assertFalse(expression.matches(ProcessFacts(self.script, 'python3')))
+        self.assertEqual(counters['files_opened'], opened)
+
+        self.assertTrue(expression.matches(ProcessFacts(self.web, 'gunicorn')))
+        # status and cmdline
+        self.assertEqual(counters['files_opened'], opened + 2)
+
+        facts = ProcessFacts(self.backup)
+        self.assertEqual((facts.comm, facts.parent, facts.ppid), ('python3', 'cron', self.cron))
+        # its stat and its parent's
+        self.assertEqual(counters['files_opened'], opened + 4)
+
+    def test_ended(self):
+        matcher = ProcessMatcher()
+        matcher.add_expression('cmdline ~ report')
+        facts = ProcessFacts(self.script, 'python3')
+        self.fake.remove(self.script)
+        self.assertFalse(MatchExpression('cmdline ~ report').matches(facts))
+        self.assertEqual(list(matcher.matching([self.script])), [])
+
+    def test_matcher_conditions(self):
+        matcher = ProcessMatcher()
+        matcher.add_command_wildcard('cron')
+        matcher.add_expression('cmdline ~  report')
+        self.assertEqual(matcher.expressions, ['cmdline ~ report'])
+        self.assertEqual(matcher.num_conditions, 2)
+        self.assertEqual(sorted(matcher.matching(self.fake.pids)), [self.cron, self.script])
+
+        # Cached results are matched again once conditions change
+        matcher.remove_expression('cmdline ~ report')
+        self.assertFalse(matcher.matches(self.script))
+        self.assertRaises(ValueError, matcher.remove_expression, 'cmdline ~ report')
+
+    def test_invalid(self):
+        for text in ('', 'user =', 'size > 5', 'pid ~ 5', 'comm = a b', '(comm = a', 'comm = a and',
+                     'cmdline ~ "("', 'user = no-such-user-here', 'comm = a!b'):
+            self.assertRaises(ValueError, MatchExpression, text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 import unittest
+import os
 import time
 import re
 import subprocess
 
 from process import *
+from process.parallel import ShardPool
 
 
 class ProcessTests(unittest.TestCase):
@@ -13,8 +15,7 @@ class ProcessTests(unittest.TestCase):
         """Verify that all_processes yields each PID once and finds new processes."""
 
         start_time = time.time()
-        cleanup_seen_interval = 0.05
-        processes = ProcessIDs(cleanup_seen_interval=cleanup_seen_interval)
+        processes = ProcessIDs()
         proc_list = [pid for pid in processes]
 
         self.assertGreater(len(proc_list), 10)
@@ -28,23 +29,53 @@ class ProcessTests(unittest.TestCase):
         sleep_process = subprocess.Popen(['sleep', '5'])
 
         self.assertIn(sleep_process.pid, [pid for pid in processes])
+        start = processes.seen[sleep_process.pid]
+        self.assertEqual(start, read_start_time(sleep_process.pid))
 
         # Again, check that next iter is empty
         self.assertFalse([pid for pid in processes])
+        self.assertFalse(processes.disappeared)
 
         sleep_process.kill()  # avoid confusing other tests
         sleep_process.communicate()
 
         print('first part of test took {} sec'.format(time.time() - start_time))
 
-        # Trigger cleanup
-        time.sleep(cleanup_seen_interval)
+        # The next listing reports it gone
         self.assertIn(sleep_process.pid, processes.seen)
         for pid in processes:
             pass
 
         self.assertNotIn(sleep_process.pid, processes.seen)
+        self.assertEqual(processes.disappeared[sleep_process.pid], start)
+
+    def test_reused_pid(self):
+        """A PID whose /proc entry was made again for another process is reported as ended and new"""
+        removed = []
+        processes = ProcessIDs(on_remove=removed.append)
+        list(processes)
+        pid = os.getpid()
+        # As if the PID belonged to an earlier process
+        processes.seen[pid] -= 1
+        processes._inodes[pid] += 1
+
+        self.assertIn(pid, list(processes))
+        self.assertEqual(processes.disappeared, {pid: processes.seen[pid] - 1})
+        self.assertEqual(removed, [pid])
 
+        # Same process, inode cached again: nothing changes
+        processes.disappeared.clear()
+        processes._inodes[pid] += 1
+        self.assertNotIn(pid, list(processes))
+        self.assertFalse(processes.disappeared)
+
+    def test_check_reused_pid(self):
+        """A watched process ends when its PID now belongs to another process"""
+        process = ProcessByPID(os.getpid())
+        self.assertTrue(process.check())
+        process.start_time -= 1
+        self.assertFalse(process.check())
+        self.assertFalse(process.running)
 
     def test_wildcard_match(self):
         """Verify pids can be found by command regex"""
@@ -95,6 +126,111 @@ class ProcessTests(unittest.TestCase):
         pids = list(matcher.matching(processes))
         self.assertFalse(pids)
 
+    def test_check_all_accounting(self):
+        """Verify CPU, I/O and context switch totals and rates are collected"""
+
+        busy_process = subprocess.Popen(['python3', '-c', 'import time\nend = time.time() + 0.5\nwhile time.time() < end: pass'])
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        processes = [ProcessByPID(busy_process.pid), ProcessByPID(sleep_process.pid)]
+
+        time.sleep(0.3)
+        ended, errors = check_all(processes)
+        self.assertEqual((ended, errors), ([], []))
+        busy = processes[0]
+        self.assertGreater(busy.cpu_percent, 10)
+        self.assertGreater(busy.utime, 0)
+        self.assertGreater(busy.status['voluntary_ctxt_switches'] + busy.status['nonvoluntary_ctxt_switches'], 0)
+        # Same timestamp for every process in the pass
+        self.assertEqual(processes[0].sample_time, processes[1].sample_time)
+
+        sleep_process.kill()
+        sleep_process.communicate()
+        busy_process.communicate()
+        ended, errors = check_all(processes)
+        self.assertEqual(ended, processes)
+        self.assertIn('CPU time - User:', busy.info())
+
+    def test_sharded_scan(self):
+        """Verify a ShardPool gives the same results, in the same order, as a serial scan"""
+
+        sleep_processes = [subprocess.Popen(['sleep', '5']) for _ in range(3)]
+        pids = list(ProcessIDs())
+        matcher = ProcessMatcher()
+        matcher.add_command_wildcard('sleep')
+
+        pool = ShardPool(4, min_shard_size=1)
+        try:
+            matched = list(matcher.matching(pids, pool))
+            self.assertEqual(matched, list(matcher.matching(pids)))
+            for p in sleep_processes:
+                self.assertIn(p.pid, matched)
+
+            processes = [ProcessByPID(p.pid) for p in sleep_processes]
+            for p in sleep_processes:
+                p.kill()
+                p.communicate()
+            ended, errors = check_all(processes, pool)
+            self.assertEqual(ended, processes)
+            self.assertEqual(errors, [])
+        finally:
+            pool.close()
+
+    def test_combined_match(self):
+        """Verify wildcards and regexes (with inline flags) combine into one matcher"""
+
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        matcher = ProcessMatcher()
+        self.assertFalse(matcher.matches(sleep_process.pid))
+        matcher.add_command_wildcard('aoeutshoaeutnhoeunaotehuoensuhtnaoeunth')
+        matcher.add_command_regex('(?i)SLE+P')
+        self.assertEqual(matcher.num_conditions, 2)
+        self.assertTrue(matcher.matches(sleep_process.pid))
+        self.assertIn(sleep_process.pid, matcher._cache)
+
+        matcher.forget(sleep_process.pid)
+        self.assertNotIn(sleep_process.pid, matcher._cache)
+
+        sleep_process.kill()
+        sleep_process.communicate()
+        self.assertFalse(matcher.matches(sleep_process.pid))
+
+    def test_remove_conditions(self):
+        """Verify removing patterns recompiles the matcher"""
+
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        matcher = ProcessMatcher()
+        matcher.add_command_wildcard('sle*')
+        matcher.add_command_regex('sleep')
+        self.assertEqual((matcher.command_wildcards, matcher.command_regexs), (['sle*'], ['sleep$']))
+
+        matcher.remove_command_wildcard('sle*')
+        self.assertTrue(matcher.matches(sleep_process.pid))
+        matcher.remove_command_regex('sleep')
+        self.assertEqual(matcher.num_conditions, 0)
+        self.assertFalse(matcher.matches(sleep_process.pid))
+        self.assertRaises(ValueError, matcher.remove_command_regex, 'sleep')
+
+        sleep_process.kill()
+        sleep_process.communicate()
+
+    def test_group_references(self):
+        """Verify regexes with groups referred to keep their meaning and a bad regex changes nothing"""
+
+        matcher = ProcessMatcher()
+        matcher.add_command_regex('(a)\\1')
+        matcher.add_command_regex('(b)\\1')
+        matcher.add_command_regex('(?P<n>c)(?P=n)')
+        matcher.add_command_regex('(?P<n>d)(?P=n)')
+        matcher.add_command_wildcard('e*')
+        self.assertEqual(len(matcher._separate_res), 4)
+        for comm, matched in (('aa', True), ('bb', True), ('cc', True), ('dd', True), ('ab', False), ('ee', True)):
+            self.assertEqual(matcher._match(1, comm, None), matched, comm)
+
+        self.assertRaises(re.error, matcher.add_command_regex, '(')
+        self.assertEqual(matcher.num_conditions, 5)
+        matcher.add_command_wildcard('f*')
+        self.assertTrue(matcher._match(1, 'ff', None))
+
     def test_process_obj_identity(self):
         """Verify ProcessByPID identity behavior"""
 
@@ -106,6 +242,60 @@ class ProcessTests(unittest.TestCase):
         self.assertEqual(p1, p2)
         self.assertIsNot(p1, p2)
 
+    def test_keep_open(self):
+        """Verify status is re-read from the kept fd and a stale fd ends the process"""
+
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        ProcessByPID.keep_open = True
+        try:
+            p = ProcessByPID(sleep_process.pid)
+        finally:
+            ProcessByPID.keep_open = False
+
+        self.assertIsNotNone(p._status_fd)
+        self.assertGreater(p.status['VmRSS'], 0)
+        self.assertGreaterEqual(p.status['VmPeak'], p.status['VmSize'])
+        self.assertTrue(p.check())
+
+        sleep_process.kill()
+        sleep_process.communicate()
+        self.assertFalse(p.check())
+        self.assertFalse(p.running)
+        self.assertIsNone(p._status_fd)
+
+    def test_without_io(self):
+        """Verify a check opens only stat and status when io isn't read, and info() leaves I/O out"""
+
+        ProcessByPID.read_io = False
+        try:
+            p = ProcessByPID(os.getpid())
+            opened = counters['files_opened']
+            self.assertTrue(p.check())
+            self.assertEqual(counters['files_opened'], opened + 2)
+            self.assertNotIn('I/O', p.info())
+        finally:
+            ProcessByPID.read_io = True
+
+        self.assertTrue(p.check())
+        self.assertEqual(counters['files_opened'], opened + 5)
+        self.assertIn('I/O', p.info())
+
+    def test_compact_record(self):
+        """Verify the slotted record still formats like an instance __dict__"""
+
+        p = ProcessByPID(os.getpid())
+        with self.assertRaises(AttributeError):
+            p.extra = 1
+        self.assertIs(p.command, ProcessByPID(os.getpid()).command)
+
+        p.mark_ended(-9)
+        self.assertEqual('{executable} process {pid} ended after {duration_text}'.format(**p.__dict__),
+                         '{} process {} ended after {}'.format(p.executable, p.pid, p.duration_text))
+        self.assertAlmostEqual((p.ended_datetime - p.created_datetime).total_seconds(), p.ended - p.created, 3)
+        self.assertIn('Ended:', p.info())
+        self.assertEqual(dict(p.status), p.as_dict()['status'])
+        self.assertEqual(set(p.status), set(ProcessByPID.status_fields))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from process.schedule import Scheduler, adaptive_interval
+
+
+class ScheduleTests(unittest.TestCase):
+    """Test deadline scheduling"""
+
+    def test_pop_due_in_order(self):
+        scheduler = Scheduler()
+        scheduler.schedule(1, 30.0)
+        scheduler.schedule(2, 10.0)
+        scheduler.schedule('discover', 20.0)
+        self.assertEqual(scheduler.next_deadline(), 10.0)
+        self.assertEqual(scheduler.pop_due(5.0), [])
+        self.assertEqual(scheduler.pop_due(25.0), [2, 'discover'])
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(scheduler.next_deadline(), 30.0)
+
+    def test_reschedule_and_cancel(self):
+        scheduler = Scheduler()
+        scheduler.schedule(1, 10.0)
+        scheduler.schedule(1, 40.0)
+        scheduler.schedule(2, 20.0)
+        scheduler.cancel(2)
+        self.assertNotIn(2, scheduler)
+        self.assertEqual(scheduler.next_deadline(), 40.0)
+        self.assertEqual(scheduler.pop_due(100.0), [1])
+        self.assertIsNone(scheduler.next_deadline())
+
+    def test_adaptive_interval(self):
+        self.assertEqual(adaptive_interval(2, 1, 60), 1)
+        self.assertEqual(adaptive_interval(100, 1, 60), 10)
+        self.assertEqual(adaptive_interval(3 * 7 * 24 * 3600, 1, 60), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
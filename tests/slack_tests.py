@@ -0,0 +1,110 @@
+import unittest
+import http.server
+import json
+import threading
+
+import communicate.slack
+from communicate.slack import RateLimited
+
+
+class FakeProcess:
+    def __init__(self, pid):
+        self.pid = pid
+        self.executable = 'fake'
+
+    def info(self):
+        return 'PID {}: fake'.format(self.pid)
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.rate_limit:
+            self.server.rate_limit = False
+            self.send_response(429)
+            self.send_header('Retry-After', '30')
+        else:
+            self.server.posts.append(json.loads(body))
+            self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeWebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), WebhookHandler)
+        self.connections = 0
+        self.posts = []
+        self.rate_limit = False
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/services/T0/B0/X'.format(self.server_address[1])
+
+
+class SlackTests(unittest.TestCase):
+    """Test Slack webhook posts against a local HTTP stand-in"""
+
+    def setUp(self):
+        self.server = FakeWebhookServer()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for pid in range(3):
+            communicate.slack.send(process=FakeProcess(pid), url=self.server.url)
+        self.assertEqual(len(self.server.posts), 3)
+        self.assertEqual(self.server.connections, 1)
+        # Quotes don't need escaping anymore
+        process = FakeProcess(4)
+        process.info = lambda: "it's \"quoted\""
+        communicate.slack.send(process=process, url=self.server.url)
+        self.assertTrue(self.server.posts[-1]['text'].startswith("Process has stopped.\nit's \"quoted\""))
+
+    def test_batch_one_message(self):
+        errors = communicate.slack.send_batch([(FakeProcess(pid), None) for pid in range(5)], url=self.server.url)
+        self.assertEqual(errors, [None] * 5)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(self.server.posts[0]['text'].count('Process has stopped.\nPID '), 5)
+        self.assertIn('PID 4: fake', self.server.posts[0]['text'])
+
+    def test_batch_headlines(self):
+        alerts = [FakeProcess(pid) for pid in range(2)]
+        for alert in alerts:
+            alert.headline = 'Alert: rss > 1GB'
+        communicate.slack.send_batch([(alert, None) for alert in alerts], url=self.server.url)
+        communicate.slack.send_batch([(alerts[0], None)], url=self.server.url)
+        batch, single = [post['text'] for post in self.server.posts]
+        self.assertEqual(batch.count('Alert: rss > 1GB\nPID '), 2)
+        self.assertNotIn('ended', batch)
+        self.assertTrue(single.startswith('Alert: rss > 1GB\nPID 0: fake'))
+
+    def test_retry_after(self):
+        self.server.rate_limit = True
+        with self.assertRaises(RateLimited) as context:
+            communicate.slack.send(process=FakeProcess(1), url=self.server.url)
+        self.assertEqual(context.exception.retry_after, 30)
+
+        # Not sent again until Retry-After passed
+        with self.assertRaises(RateLimited):
+            communicate.slack.send(process=FakeProcess(1), url=self.server.url)
+        self.assertEqual(self.server.posts, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import os
+import subprocess
+import tempfile
+
+from process import *
+from process.state import StateStore
+
+
+class StateTests(unittest.TestCase):
+    """Test checkpointing watched processes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'state.db')
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_checkpoint_and_load(self):
+        sleep_process = subprocess.Popen(['sleep', '5'])
+        process = ProcessByPID(sleep_process.pid)
+        processes = {process.pid: process}
+
+        store = StateStore(self.path)
+        self.assertEqual(store.checkpoint(processes, {process.pid}, 1.0), 1)
+        # Nothing sampled since
+        self.assertEqual(store.checkpoint(processes, {process.pid}, 2.0), 0)
+        process.check(process.sample_time + 1)
+        self.assertEqual(store.checkpoint(processes, {process.pid}, 3.0), 1)
+        store.close()
+
+        store = StateStore(self.path)
+        saved, = store.load()
+        self.assertTrue(saved.requested)
+        self.assertEqual(saved.updated, process.sample_time)
+        restored = saved.process
+        self.assertEqual(restored.pid, process.pid)
+        self.assertEqual(restored.start_time, process.start_time)
+        self.assertEqual(restored.command, process.command)
+        self.assertEqual(restored.status, process.status)
+        self.assertEqual(restored.created_datetime, process.created_datetime)
+
+        restored.mark_ended()
+        self.assertIn('Ended:', restored.info())
+
+        # No longer watched
+        self.assertEqual(store.checkpoint({}, set(), 4.0), 1)
+        self.assertEqual(store.load(), [])
+        store.close()
+
+        sleep_process.kill()
+        sleep_process.communicate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import os
+import subprocess
+import time
+
+from process import *
+from process.tree import ProcessTree, TreeWatch
+
+
+class TreeTests(unittest.TestCase):
+    """Test process tree tracking"""
+
+    def start_tree(self):
+        """:return Popen of a shell with two sleep children"""
+        shell = subprocess.Popen(['bash', '-c', 'sleep 5 & sleep 5 & wait'], start_new_session=True)
+        # Let it fork
+        time.sleep(0.2)
+        return shell
+
+    def stop_tree(self, shell):
+        # Kill the children first so the shell reaps them instead of leaving orphans
+        os.system('pkill -KILL -P {}'.format(shell.pid))
+        shell.communicate()
+
+    def test_index(self):
+        ids = ProcessIDs()
+        tree = ProcessTree()
+        tree.add(ids)
+
+        shell = self.start_tree()
+        try:
+            added = tree.add(ids)
+            self.assertIn(shell.pid, added)
+            children = tree.descendants(shell.pid)
+            self.assertEqual(len(children), 2)
+            self.assertEqual(tree.ancestor_in(children[0], {shell.pid}), shell.pid)
+            self.assertIsNone(tree.ancestor_in(shell.pid, set(children)))
+
+            # Children stay linked to an ended parent
+            tree.remove(shell.pid)
+            self.assertNotIn(shell.pid, tree)
+            self.assertEqual(sorted(tree.descendants(shell.pid)), sorted(children))
+        finally:
+            self.stop_tree(shell)
+
+    def test_known_parents(self):
+        """A process that ended before it was read is linked using its known parent"""
+        tree = ProcessTree()
+        self.assertEqual(tree.add([999999999]), [])
+        self.assertEqual(tree.add([999999999], {999999999: 1}), [999999999])
+        self.assertEqual(tree.descendants(1), [999999999])
+
+    def test_tree_watch(self):
+        ids = ProcessIDs()
+        tree = ProcessTree()
+        tree.add(ids)
+        shell = self.start_tree()
+        tree.add(ids)
+
+        watch = TreeWatch(shell.pid, tree)
+        self.assertEqual(len(watch.members), 3)
+        self.assertTrue(watch.check())
+        self.assertGreater(watch.rss_total, 0)
+
+        self.stop_tree(shell)
+        self.assertFalse(watch.check())
+        self.assertEqual(watch.processes_total, 3)
+        self.assertEqual(watch.rss_total, 0)
+        self.assertGreater(watch.rss_total_peak, 0)
+        self.assertIn('Processes: 3 (0 running)', watch.info())
+
+
+if __name__ == '__main__':
+    unittest.main()